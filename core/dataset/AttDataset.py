@@ -4,6 +4,7 @@ from PIL import Image
 import numpy as np
 import pickle
 import copy
+from .fixed_list import FixedListMixin
 
 class ReIDDataset(data.Dataset):
     """
@@ -109,7 +110,7 @@ class ReIDDataset(data.Dataset):
     def __len__(self):
         return len(self.image)
 
-class ReIDTestDataset(data.Dataset):
+class ReIDTestDataset(data.Dataset, FixedListMixin):
     """
     person re-identification test set, including val.
     """
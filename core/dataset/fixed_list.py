@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import copy
+
+class FixedListMixin(object):
+    """
+    image lists over the fixed splits shared by the test sets, the
+    distractor segment and the union of several fixed splits.
+    """
+    def add_distractors(self, image_dir=None, feat_file=None):
+        """
+            register an external distractor set as an extra gallery segment,
+            such as the 500k distractors of Market-500k. The distractors are
+            labeled by pid -2, they never match a query and are not junk.
+        Args:
+            image_dir: a directory of distractor images, extracted once
+            feat_file: a precomputed .npy feature file, used instead of image_dir
+        """
+        if feat_file is not None:
+            self.dataset['feat_file_d'] = feat_file
+            N = np.load(feat_file, mmap_mode='r').shape[0]
+            self.dataset['image_d'] = []
+        else:
+            image = []
+            for name in sorted(os.listdir(image_dir)):
+                if os.path.splitext(name)[1].lower() in ['.jpg', '.jpeg', '.png']:
+                    # absolute paths are kept by os.path.join with the root
+                    image.append(os.path.abspath(os.path.join(image_dir, name)))
+            self.dataset['image_d'] = image
+            N = len(image)
+        self.dataset['pid_d'] = [-2] * N
+        self.dataset['cam_d'] = [-1] * N
+        self.dataset['seq_d'] = [0] * N
+        self.dataset['frame_d'] = [0] * N
+        self.dataset['record_d'] = [0] * N
+
+    def create_image_list_by_fixed_distractor(self):
+        """
+            create image list using the registered distractors
+        """
+        self.image = copy.deepcopy( self.dataset['image_d'] )
+        self.pid = copy.deepcopy( self.dataset['pid_d'] )
+        self.cam = copy.deepcopy( self.dataset['cam_d'] )
+        self.seq = copy.deepcopy( self.dataset['seq_d'] )
+        self.frame = copy.deepcopy( self.dataset['frame_d'] )
+        self.record = copy.deepcopy( self.dataset['record_d'] )
+
+    def create_image_list_by_fixed_union(self, splits=('q', 'g', 'gt')):
+        """
+            create image list using the union of fixed image lists, such as
+            query, gallery and groundtruth, each image appears only once
+        Return:
+            index: a dict, index[split][i] is the position in the union list
+                   of the i-th image in the fixed list of split
+        """
+        self.image = []
+        self.pid = []
+        self.cam = []
+        self.seq = []
+        self.frame = []
+        self.record = []
+        position = dict()
+        index = dict()
+        for split in splits:
+            index[split] = []
+            for i, name in enumerate(self.dataset['image_' + split]):
+                if name not in position:
+                    position[name] = len(self.image)
+                    self.image.append(name)
+                    self.pid.append(self.dataset['pid_' + split][i])
+                    self.cam.append(self.dataset['cam_' + split][i])
+                    self.seq.append(self.dataset['seq_' + split][i])
+                    self.frame.append(self.dataset['frame_' + split][i])
+                    self.record.append(self.dataset['record_' + split][i])
+                index[split].append(position[name])
+        return index
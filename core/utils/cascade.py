@@ -0,0 +1,109 @@
+import numpy as np
+from .evaluate import normalize, compute_dist_blocks
+
+
+def summary_feat(feat, num_parts=6, summary='mean'):
+    """
+    the cheap summary of the part features, such as the 6 stripes of PCBModel
+    Args:
+        feat: ndarray with shape [N, num_parts * d], the concatenated parts
+        summary: 'mean' for the mean of the parts, or the index of a single part
+    Returns:
+        ndarray with shape [N, d]
+    """
+    N, D = feat.shape
+    parts = feat.reshape((N, num_parts, D // num_parts))
+    if summary == 'mean':
+        return np.mean(parts, axis=1)
+    return np.ascontiguousarray(parts[:, int(summary), :])
+
+
+def _part_dist(query_feat, gallery_feat, query_square, gallery_square, rows, cols, s, d):
+    """ the squared distance of the part s of the (query, gallery) pairs (rows, cols) """
+    product = np.einsum('pd,pd->p', query_feat[rows, s*d:(s+1)*d], gallery_feat[cols, s*d:(s+1)*d])
+    return np.maximum(query_square[rows, s] + gallery_square[cols, s] - 2 * product, 0)
+
+
+def cascade_search(query_feat, gallery_feat, num_parts=6, topn=500, k=10, summary='mean', \
+    dist_type='euclidean_normL2', max_memory=2**28):
+    """
+    Cascaded retrieval of part features. The gallery is ranked on the summary
+    of the parts, and the top-n candidates of each query get the full
+    distance part by part. The squared distance of the concatenated features
+    is the sum over the parts, so the partial sums are lower bounds, and a
+    candidate is abandoned once its partial sum exceeds the k-th best full
+    distance of the first k candidates of the query. The top-k of the
+    candidates is therefore exact, and the abandoned ones are ranked after
+    it by their partial sums extrapolated to all the parts.
+    Args:
+        query_feat, gallery_feat: float ndarray with shape [N, num_parts * d]
+        topn: number of the candidates of the first stage
+        k: number of the exact top candidates
+        dist_type: 'euclidean', 'euclidean_normL2' or 'cosine', the same as
+            compute_dist on the concatenated features
+    Returns:
+        cand: int ndarray with shape [Q, topn], sorted by the distance
+        cand_dist: float32 ndarray with shape [Q, topn], the distance of dist_type,
+            the extrapolated one for the abandoned candidates
+        computed: the fraction of the part distances of the candidates computed
+    """
+    assert dist_type in ['cosine', 'euclidean', 'euclidean_normL2']
+    query_feat = np.asarray(query_feat, dtype=np.float32)
+    gallery_feat = np.asarray(gallery_feat, dtype=np.float32)
+    if dist_type in ['cosine', 'euclidean_normL2']:
+        query_feat = normalize(query_feat, order=2, axis=1)
+        gallery_feat = normalize(gallery_feat, order=2, axis=1)
+    Q, D = query_feat.shape
+    G = gallery_feat.shape[0]
+    if D % num_parts != 0:
+        print('feature dimension %d is not divisible by %d parts.' % (D, num_parts))
+        raise ValueError
+    d = D // num_parts
+    topn = min(topn, G)
+    k = min(k, topn)
+    # the first stage on the summaries
+    cand = np.zeros((Q, topn), dtype=np.int64)
+    for start, end, dist in compute_dist_blocks(summary_feat(query_feat, num_parts, summary), \
+        summary_feat(gallery_feat, num_parts, summary), dist_type=dist_type, max_memory=max_memory):
+        idx = np.argpartition(dist, topn - 1, axis=1)[:, :topn]
+        order = np.argsort(np.take_along_axis(dist, idx, axis=1), axis=1, kind='stable')
+        cand[start:end] = np.take_along_axis(idx, order, axis=1)
+    # the squared norm of each part
+    query_square = np.sum(np.square(query_feat.reshape((Q, num_parts, d))), axis=2)
+    gallery_square = np.sum(np.square(gallery_feat.reshape((G, num_parts, d))), axis=2)
+    cand_dist = np.zeros((Q, topn), dtype=np.float32)
+    computed = 0
+    block_size = max(1, int(max_memory // (4 * topn * d)))
+    for start in range(0, Q, block_size):
+        end = min(start + block_size, Q)
+        rows = np.repeat(np.arange(start, end), topn)
+        cols = cand[start:end].reshape(-1)
+        partial = np.zeros(len(rows), dtype=np.float32)
+        part_dist = lambda pairs, s: _part_dist(query_feat, gallery_feat, query_square, \
+            gallery_square, rows[pairs], cols[pairs], s, d)
+        # the first k candidates of each query are completed to bound its k-th best
+        rank = np.arange(len(rows)) % topn
+        first = np.nonzero(rank < k)[0]
+        for s in range(num_parts):
+            partial[first] += part_dist(first, s)
+        computed += len(first) * num_parts
+        bound = np.max(partial[first].reshape((end - start, k)), axis=1)
+        # the rest part by part, abandoned once the partial sum exceeds the bound
+        active = np.nonzero(rank >= k)[0]
+        for s in range(num_parts):
+            partial[active] += part_dist(active, s)
+            computed += len(active)
+            abandoned = active[partial[active] > bound[rows[active] - start]]
+            # extrapolate the abandoned ones to all the parts, still beyond the bound
+            partial[abandoned] *= num_parts / float(s + 1)
+            active = active[partial[active] <= bound[rows[active] - start]]
+        cand_dist[start:end] = partial.reshape((end - start, topn))
+    order = np.argsort(cand_dist, axis=1, kind='stable')
+    cand = np.take_along_axis(cand, order, axis=1)
+    cand_dist = np.take_along_axis(cand_dist, order, axis=1)
+    if dist_type == 'cosine':
+        # ||x - y||^2 = 2 - 2cos for the normalized features
+        cand_dist = cand_dist / 2 - 1
+    else:
+        cand_dist = np.sqrt(cand_dist)
+    return cand, cand_dist, computed / float(max(Q * topn * num_parts, 1))
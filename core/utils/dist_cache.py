@@ -0,0 +1,135 @@
+import numpy as np
+from .feat_store import as_float
+from .euclidean import euclidean_from_product
+
+
+class DistanceCache(object):
+    """
+    Evaluation context memoizing the distances between named feature sets.
+    The normalized features, the squared norms and the pairwise distance
+    matrices, such as q_g, q_q and g_g, are computed once and shared by all
+    the evaluation types and re-ranking variants.
+    Args:
+        backend: 'numpy' or 'torch', the backend of the matrix products
+        shared_product: if True, all the dist_types of a pair are derived from
+            one raw inner-product matrix and the norms, i.e. a single GEMM for
+            'cosine', 'euclidean' and 'euclidean_normL2'
+    Usage example:
+        cache = DistanceCache()
+        cache.add('q', query_feat)
+        cache.add('g', gallery_feat)
+        q_g_dist = cache.dist('q', 'g', 'euclidean_normL2')
+        g_q_dist = cache.dist('g', 'q', 'euclidean_normL2') # a hit, q_g_dist.T
+        print(cache.hits, cache.misses)
+    """
+    def __init__(self, backend='numpy', shared_product=False):
+        self.backend = backend
+        self.shared_product = shared_product
+        self.feats = dict()
+        self.normalized = dict()
+        self.squares = dict()
+        self.products = dict()
+        self.dists = dict()
+        self.sources = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, name, feat):
+        """ register the feature set name, the cached entries of an old feat are dropped """
+        if name in self.feats:
+            old = self.feats[name]
+            if old is feat or (old.shape == feat.shape and np.array_equal(old, feat)):
+                return
+            self.normalized.pop(name, None)
+            self.squares = dict([(k, v) for k, v in self.squares.items() if k[0] != name])
+            self.products = dict([(k, v) for k, v in self.products.items() if name not in k])
+            self.dists = dict([(k, v) for k, v in self.dists.items() if name not in k[:2]])
+        self.feats[name] = feat
+        self.sources.pop(name, None)
+
+    def derive(self, name, source, func):
+        """
+        register the feature set name as func(features of source), computed once
+        and again only after source is replaced, such as the augmented gallery
+        Returns:
+            name
+        """
+        if name not in self.feats or self.sources[name] is not self.feats[source]:
+            self.add(name, func(self.feats[source]))
+            self.sources[name] = self.feats[source]
+        return name
+
+    def feat(self, name, normalized=False):
+        """ the features of name, L2 normalized along the rows if normalized """
+        if not normalized:
+            return as_float(self.feats[name])
+        if name not in self.normalized:
+            feat = as_float(self.feats[name])
+            norm = np.linalg.norm(feat, ord=2, axis=1, keepdims=True)
+            self.normalized[name] = feat / norm
+        return self.normalized[name]
+
+    def square(self, name, normalized=False):
+        """ the squared L2 norm of each row, float ndarray with shape [N] """
+        key = (name, normalized)
+        if key not in self.squares:
+            self.squares[key] = np.sum(np.square(self.feat(name, normalized)), axis=1)
+        return self.squares[key]
+
+    def product(self, array1, array2):
+        """ array1 * array2.T by the backend """
+        if self.backend == 'torch':
+            from .torch_backend import matmul_torch
+            return matmul_torch(array1, array2.T)
+        return np.matmul(array1, array2.T)
+
+    def inner_product(self, name1, name2, normalized=False):
+        """
+        raw inner-product matrix between name1 and name2, computed once for each
+        pair; the normalized one is derived from it by the norms of the rows
+        """
+        if (name1, name2) in self.products:
+            product = self.products[(name1, name2)]
+        elif (name2, name1) in self.products:
+            product = self.products[(name2, name1)].T
+        else:
+            product = self.product(self.feat(name1), self.feat(name2))
+            self.products[(name1, name2)] = product
+        if not normalized:
+            return product.copy()
+        norm1 = np.sqrt(self.square(name1))[:, np.newaxis]
+        norm2 = np.sqrt(self.square(name2))[np.newaxis, :]
+        return product / norm1 / norm2
+
+    def dist(self, name1, name2, dist_type='euclidean_normL2', verbose=False):
+        """
+        distance matrix between the feature sets name1 and name2, the same as
+        compute_dist(feat1, feat2, dist_type)
+        Returns:
+            ndarray with shape [N1, N2], shared with the cache, do not modify it
+        """
+        assert dist_type in ['cosine', 'euclidean', 'euclidean_normL2']
+        if (name1, name2, dist_type) in self.dists:
+            self.hits += 1
+            return self.dists[(name1, name2, dist_type)]
+        if (name2, name1, dist_type) in self.dists:
+            self.hits += 1
+            return self.dists[(name2, name1, dist_type)].T
+        self.misses += 1
+        normalized = dist_type in ['cosine', 'euclidean_normL2']
+        feat1 = self.feat(name1, normalized)
+        feat2 = self.feat(name2, normalized)
+        if verbose:
+            print('compute %s distance between %s [%d, %d] and %s [%d, %d]' \
+                %(dist_type, name1, feat1.shape[0], feat1.shape[1], name2, feat2.shape[0], feat2.shape[1]))
+        if self.shared_product:
+            dist = self.inner_product(name1, name2, normalized)
+        else:
+            dist = self.product(feat1, feat2)
+        if dist_type == 'cosine':
+            # we use negative cosine similarity as distance
+            dist = np.negative(dist, out=dist)
+        else:
+            dist = euclidean_from_product(dist, self.square(name1, normalized), self.square(name2, normalized))
+        self.dists[(name1, name2, dist_type)] = dist
+        return dist
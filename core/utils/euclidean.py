@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def euclidean_from_product(product, square1, square2):
+    """
+    the euclidean distance from the inner products and the squared norms,
+    computed in-place in product to avoid the full-size temporaries, shared by
+    compute_dist, compute_dist_blocks, DistanceCache and the torch backend
+    Args:
+        product: float ndarray with shape [m1, m2], overwritten
+        square1: ndarray with m1 elements, the squared norms of the rows of array1
+        square2: ndarray with m2 elements, the squared norms of the rows of array2
+    Returns:
+        product, sqrt(max(square1 - 2 * product + square2, 0))
+    """
+    product *= -2
+    product += np.reshape(square1, (-1, 1))
+    product += np.reshape(square2, (1, -1))
+    np.maximum(product, 0, out=product)
+    return np.sqrt(product, out=product)
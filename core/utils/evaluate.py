@@ -1,8 +1,19 @@
 import os
+import time
+import shutil
+import tempfile
 import torch
 from torch.autograd import Variable
 import numpy as np
 import copy
+from multiprocessing import Pool
+from .rerank import re_ranking_sparse
+from .feat_cache import FeatureCache
+from .dist_cache import DistanceCache
+from .feat_store import quantize_feat, as_float
+from .euclidean import euclidean_from_product
+from .projection import FeatureProjection
+from .torch_backend import set_threads, compute_dist_torch, argsort_torch, topk_torch
 
 
 # Testing
@@ -17,20 +28,166 @@ def reid_evaluate(feat_func, dataset, **kwargs):
                    "sq" single query, such as market, cuhk, duke, mars
                    "mq" mutiple query, such as market, mars
         video: whether the sequence-based or image-based re-identification
+        dist_type: the same as compute_dist, or a list of them, such as
+            ['cosine', 'euclidean', 'euclidean_normL2'], see evaluate_dist_types
+        eval_backend: 'numpy' (default) or 'torch', see get_backend
+        torch_threads: intra-op threads of the torch backend
+        feat_dtype: storage of the features, 'float32' (default), 'float64',
+            'float16' or 'int8', see get_feat_dtype
+        feat_dtype_delta: whether to report the mAP delta against float64,
+            default True for 'float16' and 'int8'
+        feat_projection: a FeatureProjection or the file of it, the features are
+            projected before the distance and the re-ranking, see get_projection
+        projection_dim: if given, only the first projection_dim components are used
     Return:
         result: a dictionary that record the results of different eval_types
         result['ss']['mAP']
         result['ss']['CMC'], CMC is a 1*G array
     """
+    if get_backend(**kwargs) == 'torch' and 'torch_threads' in kwargs:
+        set_threads(kwargs['torch_threads'])
     if 'eval_video' in kwargs and kwargs['eval_video']:
         return reid_evaluate_sequence(feat_func, dataset, **kwargs)
     else:
         return reid_evaluate_image(feat_func, dataset, **kwargs)
 
+def reid_evaluate_projection_sweep(feat_func, dataset, dims, **kwargs):
+    """
+    evaluate the full features and each output dimension of the projection
+    kwargs['feat_projection'], reuse the features by feat_cache_dir
+    Input:
+        dims: the output dimensions, such as [128, 256, 512]
+    Return:
+        sweep: a list of (dim, result, seconds), dim is None for the full features
+    """
+    sweep = []
+    for dim in [None] + list(dims):
+        if dim is None:
+            eval_kwargs = dict(kwargs, feat_projection=None)
+        else:
+            eval_kwargs = dict(kwargs, projection_dim=dim)
+        t0 = time.time()
+        result = reid_evaluate(feat_func, dataset, **eval_kwargs)
+        sweep.append((dim, result, time.time() - t0))
+    print('-' * 60)
+    print('dim     ' + ''.join(['%-10s' % (key + ' mAP') for key in sorted(sweep[0][1].keys())]) + 'time')
+    for dim, result, seconds in sweep:
+        print('%-8s' % ('full' if dim is None else dim) + ''.join(['%-10.4f' % (result[key]['mAP']) \
+            for key in sorted(result.keys())]) + '%.2fs' % (seconds))
+    print('-' * 60)
+    return sweep
+
+def get_backend(**kwargs):
+    """
+    the backend of the distance, the ranking and the re-ranking:
+    'numpy' (default) is the float64 reference, 'torch' runs them as float32
+    torch cpu tensor operations with intra-op threading
+    """
+    if 'eval_backend' in kwargs and kwargs['eval_backend'] == 'torch':
+        return 'torch'
+    return 'numpy'
+
+def get_feat_dtype(**kwargs):
+    """
+    the storage dtype of the extracted features, 'float32' by default; the
+    'float16' and 'int8' (scaled per dimension) features are compact, and the
+    distances are computed from them in float32
+    """
+    if 'feat_dtype' in kwargs:
+        return kwargs['feat_dtype']
+    return 'float32'
+
+def get_feat_dtype_delta(**kwargs):
+    """
+    whether to also evaluate the float64 reference of the features and report
+    the mAP delta, by default for the 'float16' and 'int8' storage
+    """
+    feat_dtype = get_feat_dtype(**kwargs)
+    if 'feat_dtype_delta' in kwargs:
+        feat_dtype_delta = kwargs['feat_dtype_delta']
+    else:
+        feat_dtype_delta = feat_dtype in ['float16', 'int8']
+    return feat_dtype_delta and feat_dtype != 'float64'
+
+def report_feat_dtype_delta(result, reference, feat_dtype):
+    """ add the mAP delta against the float64 reference to each eval type of result """
+    for key in sorted(result.keys()):
+        if key not in reference:
+            continue
+        result[key]['mAP_delta'] = result[key]['mAP'] - reference[key]['mAP']
+        print('%s features, %s: mAP %.4f, float64 mAP %.4f, delta %+.4f.' \
+            % (feat_dtype, key, result[key]['mAP'], reference[key]['mAP'], result[key]['mAP_delta']))
+
+def get_projection(**kwargs):
+    """ the FeatureProjection of the evaluation, None if the features are not projected """
+    if 'feat_projection' not in kwargs or kwargs['feat_projection'] is None:
+        return None
+    projection = kwargs['feat_projection']
+    if not isinstance(projection, FeatureProjection):
+        projection = FeatureProjection.load(projection)
+    if 'projection_dim' in kwargs and kwargs['projection_dim']:
+        projection = projection.truncate(kwargs['projection_dim'])
+    return projection
+
+def get_dist_cache(**kwargs):
+    """
+    the DistanceCache of an evaluation, pass dist_cache in kwargs to share
+    the cached distances across several evaluations
+    """
+    if 'dist_cache' in kwargs and kwargs['dist_cache'] is not None:
+        return kwargs['dist_cache']
+    return DistanceCache(backend=get_backend(**kwargs))
+
+def evaluate_dist_types(eval_func, *args, **kwargs):
+    """
+    run eval_func once for each dist_type of the list kwargs['dist_type'].
+    The metrics share one DistanceCache with shared_product, so each pair of
+    feature sets needs a single matrix multiplication for all of them, and
+    the random single-shot trials are the same for every metric.
+    Return:
+        result: a flat dictionary, such as result['sq_cosine']['mAP']
+    """
+    cache = get_dist_cache(**kwargs)
+    cache.shared_product = True
+    state = np.random.get_state()
+    result = dict()
+    for dist_type in kwargs['dist_type']:
+        kwargs['dist_type'] = dist_type
+        kwargs['dist_cache'] = cache
+        np.random.set_state(state)
+        res = eval_func(*args, **kwargs)
+        for key in res.keys():
+            result['%s_%s' % (key, dist_type)] = res[key]
+    return result
+
+def get_feat_cache(**kwargs):
+    """ the FeatureCache of feat_cache_dir and feat_cache_size, None if not given """
+    if 'feat_cache_dir' in kwargs and kwargs['feat_cache_dir']:
+        if 'feat_cache_size' in kwargs:
+            return FeatureCache(kwargs['feat_cache_dir'], kwargs['feat_cache_size'])
+        return FeatureCache(kwargs['feat_cache_dir'])
+    return None
+
 def extract_feat(feat_func, dataset, **kwargs):
     """
     extract feature for images
+    feat_cache_dir: if given, reuse the features cached by FeatureCache
+    feat_cache_size: maximal bytes of the feature cache
     """
+    cache = get_feat_cache(**kwargs)
+    key = None if cache is None else cache.key(feat_func, dataset)
+    if key is None:
+        # no cache, or feat_func does not expose the model to key the cache by
+        cache = None
+    else:
+        entry = cache.load(key)
+        if entry is not None:
+            print('Load cached features %s.' % (key))
+            feat, meta = entry
+            if 'feat_only' in kwargs and kwargs['feat_only']:
+                return feat
+            return feat, meta['pid'], meta['cam'], meta['seq'], meta['frame'], meta['record']
+
     test_loader = torch.utils.data.DataLoader(
         dataset = dataset, batch_size = 32,
         num_workers = 2, pin_memory = True)
@@ -42,28 +199,112 @@ def extract_feat(feat_func, dataset, **kwargs):
             imgs_var = Variable(imgs).cuda()
             feat_tmp = feat_func( imgs_var )
         batch_size = feat_tmp.shape[0]
-        if ep == 0:
-            feat = np.zeros((N, int(feat_tmp.size/batch_size)))
+        if ep == 0 and cache is not None:
+            # write the batches into the cache, the features may not fit in memory
+            feat = cache.create(key, (N, int(feat_tmp.size/batch_size)))
+        elif ep == 0:
+            # float32 as the model output, see get_feat_dtype for the storage
+            feat = np.zeros((N, int(feat_tmp.size/batch_size)), dtype=np.float32)
         feat[start:start+batch_size, :] = feat_tmp.reshape((batch_size, -1))
         start += batch_size
     
-    if 'feat_only' in kwargs and kwargs['feat_only']:
-        return feat
-    
     pid = copy.deepcopy( dataset.pid )
     cam = copy.deepcopy( dataset.cam )
     seq = copy.deepcopy( dataset.seq )
     frame = copy.deepcopy( dataset.frame )
     record = copy.deepcopy( dataset.record )
+    if cache is not None:
+        meta = dict(pid=pid, cam=cam, seq=seq, frame=frame, record=record)
+        cache.commit(key, feat, meta)
+        del feat
+        # use the cached float32 copy, the same as the later cache hits
+        feat, meta = cache.load(key)
+
+    if 'feat_only' in kwargs and kwargs['feat_only']:
+        return feat
     return feat, pid, cam, seq, frame, record
 
+def fit_projection(feat_func, dataset, dim=256, whiten=False):
+    """
+    fit a FeatureProjection on the features of dataset, such as the train
+    split, batch by batch without keeping the features
+    """
+    test_loader = torch.utils.data.DataLoader(
+        dataset = dataset, batch_size = 32,
+        num_workers = 2, pin_memory = True)
+    projection = FeatureProjection(dim, whiten)
+    print('Fitting the projection on %d images.' % (len(dataset.image)))
+    for ep, imgs in enumerate(test_loader):
+        with torch.no_grad():
+            imgs_var = Variable(imgs).cuda()
+            feat_tmp = feat_func( imgs_var )
+        projection.partial_fit(feat_tmp.reshape((feat_tmp.shape[0], -1)))
+    projection.finalize()
+    print('The projection to %d dimensions keeps %.2f%% of the variance.' \
+        % (projection.dim, 100. * projection.explained_variance()))
+    return projection
+
+def load_or_fit_projection(projection_file, feat_func, dataset, dim=256, whiten=False):
+    """
+    the projection saved in projection_file, such as next to the checkpoint,
+    fitted by fit_projection and saved if it is missing or does not match
+    """
+    if os.path.exists(projection_file):
+        projection = FeatureProjection.load(projection_file)
+        if projection.whiten == whiten and projection.dim >= dim:
+            print('Load the projection %s.' % (projection_file))
+            return projection.truncate(dim)
+    projection = fit_projection(feat_func, dataset, dim, whiten)
+    projection.save(projection_file)
+    return projection
+
+def extract_feat_fixed(feat_func, dataset, splits, **kwargs):
+    """
+    extract features for several fixed image lists in a single pass,
+    the images shared by the lists are only forwarded once
+    Input:
+        splits: the fixed lists, such as ['q', 'g', 'gt']
+    Return:
+        result: a dict, result[split] = (feat, pid, cam, seq, frame, record)
+    """
+    index = dataset.create_image_list_by_fixed_union(splits)
+    N = sum([len(index[split]) for split in splits])
+    print('extract %d unique images out of %d.' % (len(dataset.image), N))
+    kwargs['feat_only'] = True
+    feat = extract_feat(feat_func, dataset, **kwargs)
+    result = dict()
+    for split in splits:
+        result[split] = (feat[np.array(index[split], dtype=np.int64), :], \
+            copy.deepcopy( dataset.dataset['pid_' + split] ), \
+            copy.deepcopy( dataset.dataset['cam_' + split] ), \
+            copy.deepcopy( dataset.dataset['seq_' + split] ), \
+            copy.deepcopy( dataset.dataset['frame_' + split] ), \
+            copy.deepcopy( dataset.dataset['record_' + split] ))
+    return result
+
+def extract_feat_distractor(feat_func, dataset, **kwargs):
+    """
+    features of the distractors registered by dataset.add_distractors, a
+    read-only memmap of the precomputed feature file, or extracted once into
+    the feature cache and memory-mapped from it
+    """
+    if 'feat_file_d' in dataset.dataset:
+        return np.load(dataset.dataset['feat_file_d'], mmap_mode='r')
+    if 'feat_cache_dir' not in kwargs or not kwargs['feat_cache_dir']:
+        print('The distractor images need feat_cache_dir to store the features.')
+        raise ValueError
+    dataset.create_image_list_by_fixed_distractor()
+    print('Extracting features for %d distractors.' % (len(dataset.image)))
+    kwargs['feat_only'] = True
+    return extract_feat(feat_func, dataset, **kwargs)
+
 def normalize(nparray, order=2, axis=0):
     """ Normalize a N-D numpy array along the specified axis. """
     norm = np.linalg.norm(nparray, ord=order, axis=axis, keepdims=True)
     return nparray/norm
     # return nparray/(norm + np.finfo(np.float32).eps)
 
-def compute_dist(array1, array2, dist_type='euclidean_normL2', A=None, verbose=False):
+def compute_dist(array1, array2, dist_type='euclidean_normL2', A=None, verbose=False, backend='numpy'):
     """Compute the manhattan, euclidean, cosine distance of all pairs
     Args:
         array1: numpy array with shape [m1, D]
@@ -71,9 +312,15 @@ def compute_dist(array1, array2, dist_type='euclidean_normL2', A=None, verbose=F
         A: mapping matrix with shape [D, d]
         type: one of ['cosine', 'euclidean', 'mahalanobis']
         Mah: (x_i - x_j) * M * (x_i - x_j).T
+        backend: 'numpy' or 'torch', see get_backend
     Returns:
         numpy array with shape [m1, m2]
     """
+    # the compact storage is computed in float32, float64 is kept for the reference
+    array1 = as_float(array1)
+    array2 = as_float(array2)
+    if backend == 'torch':
+        return compute_dist_torch(array1, array2, dist_type=dist_type, A=A, verbose=verbose)
     assert dist_type in ['cosine', 'euclidean', 'mahalanobis', 'euclidean_normL2']
     assert len(array1.shape) == 2 and len(array2.shape) == 2
     assert array1.shape[1] == array2.shape[1]
@@ -96,10 +343,7 @@ def compute_dist(array1, array2, dist_type='euclidean_normL2', A=None, verbose=F
         square1 = np.sum(np.square(array1), axis=1)[..., np.newaxis]
         # shape [1, m2]
         square2 = np.sum(np.square(array2), axis=1)[np.newaxis, ...]
-        squared_dist = -2 * np.matmul(array1, array2.T) + square1 + square2
-        squared_dist[squared_dist < 0] = 0
-        dist = np.sqrt(squared_dist)
-        return dist
+        return euclidean_from_product(np.matmul(array1, array2.T), square1, square2)
     # for euclidean_normL2 distance
     if dist_type == 'euclidean_normL2':
         norm_array1 = normalize(array1, order=2, axis=1)
@@ -108,10 +352,7 @@ def compute_dist(array1, array2, dist_type='euclidean_normL2', A=None, verbose=F
         square1 = np.sum(np.square(norm_array1), axis=1)[..., np.newaxis]
         # shape [1, m2]
         square2 = np.sum(np.square(norm_array2), axis=1)[np.newaxis, ...]
-        squared_dist = -2 * np.matmul(norm_array1, norm_array2.T) + square1 + square2
-        squared_dist[squared_dist < 0] = 0
-        dist = np.sqrt(squared_dist)
-        return dist
+        return euclidean_from_product(np.matmul(norm_array1, norm_array2.T), square1, square2)
     # for manhattan distance
     if dist_type == 'mahalanobis':
         assert A is not None
@@ -124,6 +365,57 @@ def compute_dist(array1, array2, dist_type='euclidean_normL2', A=None, verbose=F
         dist = np.sqrt(squared_dist)
         return dist
 
+def compute_dist_blocks(array1, array2, dist_type='euclidean_normL2', A=None, \
+    max_memory=2**28, block_size=None, verbose=False):
+    """Compute the distance matrix of compute_dist block by block along the rows of array1
+    Args:
+        array1, array2, dist_type, A: the same as compute_dist
+        max_memory: bytes of a float32 distance block, default 256MB
+        block_size: number of rows in each block, overrides max_memory
+    Yields:
+        (start, end, dist), dist is a float32 array with shape [end-start, m2]
+    Note:
+        array2 is normalized once and shared by all the blocks; each block is
+        computed in-place, so the peak memory is about one block.
+        For mahalanobis, A is assumed to be symmetric.
+    """
+    assert dist_type in ['cosine', 'euclidean', 'mahalanobis', 'euclidean_normL2']
+    assert len(array1.shape) == 2 and len(array2.shape) == 2
+    assert array1.shape[1] == array2.shape[1]
+    M1 = array1.shape[0]
+    M2 = array2.shape[0]
+    if block_size is None:
+        block_size = max(1, int(max_memory // (4 * M2)))
+    if verbose:
+        print('compute %s distance between matrix [%d, %d] and [%d, %d], %d rows per block' \
+            %(dist_type, M1, array1.shape[1], M2, array2.shape[1], block_size))
+    array2 = np.asarray(array2, dtype=np.float32)
+    if dist_type in ['cosine', 'euclidean_normL2']:
+        array2 = normalize(array2, order=2, axis=1)
+    if dist_type == 'mahalanobis':
+        assert A is not None
+        A = np.asarray(A, dtype=np.float32)
+        tmp = np.matmul(array2, A)
+        square2 = np.sum(tmp * array2, axis=1)[np.newaxis, ...]
+        array2 = tmp
+    else:
+        square2 = np.sum(np.square(array2), axis=1)[np.newaxis, ...]
+    for start in range(0, M1, block_size):
+        end = min(start + block_size, M1)
+        block = np.asarray(array1[start:end], dtype=np.float32)
+        if dist_type in ['cosine', 'euclidean_normL2']:
+            block = normalize(block, order=2, axis=1)
+        dist = np.matmul(block, array2.T)
+        if dist_type == 'cosine':
+            # we use negative cosine similarity as distance
+            yield start, end, np.negative(dist, out=dist)
+            continue
+        if dist_type == 'mahalanobis':
+            square1 = np.sum(np.matmul(block, A) * block, axis=1)[..., np.newaxis]
+        else:
+            square1 = np.sum(np.square(block), axis=1)[..., np.newaxis]
+        yield start, end, euclidean_from_product(dist, square1, square2)
+
 def feature_pooling(feat, **kwargs):
     """ pool the feature into a single vector
     Input:
@@ -147,24 +439,583 @@ def feature_pooling(feat, **kwargs):
         print('The pooling operation should be in %s'%('average, max'))
         raise ValueError
 
-def compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False):
+def composite_key(columns, bases=None):
+    """
+    encode several integer columns, such as (pid, cam, seq), into one int64 key
+    Input:
+        columns: a list of int ndarray with the same length
+        bases: a list of (low, size) for each column, computed from columns if None,
+               pass the same bases to encode another set of columns consistently
+    Output:
+        key: int64 ndarray
+        bases
+    """
+    columns = [np.asarray(col, dtype=np.int64) for col in columns]
+    if bases is None:
+        bases = [(int(col.min()), int(col.max() - col.min()) + 1) for col in columns]
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for col, (low, size) in zip(columns, bases):
+        key = key * size + (col - low)
+    return key, bases
+
+def group_order(columns):
+    """
+    sort the items into groups of equal (pid, cam, ...) without python dicts,
+    the groups are ordered like the nested dicts, i.e. by the first appearance
+    of pid, then of cam within the pid, and so on.
+    Input:
+        columns: a list of int ndarray with the same length
+    Output:
+        order: item indices sorted by group, ascending within a group
+        starts: int ndarray, the start of each group in order
+    """
+    N = len(columns[0])
+    first = []
+    for l in range(1, len(columns)+1):
+        key, _ = composite_key(columns[:l])
+        _, index, inverse = np.unique(key, return_index=True, return_inverse=True)
+        first.append(index[inverse.ravel()])
+    order = np.lexsort([np.arange(N)] + first[::-1])
+    starts = np.nonzero(np.diff(first[-1][order]))[0] + 1
+    starts = np.concatenate([[0], starts]).astype(np.int64)
+    return order, starts
+
+def feature_pooling_groups(feat, order, starts, **kwargs):
+    """ pool the feature of each group, the same as feature_pooling on each group
+    Input:
+        feat: N*D
+        order, starts: the groups, see group_order
+    Output:
+        feat: G*D, G = len(starts)
+    """
+    if 'feat_pool_type' in kwargs:
+        operation = kwargs['feat_pool_type']
+    else:
+        operation = 'average'
+    feat = as_float(feat[order, :])
+    if operation == 'average':
+        count = np.diff(np.append(starts, len(order))).astype(feat.dtype)
+        return np.add.reduceat(feat, starts, axis=0) / count[:, np.newaxis]
+    elif operation == 'max':
+        return np.maximum.reduceat(feat, starts, axis=0)
+    else:
+        print('The pooling operation should be in %s'%('average, max'))
+        raise ValueError
+
+def feature_pooling_by_keys(feat, columns, query_columns, **kwargs):
+    """ pool the feature of the items sharing each query key, such as the
+        multi-query pooling of the groundtruth by (pid, cam)
+    Input:
+        feat: N*D
+        columns: a list of int ndarray with length N, such as [gt_pid, gt_cam]
+        query_columns: a list of int ndarray with length Q, such as [query_pid, query_cam]
+    Output:
+        feat: Q*D, nan for the queries without any item
+    """
+    order, starts = group_order(columns)
+    pooled = feature_pooling_groups(feat, order, starts, **kwargs)
+    _, bases = composite_key([np.concatenate([np.asarray(c), np.asarray(q)]) \
+        for c, q in zip(columns, query_columns)])
+    key, _ = composite_key([np.asarray(c)[order[starts]] for c in columns], bases)
+    query_key, _ = composite_key(query_columns, bases)
+    # join the queries with the groups by binary search on the sorted keys
+    sort = np.argsort(key)
+    pos = np.minimum(np.searchsorted(key[sort], query_key), len(key) - 1)
+    found = key[sort][pos] == query_key
+    query_feat = np.zeros((len(query_key), feat.shape[1]), dtype=pooled.dtype) + np.nan
+    query_feat[found, :] = pooled[sort[pos[found]], :]
+    return query_feat
+
+def compute_dist_pruned_blocks(constraint, query_feat, query_cam, query_frame, gallery_feat, \
+    dist_type='euclidean_normL2', backend='numpy', max_memory=2**28):
+    """
+    Compute the distance only between each query and its feasible gallery
+    items under a SpatioTemporalConstraint fitted on the gallery, block by
+    block along the query rows as compute_dist_blocks.
+    Input:
+        constraint: a fitted SpatioTemporalConstraint
+        query_cam, query_frame: ndarray with Q elements
+        query_feat, gallery_feat, dist_type, backend: the same as compute_dist
+        max_memory: bytes of a float32 distance block, default 256MB
+    Yields:
+        (start, end, dist), dist is a float32 array with shape [end-start, G],
+        inf for the pruned pairs
+    """
+    Q = query_feat.shape[0]
+    G = gallery_feat.shape[0]
+    query_cam = np.asarray(query_cam).reshape(-1)
+    query_frame = np.asarray(query_frame).reshape(-1)
+    block_size = max(1, int(max_memory // (4 * G)))
+    for start in range(0, Q, block_size):
+        end = min(start + block_size, Q)
+        dist_mat = np.zeros((end - start, G), dtype=np.float32) + np.inf
+        # the candidate sets are cached in constraint, the blocks only regroup the queries
+        for query_idx, cand_idx, mask in constraint.groups(query_cam[start:end], query_frame[start:end]):
+            if len(cand_idx) == 0:
+                continue
+            dist = compute_dist(query_feat[start + query_idx, :], gallery_feat[cand_idx, :], \
+                dist_type=dist_type, backend=backend)
+            dist[~mask] = np.inf
+            dist_mat[np.ix_(query_idx, cand_idx)] = dist
+        yield start, end, dist_mat
+    print('spatio-temporal pruning: %.2f%% of the distances are skipped, %.2f%% pairs are feasible.' \
+        % (100. * constraint.prune_ratio(), \
+        100. * constraint.feasible_pairs / float(max(constraint.total_pairs, 1))))
+
+def compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False, **kwargs):
     """
     Input:
         dist_mat, distance matrix with shape [M, N]
-        query_pid, ndarray with shape [1, N]
-        gallery_pid, ndarray with shape [1, M] 
+        query_pid, ndarray with shape [1, M]
+        gallery_pid, ndarray with shape [1, N] 
         # pid = -1 are distractors
+        score_block_size: number of queries scored together, default 128
+        score_workers: number of processes scoring the query shards, default 1
     Return:
         mAP, CMC
     """
-    index = np.argsort(dist_mat, axis=1) # with shape [M,N]
-    cmcs = np.zeros(dist_mat.shape)
-    aps = np.zeros(dist_mat.shape[0])
-    for i in range(dist_mat.shape[0]):
-        # calc ap and cmc
-        aps[i], cmcs[i, :] = compute_ap_cmc(query_pid[0, i], query_cam[0, i], \
-            gallery_pid[:, index[i, :]], gallery_cam[:, index[i, :]], seperate_cam)
-    return np.mean(aps), np.mean(cmcs, axis=0, keepdims=True)
+    if 'score_workers' in kwargs and kwargs['score_workers'] > 1:
+        aps, first_hit = compute_score_parallel(dist_mat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, seperate_cam, **kwargs)
+    else:
+        aps, first_hit = compute_score_query(dist_mat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, seperate_cam, **kwargs)
+    return np.mean(aps), compute_cmc(first_hit, dist_mat.shape[1])
+
+def compute_score_blocks(dist_blocks, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False, **kwargs):
+    """
+    Input:
+        dist_blocks, iterable of (start, end, dist) over the query rows,
+            such as the generator of compute_dist_blocks
+        the rest are the same as compute_score
+    Return:
+        mAP, CMC
+    """
+    M = query_pid.shape[1]
+    N = gallery_pid.shape[1]
+    aps = np.zeros(M)
+    first_hit = np.zeros(M, dtype=np.int64)
+    for start, end, dist in dist_blocks:
+        aps[start:end], first_hit[start:end] = compute_score_query(dist, \
+            query_pid[:, start:end], query_cam[:, start:end], gallery_pid, gallery_cam, \
+            seperate_cam, **kwargs)
+    return np.mean(aps), compute_cmc(first_hit, N)
+
+# the shared arrays of compute_score_parallel, attached once in each worker
+_score_shared = dict()
+
+def _to_shared(array):
+    """ copy array into a new shared memory block, return the block and its view """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    return shm, view
+
+def _score_worker_init(specs, seperate_cam, kwargs):
+    from multiprocessing import shared_memory
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _score_shared[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _score_shared['seperate_cam'] = seperate_cam
+    _score_shared['kwargs'] = kwargs
+
+def _score_worker_shard(shard):
+    start, end = shard
+    arrays = dict([(name, _score_shared[name][1]) for name in \
+        ['dist_mat', 'query_pid', 'query_cam', 'gallery_pid', 'gallery_cam']])
+    return compute_score_query(arrays['dist_mat'][start:end, :], \
+        arrays['query_pid'][:, start:end], arrays['query_cam'][:, start:end], \
+        arrays['gallery_pid'], arrays['gallery_cam'], \
+        _score_shared['seperate_cam'], **_score_shared['kwargs'])
+
+def compute_score_parallel(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False, **kwargs):
+    """
+    compute_score_query on query shards in a process pool. The distance rows and
+    the labels are put in shared memory once, the workers only receive the
+    (start, end) of their shards, and the shards are merged back in query order.
+    Input:
+        the same as compute_score
+        score_workers: number of processes
+        score_shards: number of query shards, default 4 * score_workers
+    Return:
+        aps, first_hit, the same as compute_score_query
+    """
+    try:
+        # multiprocessing.shared_memory needs python >= 3.8
+        from multiprocessing import shared_memory
+    except ImportError:
+        print('Warning: multiprocessing.shared_memory is not available, score the queries serially.')
+        kwargs = dict([(k, v) for k, v in kwargs.items() if k not in ['score_workers', 'score_shards']])
+        return compute_score_query(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, \
+            seperate_cam, **kwargs)
+    workers = kwargs['score_workers']
+    if 'score_shards' in kwargs:
+        num_shards = kwargs['score_shards']
+    else:
+        num_shards = 4 * workers
+    M = dist_mat.shape[0]
+    bounds = np.linspace(0, M, min(num_shards, max(M, 1)) + 1).astype(np.int64)
+    shards = [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+    if len(shards) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    # the forked workers score with numpy, torch threads do not survive a fork
+    kwargs = dict([(k, v) for k, v in kwargs.items() if k not in \
+        ['score_workers', 'score_shards', 'eval_backend', 'dist_cache', 'st_constraint']])
+    arrays = {'dist_mat': dist_mat, 'query_pid': query_pid, 'query_cam': query_cam, \
+        'gallery_pid': gallery_pid, 'gallery_cam': gallery_cam}
+    blocks = []
+    try:
+        specs = dict()
+        for name, array in arrays.items():
+            shm, view = _to_shared(np.ascontiguousarray(array))
+            blocks.append(shm)
+            specs[name] = (shm.name, view.shape, view.dtype)
+            del view
+        pool = Pool(processes=min(workers, len(shards)), initializer=_score_worker_init, \
+            initargs=(specs, seperate_cam, kwargs))
+        try:
+            results = pool.map(_score_worker_shard, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    aps = np.concatenate([r[0] for r in results])
+    first_hit = np.concatenate([r[1] for r in results])
+    return aps, first_hit
+
+def compute_dist_score(query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, cache=None, names=None, **kwargs):
+    """
+    Compute the distance and the score, optionally in streaming mode.
+    Input:
+        query_feat, gallery_feat: the features
+        the rest are the same as compute_score
+        cache, names: if given, take the distance from the DistanceCache
+            cache between the feature sets names[0] and names[1]
+        dist_type: the same as compute_dist, default euclidean_normL2
+        stream_eval: if True, walk the query rows block by block and discard
+            each distance block once it is scored, so the full [M, N] distance
+            matrix is never built, default False
+        stream_memory: bytes of a float32 distance block in streaming mode, default 256MB
+        gallery_shards: if > 1, split the gallery into memory-mapped shards and
+            score them in worker processes, see ShardedGallery, default 1
+        shard_dir: the shards are written in a new directory inside shard_dir,
+            which is removed after the scoring, a temporary one by default
+        shard_workers: number of processes of the shards, default gallery_shards
+    Return:
+        mAP, CMC
+        dist_mat, the [M, N] distance matrix, None in streaming or sharded mode
+    """
+    if 'dist_type' in kwargs:
+        dist_type = kwargs['dist_type']
+    else:
+        dist_type = 'euclidean_normL2'
+    if 'gallery_shards' in kwargs and kwargs['gallery_shards'] > 1:
+        from .gallery_shard import ShardedGallery
+        num_shards = kwargs['gallery_shards']
+        if 'shard_workers' in kwargs:
+            workers = kwargs['shard_workers']
+        else:
+            workers = num_shards
+        tmp_dir = None
+        if 'shard_dir' in kwargs and kwargs['shard_dir']:
+            shard_dir = kwargs['shard_dir']
+        else:
+            tmp_dir = tempfile.mkdtemp()
+            shard_dir = tmp_dir
+        print('score %d queries against %d gallery shards.' % (query_feat.shape[0], num_shards))
+        try:
+            gallery = ShardedGallery.build(shard_dir, gallery_feat, gallery_pid, gallery_cam, num_shards)
+            try:
+                aps, first_hit = gallery.score(query_feat, query_pid, query_cam, seperate_cam, \
+                    dist_type=dist_type, workers=workers)
+            finally:
+                gallery.remove()
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return np.mean(aps), compute_cmc(first_hit, gallery_pid.shape[1]), None
+    if 'stream_eval' in kwargs and kwargs['stream_eval']:
+        if 'stream_memory' in kwargs:
+            max_memory = kwargs['stream_memory']
+        else:
+            max_memory = 2**28
+        dist_blocks = compute_dist_blocks(query_feat, gallery_feat, dist_type=dist_type, \
+            max_memory=max_memory, verbose=True)
+        mAP, CMC = compute_score_blocks(dist_blocks, query_pid, query_cam, \
+            gallery_pid, gallery_cam, seperate_cam, **kwargs)
+        return mAP, CMC, None
+    if cache is not None:
+        dist_mat = cache.dist(names[0], names[1], dist_type, verbose=True)
+    else:
+        dist_mat = compute_dist(query_feat, gallery_feat, dist_type=dist_type, verbose=True, \
+            backend=get_backend(**kwargs))
+    mAP, CMC = compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, \
+        seperate_cam, **kwargs)
+    return mAP, CMC, dist_mat
+
+def compute_score_query(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False, **kwargs):
+    """
+    Sort and score blocks of queries at once instead of one query at a time.
+    Input:
+        the same as compute_score
+        score_type: 'sort' (default) or 'count', see compute_score_count_query
+    Return:
+        aps, ndarray with shape [M]
+        first_hit, int ndarray with shape [M], the rank of the first true match
+            among the valid gallery items, N if there is no true match
+    """
+    if 'score_type' in kwargs and kwargs['score_type'] == 'count':
+        return compute_score_count_query(dist_mat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, seperate_cam, **kwargs)
+    if 'score_block_size' in kwargs:
+        block_size = kwargs['score_block_size']
+    else:
+        block_size = 128
+    M, N = dist_mat.shape
+    aps = np.zeros(M)
+    first_hit = np.zeros(M, dtype=np.int64)
+    for start in range(0, M, block_size):
+        end = min(start + block_size, M)
+        if get_backend(**kwargs) == 'torch':
+            index = argsort_torch(dist_mat[start:end, :])
+        else:
+            # stable, the ties are broken by gallery index as in compute_score_count_query
+            index = np.argsort(dist_mat[start:end, :], axis=1, kind='stable')
+        aps[start:end], first_hit[start:end] = compute_ap_cmc_batch(
+            query_pid[0, start:end], query_cam[0, start:end], \
+            gallery_pid[0, index], gallery_cam[0, index], seperate_cam)
+    return aps, first_hit
+
+def compute_score_count_query(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, topk=None, **kwargs):
+    """
+    Sort-free scoring: the rank of each true match is the number of valid
+    gallery items with a smaller distance, ties are broken by gallery index.
+    Nothing is sorted over the gallery, each true match is compared once with
+    each valid item, O(N * ngood) for a query with ngood true matches.
+    Input:
+        the same as compute_score
+        topk: if given, also return the top-k ranked gallery indices
+    Return:
+        aps, first_hit, the same as compute_score_query
+        index, int ndarray with shape [M, topk], only if topk is given
+    """
+    if 'score_block_size' in kwargs:
+        block_size = kwargs['score_block_size']
+    else:
+        block_size = 128
+    M, N = dist_mat.shape
+    aps = np.zeros(M)
+    first_hit = np.zeros(M, dtype=np.int64)
+    if topk is not None:
+        topk = min(topk, N)
+        index = np.zeros((M, topk), dtype=np.int64)
+    for start in range(0, M, block_size):
+        end = min(start + block_size, M)
+        dist = dist_mat[start:end, :]
+        aps[start:end], first_hit[start:end] = compute_ap_cmc_count(dist, \
+            query_pid[0, start:end], query_cam[0, start:end], \
+            gallery_pid[0, :], gallery_cam[0, :], seperate_cam)
+        if topk is not None:
+            if get_backend(**kwargs) == 'torch':
+                index[start:end, :] = topk_torch(dist, topk)
+                continue
+            idx = np.argpartition(dist, topk-1, axis=1)[:, :topk]
+            order = np.lexsort((idx, np.take_along_axis(dist, idx, axis=1)))
+            index[start:end, :] = np.take_along_axis(idx, order, axis=1)
+    if topk is None:
+        return aps, first_hit
+    return aps, first_hit, index
+
+def compute_ap_cmc_count(dist, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False):
+    """
+    Input:
+        dist, distance matrix with shape [B, N]
+        query_pid, query_cam, ndarray with shape [B]
+        gallery_pid, gallery_cam, ndarray with shape [N], not sorted
+    Output:
+        aps, ndarray with shape [B]
+        first_hit, int ndarray with shape [B]
+    """
+    rows, cols, ranks, ngood = compute_good_ranks(dist, query_pid, query_cam, \
+        gallery_pid, gallery_cam, seperate_cam)
+    return compute_ap_from_ranks(rows, ranks, ngood, dist.shape[1])
+
+def compute_good_ranks(dist, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam=False):
+    """
+    the rank of each true match among the valid gallery items, by counting
+    Input:
+        the same as compute_ap_cmc_count
+    Output:
+        rows, cols: int ndarray with shape [K], the query and the gallery item
+            of each true match, sorted by rank within each query
+        ranks: int ndarray with shape [K]
+        ngood: int ndarray with shape [B], the number of true matches of each query
+    """
+    query_pid = np.asarray(query_pid).reshape((-1, 1))
+    query_cam = np.asarray(query_cam).reshape((-1, 1))
+    assert np.all(query_pid != -1)
+    B = dist.shape[0]
+    same_pid = gallery_pid[np.newaxis, :] == query_pid
+    same_cam = gallery_cam[np.newaxis, :] == query_cam
+    good = same_pid & ~same_cam
+    if seperate_cam:
+        junk = same_cam
+    else:
+        junk = same_pid & same_cam
+    junk |= gallery_pid[np.newaxis, :] == -1
+    rows, cols = np.nonzero(good)
+    ngood = np.bincount(rows, minlength=B)
+    ranks = np.zeros(len(rows), dtype=np.int64)
+    # the valid items which are not true matches
+    negative = ~(junk | good)
+    first = np.cumsum(ngood) - ngood
+    for i in range(B):
+        if ngood[i] == 0:
+            continue
+        pos = cols[first[i]:first[i]+ngood[i]]
+        # sort the few true matches by (distance, gallery index)
+        order = np.lexsort((pos, dist[i, pos]))
+        pos = pos[order]
+        cols[first[i]:first[i]+ngood[i]] = pos
+        dist_pos = dist[i, pos][:, np.newaxis]
+        neg = np.nonzero(negative[i, :])[0]
+        dist_neg = dist[i, neg][np.newaxis, :]
+        # number of negative items ranked before each true match, by one
+        # comparison with each negative, O(N * ngood) without any sort
+        before = np.count_nonzero((dist_neg < dist_pos) | \
+            ((dist_neg == dist_pos) & (neg[np.newaxis, :] < pos[:, np.newaxis])), axis=1)
+        ranks[first[i]:first[i]+ngood[i]] = before + np.arange(ngood[i])
+    return rows, cols, ranks, ngood
+
+def compute_score_distractors(query_feat, gallery_feat, distractor_feat, query_pid, query_cam, \
+    gallery_pid, gallery_cam, counts, seperate_cam=False, dist_type='euclidean_normL2', \
+    max_memory=2**28, backend='numpy'):
+    """
+    Score the queries against the gallery extended by the first n distractors,
+    for each n of counts in one pass over the distractors. The distractors never
+    match a query, so only the number of distractors ranked before each true
+    match is needed, and the distractors are streamed in blocks of rows.
+    Input:
+        distractor_feat: ndarray or memmap with shape [D, dim], appended after the gallery
+        counts: a list of distractor counts, such as [0, 100000, 500000]
+        max_memory: bytes of a float32 distractor distance block, default 256MB
+        the rest are the same as compute_dist and compute_score
+    Return:
+        a list of (mAP, CMC), one for each count, CMC has shape [1, G+n]
+    """
+    Q = query_feat.shape[0]
+    G = gallery_feat.shape[0]
+    counts = [min(int(n), distractor_feat.shape[0]) for n in counts]
+    dist = compute_dist(query_feat, gallery_feat, dist_type=dist_type, backend=backend)
+    rows, cols, ranks, ngood = compute_good_ranks(dist, query_pid[0, :], query_cam[0, :], \
+        gallery_pid[0, :], gallery_cam[0, :], seperate_cam)
+    pos_dist = dist[rows, cols]
+    del dist
+    first = np.cumsum(ngood) - ngood
+    block_size = max(1, int(max_memory // (4 * Q)))
+    bounds = sorted(set([0] + counts))
+    # before[k], the number of distractors in [0, bounds[k+1]) before each true match
+    before = np.zeros((len(bounds), len(rows)), dtype=np.int64)
+    for k in range(1, len(bounds)):
+        before[k, :] = before[k-1, :]
+        for start in range(bounds[k-1], bounds[k], block_size):
+            end = min(start + block_size, bounds[k])
+            print('compute distance and score for distractors [%d, %d).' % (start, end))
+            dist = np.sort(compute_dist(query_feat, distractor_feat[start:end], \
+                dist_type=dist_type, backend=backend), axis=1)
+            for i in np.nonzero(ngood)[0]:
+                # a tied distractor is ranked after the true match, its index is larger
+                before[k, first[i]:first[i]+ngood[i]] += np.searchsorted(dist[i, :], \
+                    pos_dist[first[i]:first[i]+ngood[i]], side='left')
+    result = []
+    for n in counts:
+        aps, first_hit = compute_ap_from_ranks(rows, ranks + before[bounds.index(n), :], ngood, G + n)
+        result.append((np.mean(aps), compute_cmc(first_hit, G + n)))
+    return result
+
+def compute_cmc(first_hit, num_gallery):
+    """
+    Input:
+        first_hit, int ndarray with shape [M], see compute_score_query
+        num_gallery, the length N of the cmc curve
+    Output:
+        CMC, ndarray with shape [1, N]
+    """
+    cmc = np.bincount(first_hit, minlength=num_gallery+1)[:num_gallery]
+    cmc = np.cumsum(cmc) / float(len(first_hit))
+    return cmc.reshape((1, num_gallery))
+
+def compute_ap_cmc_batch(query_pid, query_cam, gallery_pids, gallery_cams, seperate_cam=False):
+    """
+    Vectorized compute_ap_cmc for a block of queries.
+    Input:
+        query_pid, ndarray with shape [B]
+        query_cam, ndarray with shape [B]
+        gallery_pids, ndarray with shape [B, N], sorted by distance for each query
+        gallery_cams, ndarray with shape [B, N], sorted by distance for each query
+    Output:
+        aps, ndarray with shape [B]
+        first_hit, int ndarray with shape [B]
+    """
+    query_pid = np.asarray(query_pid).reshape((-1, 1))
+    query_cam = np.asarray(query_cam).reshape((-1, 1))
+    assert np.all(query_pid != -1)
+    B, N = gallery_pids.shape
+    same_pid = gallery_pids == query_pid
+    same_cam = gallery_cams == query_cam
+    good = same_pid & ~same_cam
+    if seperate_cam:
+        junk = same_cam
+    else:
+        junk = same_pid & same_cam
+    junk |= gallery_pids == -1
+    # the position of each gallery item after removing the junk ones
+    valid_rank = np.cumsum(~junk, axis=1, dtype=np.int32) - 1
+    rows, cols = np.nonzero(good)
+    ngood = np.bincount(rows, minlength=B)
+    return compute_ap_from_ranks(rows, valid_rank[rows, cols], ngood, N)
+
+def compute_ap_from_ranks(rows, ranks, ngood, num_gallery):
+    """
+    Trapezoidal ap of compute_ap_cmc, using only the ranks of the true matches.
+    Input:
+        rows, int ndarray with shape [K], the query of each true match
+        ranks, int ndarray with shape [K], the rank of each true match among the
+            valid gallery items, (rows, ranks) should be sorted in ascending order
+        ngood, int ndarray with shape [B], the number of true matches of each query
+        num_gallery, returned as first_hit when a query has no true match
+    Output:
+        aps, ndarray with shape [B]
+        first_hit, int ndarray with shape [B]
+    """
+    B = len(ngood)
+    nhit = np.bincount(rows, minlength=B)
+    first = np.cumsum(nhit) - nhit
+    # the k-th true match of its query, starting from 1
+    k = np.arange(len(rows)) - first[rows] + 1
+    n = ngood[rows]
+    recall = k / n
+    old_recall = (k - 1) / n
+    precision = k / (ranks + 1.)
+    old_precision = np.ones(len(rows))
+    prev = ranks > 0
+    old_precision[prev] = (k[prev] - 1) / ranks[prev].astype(float)
+    # same summation order as compute_ap_cmc, to keep the ap bit-identical
+    terms = np.zeros((B, max(nhit.max(initial=0), 1)))
+    terms[rows, k - 1] = (recall - old_recall) * ((old_precision + precision) / 2.)
+    aps = np.zeros(B)
+    for i in range(terms.shape[1]):
+        aps += terms[:, i]
+    aps[ngood == 0] = np.nan
+    first_hit = np.zeros(B, dtype=np.int64) + num_gallery
+    first_hit[nhit > 0] = ranks[first[nhit > 0]]
+    return aps, first_hit
 
 def compute_ap_cmc(query_pid, query_cam, gallery_pids, gallery_cams, seperate_cam=False):
     """
@@ -217,43 +1068,49 @@ def compute_ap_cmc(query_pid, query_cam, gallery_pids, gallery_cams, seperate_ca
             break
     return ap, cmc
 
-def evaluate_image_ss(dist_mat, pid, cam, **kwargs):
+def sample_image_ss(order, starts, T):
+    """
+    sample one image of each (pid, cam) group for T trials at once
+    Input:
+        order, starts: the groups, see group_order
+        T: the number of trials
+    Output:
+        index: int ndarray with shape [T, G], G = len(starts)
+    """
+    count = np.diff(np.append(starts, len(order)))
+    offset = (np.random.rand(T, len(starts)) * count).astype(np.int64)
+    offset = np.minimum(offset, count - 1)
+    return order[starts + offset]
+
+def evaluate_image_ss(dist_mat, pid, cam, index=None, **kwargs):
     """
     Input:
         dist_mat, pid, cam
+        index, int ndarray with shape [T, G], the sampled items of each trial
+            as rows/cols of dist_mat, sampled by sample_image_ss if None
     Output:
         result: dict
         result['ss']['CMC']
         result['ss']['mAP']
     """
-    if 'repeat_times' in kwargs:
-        T = kwargs['repeat_times']
-    else:
-        T = 1
-    data = dict()
-    for i, (p, c) in enumerate(zip(pid[0, :], cam[0, :])):
-        if p not in data:
-            data[p] = dict()
-        if c not in data[p]:
-            data[p][c] = []
-        data[p][c].append(i)
-    # random T times for testing
+    if index is None:
+        if 'repeat_times' in kwargs:
+            T = kwargs['repeat_times']
+        else:
+            T = 1
+        order, starts = group_order([pid[0, :], cam[0, :]])
+        index = sample_image_ss(order, starts, T)
+    T, G = index.shape
     print('compute score for single shot.')
-    for t in range(T):
-        # sample query idx
-        index = []
-        for p in data.keys():
-            for c in data[p].keys():
-                index.append( np.random.choice(data[p][c]) )
-        if t == 0:
-            aps = np.zeros((1, T))
-            cmcs = np.zeros((T, len(index)))
-        dist_tmp = dist_mat[index, :][:, index]
-        query_pid = pid[:, index]
-        query_cam = cam[:, index]
-        aps[0, t], cmcs[t, :] = compute_score(dist_tmp, query_pid, query_cam, query_pid, query_cam, True)
-    mAP = np.mean(aps[:])
-    CMC =  np.mean(cmcs, axis=0, keepdims=True)
+    # the sampled groups share (pid, cam) across the trials, so the trials are
+    # stacked as T*G queries against the same G gallery labels and scored at once
+    query_pid = pid[:, index[0, :]]
+    query_cam = cam[:, index[0, :]]
+    dist_tmp = dist_mat[index[:, :, np.newaxis], index[:, np.newaxis, :]].reshape((T*G, G))
+    aps, first_hit = compute_score_query(dist_tmp, np.tile(query_pid, (1, T)), \
+        np.tile(query_cam, (1, T)), query_pid, query_cam, True, **kwargs)
+    mAP = np.mean(np.mean(aps.reshape((T, G)), axis=1))
+    CMC = compute_cmc(first_hit, G)
     return mAP, CMC
 
 def reid_evaluate_image_pids(feat_func, dataset, **kwargs):
@@ -262,121 +1119,114 @@ def reid_evaluate_image_pids(feat_func, dataset, **kwargs):
         for each pid at each cam, selected the first one sample for validation
     """
     dataset.create_image_list_by_pids()
-    feat, pid, cam, seq, frame, record = extract_feat(feat_func, dataset)
+    feat, pid, cam, seq, frame, record = extract_feat(feat_func, dataset, **kwargs)
     return reid_evaluate_image_sequence_pids(feat, pid, cam, **kwargs)
 
 def reid_evaluate_image_sequence_pids(feat, pid, cam, **kwargs):
     """
     shared by image-based and sequence-based person re-identification
     """
-    # re-organize the data 
+    if 'dist_type' in kwargs and isinstance(kwargs['dist_type'], (list, tuple)):
+        return evaluate_dist_types(reid_evaluate_image_sequence_pids, feat, pid, cam, **kwargs)
+    projection = get_projection(**kwargs)
+    if projection is not None:
+        print('project the features to %d dimensions.' % (projection.dim))
+        feat = projection.transform(feat)
+        kwargs['feat_projection'] = None
+    feat_dtype = get_feat_dtype(**kwargs)
+    if get_feat_dtype_delta(**kwargs):
+        print('evaluate the float64 reference of the %s features.' % (feat_dtype))
+        reference = reid_evaluate_image_sequence_pids(feat, pid, cam, \
+            **dict(kwargs, feat_dtype='float64', feat_dtype_delta=False, dist_cache=None))
+        result = reid_evaluate_image_sequence_pids(feat, pid, cam, **dict(kwargs, feat_dtype_delta=False))
+        report_feat_dtype_delta(result, reference, feat_dtype)
+        return result
+    feat = quantize_feat(feat, feat_dtype)
+    # re-organize the data by (pid, cam)
     result = dict()
-    data = dict()
-    for i, (p, c) in enumerate(zip(pid, cam)):
-        if p not in data:
-            data[p] = dict()
-        if c not in data[p]:
-            data[p][c] = []
-        data[p][c].append(i)
+    pid = np.array(pid)
+    cam = np.array(cam)
+    order, starts = group_order([pid, cam])
+    if 'dist_type' in kwargs:
+        dist_type = kwargs['dist_type']
+    else:
+        dist_type = 'euclidean_normL2'
+    cache = get_dist_cache(**kwargs)
+    cache.add('all', feat)
     # default: single query
     sq_flag = 'eval_type' in kwargs and 'sq' in kwargs['eval_type']
     sq_flag = sq_flag or 'eval_type'not in kwargs
     if sq_flag:
         # for each person at each camera, sample one image
-        query_idx = []
-        for p in data.keys():
-            for c in data[p].keys():
-                query_idx.append(data[p][c][0])
+        query_idx = order[starts]
         gallery_pid = np.array(pid).reshape((1, len(pid)))
         gallery_cam = np.array(cam).reshape((1, len(cam)))
         gallery_feat = feat
         query_pid = gallery_pid[:, query_idx]
         query_cam = gallery_cam[:, query_idx]
         query_feat = feat[query_idx, :]
-        print('compute distance for single query.')
-        if 'dist_type' in kwargs:
-            dist_mat = compute_dist(query_feat, gallery_feat, dist_type=kwargs['dist_type'], verbose=True)
-        else:
-            dist_mat = compute_dist(query_feat, gallery_feat, dist_type='euclidean_normL2', verbose=True)
-        mAP, CMC = compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam)
+        cache.add('sq', query_feat)
+        print('compute distance and score for single query.')
+        mAP, CMC, _ = compute_dist_score(query_feat, gallery_feat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, cache=cache, names=('sq', 'all'), **kwargs)
         result['sq'] = dict()
         result['sq']['mAP'] = mAP
         result['sq']['CMC'] = CMC
     # mutiple query 
     if 'eval_type' in kwargs and 'mq' in kwargs['eval_type']:
         # re-organize the query feature
-        query_pid = []
-        query_cam = []
-        query_idx = []
-        for p in data.keys():
-            for c in data[p].keys():
-                query_pid.append(p)
-                query_cam.append(c)
-                query_idx.append(data[p][c])
-        # pooling the feat
-        Q = len(query_idx)
-        D = feat.shape[1]
-        query_feat = np.zeros((Q, D))
-        for i in range(len(query_idx)):
-            query_feat[i,:] = feature_pooling(feat[query_idx[i], :], **kwargs)
-        query_pid = np.array(query_pid).reshape((1, Q))
-        query_cam = np.array(query_cam).reshape((1, Q))
+        # pooling the feat of each person at each camera
+        Q = len(starts)
+        query_feat = feature_pooling_groups(feat, order, starts, **kwargs)
+        query_pid = pid[order[starts]].reshape((1, Q))
+        query_cam = cam[order[starts]].reshape((1, Q))
         gallery_pid = np.array(pid).reshape((1, len(pid)))
         gallery_cam = np.array(cam).reshape((1, len(cam)))
         gallery_feat = feat
-        print('compute distance for mutiple query.')
-        if 'dist_type' in kwargs:
-            dist_mat = compute_dist(query_feat, gallery_feat, dist_type=kwargs['dist_type'], verbose=True)
-        else:
-            dist_mat = compute_dist(query_feat, gallery_feat, dist_type='euclidean_normL2', verbose=True)
-        print('compute score for mutiple query.')
-        mAP, CMC = compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam)
+        cache.add('pool', query_feat)
+        print('compute distance and score for mutiple query.')
+        mAP, CMC, _ = compute_dist_score(query_feat, gallery_feat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, cache=cache, names=('pool', 'all'), **kwargs)
         result['mq'] = dict()
         result['mq']['mAP'] = mAP
         result['mq']['CMC'] = CMC
             
     # single shot, specially for cuhk03 val/test in old style
     if 'eval_type' in kwargs and 'ss' in kwargs['eval_type']:
-        print('compute distance for single shot.')
-        if 'dist_type' in kwargs:
-            dist_mat = compute_dist(feat, feat, dist_type=kwargs['dist_type'], verbose=True)
+        if 'repeat_times' in kwargs:
+            T = kwargs['repeat_times']
         else:
-            dist_mat = compute_dist(feat, feat, dist_type='euclidean_normL2', verbose=True)
-        query_pid = np.array(pid).reshape((1, len(pid)))
-        query_cam = np.array(cam).reshape((1, len(cam)))
-        mAP, CMC = evaluate_image_ss(dist_mat, query_pid, query_cam, **kwargs)
+            T = 1
+        # sample all the trials first, only the sampled items need the distance
+        index = sample_image_ss(order, starts, T)
+        union, inverse = np.unique(index, return_inverse=True)
+        print('compute distance for single shot.')
+        cache.add('ss', feat[union, :])
+        dist_mat = cache.dist('ss', 'ss', dist_type, verbose=True)
+        query_pid = pid[union].reshape((1, len(union)))
+        query_cam = cam[union].reshape((1, len(union)))
+        mAP, CMC = evaluate_image_ss(dist_mat, query_pid, query_cam, \
+            index=inverse.reshape(index.shape), **kwargs)
         result['ss'] = dict()
         result['ss']['mAP'] = mAP
         result['ss']['CMC'] = CMC
     
     # mutiple shot specially for cuhk03 val/test in old style
     if 'eval_type' in kwargs and 'ms' in kwargs['eval_type']:
-        query_pid = []
-        query_cam = []
-        query_idx = []
-        for p in data.keys():
-            for c in data[p].keys():
-                query_pid.append(p)
-                query_cam.append(c)
-                query_idx.append(data[p][c])
-        # pooling the feat
-        Q = len(query_idx)
-        D = feat.shape[1]
-        query_feat = np.zeros((Q, D))
-        for i in range(len(query_idx)):
-            query_feat[i,:] = feature_pooling(feat[query_idx[i], :], **kwargs)
-        query_pid = np.array(query_pid).reshape((1, Q))
-        query_cam = np.array(query_cam).reshape((1, Q))
+        # pooling the feat of each person at each camera
+        Q = len(starts)
+        query_feat = feature_pooling_groups(feat, order, starts, **kwargs)
+        query_pid = pid[order[starts]].reshape((1, Q))
+        query_cam = cam[order[starts]].reshape((1, Q))
+        cache.add('pool', query_feat)
         print('compute distance for mutiple shot.')
-        if 'dist_type' in kwargs:
-            dist_mat = compute_dist(query_feat, query_feat, dist_type=kwargs['dist_type'], verbose=True)
-        else:
-            dist_mat = compute_dist(query_feat, query_feat, dist_type='euclidean_normL2', verbose=True)
+        dist_mat = cache.dist('pool', 'pool', dist_type, verbose=True)
         print('compute score for mutiple shot.')
         mAP, CMC = evaluate_image_ss(dist_mat, query_pid, query_cam, repated_times=1)
         result['ms'] = dict()
         result['ms']['mAP'] = mAP
         result['ms']['CMC'] = CMC
+    print('distance cache: %d hits, %d misses.' % (cache.hits, cache.misses))
     return result
 
 def reid_evaluate_image_viper(feat_func, dataset, **kwargs):
@@ -397,45 +1247,521 @@ def reid_evaluate_image_fixed_query_gallery(feat_func, dataset, **kwargs):
         if using mutiple query, using fixed groundtruth or gallery
     """
     
-    print('Extracting features for fixed query.')
-    dataset.create_image_list_by_fixed_query()
-    query_feat, query_pid, query_cam, query_seq, query_frame, query_record = \
-        extract_feat(feat_func, dataset)
-
-    print('Extracting features for fixed gallery.')
-    dataset.create_image_list_by_fixed_gallery()
-    gallery_feat, gallery_pid, gallery_cam, gallery_seq, gallery_frame, gallery_record = \
-        extract_feat(feat_func, dataset)
+    # mutiple query, using fixed groundtruth or gallery
+    mq_flag = 'eval_type' in kwargs and 'mq' in kwargs['eval_type']
+    splits = ['q', 'g']
+    if mq_flag and 'image_gt' in dataset.dataset:
+        splits.append('gt')
+    print('Extracting features for fixed %s in a single pass.' % (', '.join(splits)))
+    feats = extract_feat_fixed(feat_func, dataset, splits, **kwargs)
+    distractor_feat = None
+    if 'pid_d' in dataset.dataset:
+        distractor_feat = extract_feat_distractor(feat_func, dataset, **kwargs)
+    query_feat, query_pid, query_cam, query_seq, query_frame, query_record = feats['q']
+    gallery_feat, gallery_pid, gallery_cam, gallery_seq, gallery_frame, gallery_record = feats['g']
     
-    # mutiple query
-    if 'eval_type' in kwargs and 'mq' in kwargs['eval_type']:
-        if 'image_gt' in dataset.dataset:
-            print('Extracting features for fixed groundtruth in mutiple query.')
-            dataset.create_image_list_by_fixed_groundtruth()
-            gt_feat, gt_pid, gt_cam, gt_seq, gt_frame, gt_record = \
-                extract_feat(feat_func, dataset)
-            # GT = len(gt_pid)
-            # gt_pid = np.array(gt_pid).reshape((1, GT))
-            # gt_cam = np.array(gt_cam).reshape((1, GT))
+    if mq_flag:
+        if 'gt' in feats:
+            gt_feat, gt_pid, gt_cam, gt_seq, gt_frame, gt_record = feats['gt']
         else:
             gt_feat = gallery_feat
             gt_pid = gallery_pid
             gt_cam = gallery_cam
     else:
-        gt_pid = []
         gt_pid = []
         gt_cam = []
         gt_feat = None
 
     return  reid_evaluate_image_sequence_fixed_query_gallery_groundtruth(query_feat, query_pid, query_cam, \
-        gallery_feat, gallery_pid, gallery_cam, gt_feat, gt_pid, gt_cam, **kwargs)
+        gallery_feat, gallery_pid, gallery_cam, gt_feat, gt_pid, gt_cam, \
+        query_frame=query_frame, gallery_frame=gallery_frame, distractor_feat=distractor_feat, **kwargs)
+
+def build_ann_index(gallery_feat, dist_type='euclidean_normL2', **kwargs):
+    """
+    the IVFPQIndex of the gallery for the approximate first stage
+    Input:
+        ann_nlist: number of inverted lists
+        ann_m: number of sub-quantizers, i.e. the code size in bytes, default 64
+        ann_nbits: bits of each sub-quantizer, default 8
+    """
+    from .ivfpq import IVFPQIndex
+    if 'ann_m' in kwargs:
+        m = kwargs['ann_m']
+    else:
+        m = 64
+    if 'ann_nbits' in kwargs:
+        nbits = kwargs['ann_nbits']
+    else:
+        nbits = 8
+    t0 = time.time()
+    index = IVFPQIndex(nlist=kwargs['ann_nlist'], m=m, nbits=nbits, dist_type=dist_type).fit(gallery_feat)
+    print('build ivf-pq index of %d lists and %d bytes codes for %d gallery items in %.2fs.' \
+        % (index.nlist, index.code_size(), index.num_gallery, time.time() - t0))
+    return index
+
+def rescore_shortlist(cand, query_feat, gallery_feat, dist_type='euclidean_normL2'):
+    """
+    re-score the shortlist of each query with the exact distances, in float32
+    as compute_dist_blocks
+    Input:
+        cand: int ndarray with shape [Q, R], the gallery indices, -1 for none
+    Return:
+        cand, cand_dist: sorted by the exact distance, inf for none
+    """
+    assert dist_type in ['cosine', 'euclidean', 'euclidean_normL2']
+    Q, R = cand.shape
+    query_feat = np.asarray(query_feat, dtype=np.float32)
+    gallery_feat = np.asarray(gallery_feat, dtype=np.float32)
+    if dist_type in ['cosine', 'euclidean_normL2']:
+        query_feat = normalize(query_feat, order=2, axis=1)
+        gallery_feat = normalize(gallery_feat, order=2, axis=1)
+    square1 = np.sum(np.square(query_feat), axis=1)
+    square2 = np.sum(np.square(gallery_feat), axis=1)
+    cand_dist = np.zeros(cand.shape, dtype=np.float32)
+    # by blocks of about 256MB gathered gallery rows
+    block_size = max(1, 2**26 // (max(R, 1) * gallery_feat.shape[1]))
+    for start in range(0, Q, block_size):
+        end = min(start + block_size, Q)
+        index = np.maximum(cand[start:end], 0)
+        product = np.matmul(gallery_feat[index], query_feat[start:end, :, np.newaxis])[:, :, 0]
+        if dist_type == 'cosine':
+            dist = -product
+        else:
+            dist = -2 * product + square1[start:end, np.newaxis] + square2[index]
+            dist = np.sqrt(np.maximum(dist, 0))
+        cand_dist[start:end] = np.where(cand[start:end] >= 0, dist, np.inf)
+    order = np.argsort(cand_dist, axis=1, kind='stable')
+    return np.take_along_axis(cand, order, axis=1), np.take_along_axis(cand_dist, order, axis=1)
+
+def shortlist_recall(cand, query_feat, gallery_feat, dist_type='euclidean_normL2', recall_k=10):
+    """
+    the mean fraction of the exact top-k of each query found in the first k
+    columns of cand, by an exhaustive search
+    Return:
+        recall, exact_time: seconds of the exhaustive search
+    """
+    Q = query_feat.shape[0]
+    recall_k = min(recall_k, cand.shape[1])
+    t0 = time.time()
+    found = 0
+    for start, end, dist in compute_dist_blocks(query_feat, gallery_feat, dist_type=dist_type):
+        exact = np.argpartition(dist, recall_k - 1, axis=1)[:, :recall_k]
+        approx = cand[start:end, :recall_k]
+        # the missing candidates are -1, -2, ..., never equal to an exact one
+        approx = np.where(approx >= 0, approx, -1 - np.arange(recall_k)[np.newaxis, :])
+        both = np.sort(np.concatenate([exact, approx], axis=1), axis=1)
+        found += np.count_nonzero(both[:, 1:] == both[:, :-1])
+    return found / float(Q * recall_k), time.time() - t0
+
+def compute_shortlist_score(cand, cand_dist, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, **kwargs):
+    """
+    mAP and CMC of the re-scored shortlists, scored from the ranks of the true
+    matches in the shortlists without any [Q, G] matrix. The true matches out
+    of the shortlist of a query are counted as misses.
+    Input:
+        cand: int ndarray with shape [Q, K], the shortlists, -1 for padding
+        cand_dist: ndarray with shape [Q, K], the exact distances of cand
+        the rest are the same as compute_score
+    Return:
+        mAP, CMC
+    """
+    query_pid = np.asarray(query_pid).reshape(-1)
+    query_cam = np.asarray(query_cam).reshape(-1)
+    gallery_pid = np.asarray(gallery_pid).reshape(-1)
+    gallery_cam = np.asarray(gallery_cam).reshape(-1)
+    G = len(gallery_pid)
+    # sort each shortlist by distance, ties broken by gallery index as compute_score
+    valid = cand >= 0
+    order = np.lexsort((np.where(valid, cand, G), np.where(valid, cand_dist, np.inf)))
+    cand = np.take_along_axis(cand, order, axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    pid = gallery_pid[np.where(valid, cand, 0)]
+    cam = gallery_cam[np.where(valid, cand, 0)]
+    same_pid = pid == query_pid[:, np.newaxis]
+    same_cam = cam == query_cam[:, np.newaxis]
+    good = same_pid & ~same_cam & valid
+    # the same junk rule as compute_ap_cmc
+    if seperate_cam:
+        junk = same_cam
+    else:
+        junk = same_pid & same_cam
+    junk |= (pid == -1) | ~valid
+    # the rank of each item among the valid items of the shortlist
+    rank = np.cumsum(~junk, axis=1) - 1
+    rows, cols = np.nonzero(good)
+    # the true matches of the whole gallery, by the (pid) and (pid, cam) counts
+    cam_min = min(gallery_cam.min(), query_cam.min())
+    span = max(gallery_cam.max(), query_cam.max()) - cam_min + 1
+    ngood = count_keys(gallery_pid, query_pid) - count_keys(gallery_pid * span + gallery_cam - cam_min, \
+        query_pid * span + query_cam - cam_min)
+    aps, first_hit = compute_ap_from_ranks(rows, rank[rows, cols], ngood, G)
+    return np.mean(aps), compute_cmc(first_hit, G)
+
+def count_keys(keys, query_keys):
+    """ the number of occurrences of each of query_keys in keys """
+    keys = np.sort(keys)
+    return np.searchsorted(keys, query_keys, side='right') - np.searchsorted(keys, query_keys, side='left')
+
+def compute_ann_score(index, query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, **kwargs):
+    """
+    Score the approximate first stage: the shortlist of each query is searched
+    in the IVFPQIndex, re-scored with the exact distances, and the true matches
+    out of the shortlist are misses, see compute_shortlist_score.
+    Input:
+        index: a fitted IVFPQIndex of gallery_feat
+        ann_nprobe: number of inverted lists visited by each query, default 8
+        ann_topk: size of the shortlist, default 100
+        ann_recall_k: k of the recall against the exact search, default 10
+        the rest are the same as compute_dist_score
+    Return:
+        mAP, CMC
+        recall: the mean fraction of the exact top-k found in the top-k of the first stage
+        search_time: seconds of the search and the re-scoring
+    """
+    if 'ann_nprobe' in kwargs:
+        nprobe = kwargs['ann_nprobe']
+    else:
+        nprobe = 8
+    if 'ann_topk' in kwargs:
+        topk = kwargs['ann_topk']
+    else:
+        topk = 100
+    if 'ann_recall_k' in kwargs:
+        recall_k = kwargs['ann_recall_k']
+    else:
+        recall_k = 10
+    t0 = time.time()
+    _, cand = index.search(query_feat, topk=topk, nprobe=nprobe)
+    cand, cand_dist = rescore_shortlist(cand, query_feat, gallery_feat, index.dist_type)
+    search_time = time.time() - t0
+    recall, exact_time = shortlist_recall(cand, query_feat, gallery_feat, index.dist_type, recall_k)
+    print('ann search with nprobe %d: %.2fs, exact search: %.2fs, recall@%d %.4f.' \
+        % (nprobe, search_time, exact_time, min(recall_k, cand.shape[1]), recall))
+    mAP, CMC = compute_shortlist_score(cand, cand_dist, query_pid, query_cam, \
+        gallery_pid, gallery_cam, seperate_cam, **kwargs)
+    return mAP, CMC, recall, search_time
+
+def build_hash_index(gallery_feat, dist_type='euclidean_normL2', **kwargs):
+    """
+    the BinaryHashIndex of the gallery for the Hamming first stage
+    Input:
+        hash_bits: the code length, a multiple of 64
+        hash_itq: number of ITQ iterations, 0 for the plain PCA signs, default 50
+    """
+    from .hashing import BinaryHashIndex
+    if 'hash_itq' in kwargs:
+        itq_iter = kwargs['hash_itq']
+    else:
+        itq_iter = 50
+    t0 = time.time()
+    index = BinaryHashIndex(nbits=kwargs['hash_bits'], itq_iter=itq_iter, dist_type=dist_type).fit(gallery_feat)
+    print('build %d bits binary codes for %d gallery items in %.2fs.' \
+        % (index.nbits, index.num_gallery, time.time() - t0))
+    return index
+
+def compute_hash_score(index, query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, **kwargs):
+    """
+    Score the two-stage search: the top-R gallery items of each query by the
+    Hamming distance of the binary codes are re-scored with the exact
+    distances, and the true matches out of them are misses.
+    Input:
+        index: a fitted BinaryHashIndex of gallery_feat
+        hash_topr: R, number of the re-scored candidates, default 1000
+        hash_recall_k: k of the recall against the exact search, default 10
+        the rest are the same as compute_dist_score
+    Return:
+        mAP, CMC, recall, search_time: the same as compute_ann_score
+    """
+    if 'hash_topr' in kwargs:
+        topr = kwargs['hash_topr']
+    else:
+        topr = 1000
+    if 'hash_recall_k' in kwargs:
+        recall_k = kwargs['hash_recall_k']
+    else:
+        recall_k = 10
+    t0 = time.time()
+    _, cand = index.search(query_feat, topk=topr)
+    hamming_time = time.time() - t0
+    cand, cand_dist = rescore_shortlist(cand, query_feat, gallery_feat, index.dist_type)
+    search_time = time.time() - t0
+    recall, exact_time = shortlist_recall(cand, query_feat, gallery_feat, index.dist_type, recall_k)
+    print('hamming search of top %d: %.2fs, with re-scoring: %.2fs, exact search: %.2fs, recall@%d %.4f.' \
+        % (cand.shape[1], hamming_time, search_time, exact_time, min(recall_k, cand.shape[1]), recall))
+    mAP, CMC = compute_shortlist_score(cand, cand_dist, query_pid, query_cam, \
+        gallery_pid, gallery_cam, seperate_cam, **kwargs)
+    return mAP, CMC, recall, search_time
+
+def compute_cascade_score(query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, **kwargs):
+    """
+    Score the cascaded retrieval of the part features, such as the stripes of
+    PCBModel: the gallery is ranked on the summary of the parts, and the top-n
+    candidates get the full distance part by part with early abandoning, see
+    cascade_search; the true matches out of them are misses.
+    Input:
+        cascade_topn: n, the candidates of the first stage
+        cascade_parts: number of the parts, default 6
+        cascade_summary: 'mean' (default) or the index of a single part
+        cascade_k: the exact top-k, also the k of the recall, default 10
+        the rest are the same as compute_dist_score
+    Return:
+        mAP, CMC, recall, search_time: the same as compute_ann_score
+    """
+    from .cascade import cascade_search
+    if 'cascade_parts' in kwargs:
+        num_parts = kwargs['cascade_parts']
+    else:
+        num_parts = 6
+    if 'cascade_summary' in kwargs:
+        summary = kwargs['cascade_summary']
+    else:
+        summary = 'mean'
+    if 'cascade_k' in kwargs:
+        k = kwargs['cascade_k']
+    else:
+        k = 10
+    if 'dist_type' in kwargs:
+        dist_type = kwargs['dist_type']
+    else:
+        dist_type = 'euclidean_normL2'
+    t0 = time.time()
+    cand, cand_dist, computed = cascade_search(query_feat, gallery_feat, num_parts, \
+        kwargs['cascade_topn'], k, summary, dist_type)
+    search_time = time.time() - t0
+    recall, exact_time = shortlist_recall(cand, query_feat, gallery_feat, dist_type, k)
+    print('cascade search of top %d: %.2fs, %.2f%% part distances computed, flat search: %.2fs, recall@%d %.4f.' \
+        % (cand.shape[1], search_time, 100. * computed, exact_time, min(k, cand.shape[1]), recall))
+    mAP, CMC = compute_shortlist_score(cand, cand_dist, query_pid, query_cam, \
+        gallery_pid, gallery_cam, seperate_cam, **kwargs)
+    return mAP, CMC, recall, search_time
+
+def compute_qe_score(cache, query_name, query_pid, query_cam, gallery_pid, gallery_cam, \
+    seperate_cam=False, **kwargs):
+    """
+    Score the fast post-processing: database-side augmentation (DBA) of the
+    gallery and alpha-weighted query expansion (alpha-QE) of the queries, both
+    from the top-k neighbours of a blocked matmul, see query_expansion.py.
+    The augmented gallery is derived once in the DistanceCache, and shared by
+    the single and the mutiple query, and stored in the feature cache, see
+    get_dba_gallery.
+    Input:
+        cache: the DistanceCache with the feature sets query_name and 'g'
+        qe: if True, expand the queries, default False
+        qe_k, qe_alpha: the neighbours and the weight exponent of alpha-QE, default 10 and 3
+        dba: if True, augment the gallery, the queries are expanded against it, default False
+        dba_k, dba_alpha: the same for DBA, default 10 and 3
+        the rest are the same as compute_dist_score; the expanded features are
+            L2 normalized, so 'euclidean' is replaced by 'euclidean_normL2' to
+            compare both sides at the same scale
+    Return:
+        mAP, CMC
+        qe_time: seconds of DBA, about 0 if cached, and alpha-QE
+    """
+    from .query_expansion import alpha_query_expansion
+    if 'qe_k' in kwargs:
+        qe_k = kwargs['qe_k']
+    else:
+        qe_k = 10
+    if 'qe_alpha' in kwargs:
+        qe_alpha = kwargs['qe_alpha']
+    else:
+        qe_alpha = 3.
+    if 'dba_k' in kwargs:
+        dba_k = kwargs['dba_k']
+    else:
+        dba_k = 10
+    if 'dba_alpha' in kwargs:
+        dba_alpha = kwargs['dba_alpha']
+    else:
+        dba_alpha = 3.
+    if 'stream_memory' in kwargs:
+        max_memory = kwargs['stream_memory']
+    else:
+        max_memory = 2**28
+    t0 = time.time()
+    gallery_name = 'g'
+    if 'dba' in kwargs and kwargs['dba']:
+        gallery_name = cache.derive('g_dba_k%d_a%g' % (dba_k, dba_alpha), 'g', \
+            lambda feat: get_dba_gallery(feat, dba_k, dba_alpha, max_memory, **kwargs))
+    if 'qe' in kwargs and kwargs['qe']:
+        expanded = alpha_query_expansion(cache.feat(query_name), cache.feat(gallery_name), \
+            qe_k, qe_alpha, max_memory)
+        query_name = query_name + '_qe'
+        cache.add(query_name, expanded)
+    qe_time = time.time() - t0
+    print('query expansion of %s against %s: %.2fs.' % (query_name, gallery_name, qe_time))
+    if 'dist_type' in kwargs and kwargs['dist_type'] not in ['cosine', 'euclidean_normL2']:
+        kwargs = dict(kwargs)
+        kwargs['dist_type'] = 'euclidean_normL2'
+    mAP, CMC, _ = compute_dist_score(cache.feats[query_name], cache.feats[gallery_name], \
+        query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam, \
+        cache=cache, names=(query_name, gallery_name), **kwargs)
+    return mAP, CMC, qe_time
+
+def get_dba_gallery(gallery_feat, k=10, alpha=3., max_memory=2**28, **kwargs):
+    """
+    the DBA gallery of database_augment, stored in the feature cache by the
+    content of the gallery features, so it is computed once and reused by the
+    later evaluations of the same gallery
+    Input:
+        feat_cache_dir, feat_cache_size: the feature cache, see extract_feat,
+            the DBA gallery is not stored if not given
+    """
+    from .query_expansion import database_augment
+    feat_cache = get_feat_cache(**kwargs)
+    if feat_cache is not None:
+        key = feat_cache.content_key(gallery_feat, 'dba', k, alpha)
+        path = feat_cache.load_file(key, 'dba.npy')
+        if path is not None:
+            print('Load cached DBA gallery %s.' % (key))
+            return np.load(path, mmap_mode='r')
+    t0 = time.time()
+    feat = database_augment(gallery_feat, k, alpha, max_memory)
+    print('augment the gallery of %d items in %.2fs.' % (feat.shape[0], time.time() - t0))
+    if feat_cache is not None:
+        feat_cache.save_file(key, 'dba.npy', lambda path: np.save(path, feat), \
+            dict(k=k, alpha=alpha, num_gallery=feat.shape[0]))
+    return feat
+
+def get_gallery_graph(cache, dist_type='euclidean_normL2', k1=20, k2=6, **kwargs):
+    """
+    the GalleryGraph of the gallery 'g' of the DistanceCache for re-ranking,
+    stored in the feature cache by the content of the gallery features, so it
+    is built once and reused by the later evaluations of the same gallery
+    Input:
+        feat_cache_dir, feat_cache_size: the feature cache, see extract_feat,
+            the graph is not stored if not given
+    """
+    from .rerank import GalleryGraph
+    feat_cache = get_feat_cache(**kwargs)
+    if feat_cache is not None:
+        key = feat_cache.content_key(cache.feats['g'], 'gallery_graph', dist_type, k1, k2)
+        path = feat_cache.load_file(key, 'graph.npz')
+        if path is not None:
+            print('Load cached gallery graph %s.' % (key))
+            return GalleryGraph.load(path)
+    t0 = time.time()
+    g_g_dist = cache.dist('g', 'g', dist_type, verbose=True)
+    graph = GalleryGraph.build(g_g_dist, k1, k2, backend=get_backend(**kwargs))
+    print('build the gallery graph of %d items in %.2fs.' % (graph.num_gallery, time.time() - t0))
+    if feat_cache is not None:
+        feat_cache.save_file(key, 'graph.npz', graph.save, \
+            dict(dist_type=dist_type, k1=k1, k2=k2, num_gallery=graph.num_gallery))
+    return graph
+
+def rerank_online(cache, query_name, graph, dist_type='euclidean_normL2', lambda_value=0.3, **kwargs):
+    """
+    re-rank the queries of the DistanceCache as a stream against the gallery 'g':
+    the OnlineReranker starts from graph, the GalleryGraph of get_gallery_graph,
+    and the queries are fed rerank_online at a time; the final distance is the
+    same as the batch re-ranking
+    Return:
+        final_dist
+        latency: float ndarray, seconds of each block of queries
+    """
+    from .rerank import OnlineReranker
+    block_size = kwargs['rerank_online']
+    q_g_dist = cache.dist(query_name, 'g', dist_type)
+    q_q_dist = cache.dist(query_name, query_name, dist_type)
+    online = OnlineReranker(cache.dist('g', 'g', dist_type), graph.k1, graph.k2, lambda_value, graph=graph)
+    latency = []
+    for start in range(0, q_g_dist.shape[0], block_size):
+        end = min(start + block_size, q_g_dist.shape[0])
+        t0 = time.time()
+        online.add(q_g_dist[start:end], q_q_dist[start:end, :end])
+        latency.append(time.time() - t0)
+    latency = np.array(latency)
+    print('online rerank of %d queries, %d at a time: %.1fms mean, %.1fms p99 latency.' \
+        % (q_g_dist.shape[0], block_size, 1000 * np.mean(latency), 1000 * np.percentile(latency, 99)))
+    return online.dist(), latency
+
+def _add_stage_result(result, name, mAP, CMC, extra=None):
+    """ result[name] of a scoring stage, the mAP, the CMC and the extra metrics such as the time """
+    result[name] = dict()
+    result[name]['mAP'] = mAP
+    result[name]['CMC'] = CMC
+    if extra is not None:
+        result[name].update(extra)
 
 def reid_evaluate_image_sequence_fixed_query_gallery_groundtruth(query_feat, query_pid, query_cam, \
-    gallery_feat, gallery_pid, gallery_cam, gt_feat, gt_pid, gt_cam, **kwargs):
+    gallery_feat, gallery_pid, gallery_cam, gt_feat, gt_pid, gt_cam, \
+    query_frame=None, gallery_frame=None, distractor_feat=None, **kwargs):
     """
+    Input:
+        query_frame, gallery_frame: the frames of the images, needed by st_constraint
+        distractor_feat: the features of an extra distractor gallery segment, if
+            given, sq and mq are also scored with the first n distractors
+            appended to the gallery, result['sq_distractor%d' % n]
+        distractor_counts: the list of n, clamped to the number of distractors,
+            default all the distractors
+        st_constraint: a SpatioTemporalConstraint, if given, the sq and mq distances
+            are only computed between each query and its feasible gallery items,
+            the pruned items are ranked last; the re-ranking uses the full gallery
+        ann_nlist: if > 0, sq and mq are also scored with an IVF-PQ first stage,
+            result['sq_ann'] with its recall and search time, see compute_ann_score
+        hash_bits: if > 0, sq and mq are also scored with a binary hashing first
+            stage and exact re-scoring, result['sq_hash'], see compute_hash_score
+        cascade_topn: if > 0, sq and mq are also scored with the cascaded retrieval
+            of the part features, result['sq_cascade'], see compute_cascade_score
+        qe, dba: if True, sq and mq are also scored with the alpha-weighted query
+            expansion and the database-side augmentation, a cheap alternative
+            to rerank, result['sq_qe'], see compute_qe_score
+        rerank_graph: if True, rerank with the GalleryGraph of the gallery, built
+            once and reused by sq and mq and by the later evaluations through
+            the feature cache, see get_gallery_graph, default False. It is an
+            approximation of rerank, the result is in result['sq_rerank_graph']
+        rerank_online: if > 0, rerank the queries as a stream, rerank_online at
+            a time, with the same result as the batch one and the latency in
+            result['sq_rerank']['latency'], see rerank_online, default 0
+        feat_projection, projection_dim: the projection of all the features, see get_projection
+        feat_dtype, feat_dtype_delta: the storage of query_feat, gallery_feat and
+            gt_feat, and whether to evaluate the float64 reference of the same
+            features, result[key]['mAP_delta'] is the difference of the mAP
     Output:
         result
     """
+    if 'dist_type' in kwargs and isinstance(kwargs['dist_type'], (list, tuple)):
+        return evaluate_dist_types(reid_evaluate_image_sequence_fixed_query_gallery_groundtruth, \
+            query_feat, query_pid, query_cam, gallery_feat, gallery_pid, gallery_cam, \
+            gt_feat, gt_pid, gt_cam, query_frame=query_frame, gallery_frame=gallery_frame, \
+            distractor_feat=distractor_feat, **kwargs)
+    projection = get_projection(**kwargs)
+    if projection is not None:
+        print('project the features to %d dimensions.' % (projection.dim))
+        gt_is_gallery = gt_feat is gallery_feat
+        query_feat = projection.transform(query_feat)
+        gallery_feat = projection.transform(gallery_feat)
+        if gt_is_gallery:
+            gt_feat = gallery_feat
+        elif gt_feat is not None:
+            gt_feat = projection.transform(gt_feat)
+        if distractor_feat is not None:
+            distractor_feat = projection.transform(distractor_feat)
+        kwargs['feat_projection'] = None
+    feat_dtype = get_feat_dtype(**kwargs)
+    if get_feat_dtype_delta(**kwargs):
+        print('evaluate the float64 reference of the %s features.' % (feat_dtype))
+        reference = reid_evaluate_image_sequence_fixed_query_gallery_groundtruth(query_feat, \
+            query_pid, query_cam, gallery_feat, gallery_pid, gallery_cam, gt_feat, gt_pid, gt_cam, \
+            query_frame=query_frame, gallery_frame=gallery_frame, distractor_feat=distractor_feat, \
+            **dict(kwargs, feat_dtype='float64', feat_dtype_delta=False, dist_cache=None))
+        kwargs['feat_dtype_delta'] = False
+        result = reid_evaluate_image_sequence_fixed_query_gallery_groundtruth(query_feat, \
+            query_pid, query_cam, gallery_feat, gallery_pid, gallery_cam, gt_feat, gt_pid, gt_cam, \
+            query_frame=query_frame, gallery_frame=gallery_frame, distractor_feat=distractor_feat, **kwargs)
+        report_feat_dtype_delta(result, reference, feat_dtype)
+        return result
+    # the gallery may be the groundtruth of the mutiple query
+    gt_is_gallery = gt_feat is gallery_feat
+    query_feat = quantize_feat(query_feat, feat_dtype)
+    gallery_feat = quantize_feat(gallery_feat, feat_dtype)
+    gt_feat = gallery_feat if gt_is_gallery else quantize_feat(gt_feat, feat_dtype)
+    print('store the query and gallery features as %s, %.1fMB.' \
+        % (feat_dtype, (query_feat.nbytes + gallery_feat.nbytes) / 2.**20))
     result = dict()
     # single query
     Q = len(query_pid)
@@ -446,18 +1772,74 @@ def reid_evaluate_image_sequence_fixed_query_gallery_groundtruth(query_feat, que
     gallery_pid = np.array(gallery_pid).reshape((1, G))
     gallery_cam = np.array(gallery_cam).reshape((1, G))
 
-    print('compute distance for single query.')
     if 'dist_type' in kwargs:
-        dist_mat = compute_dist(query_feat, gallery_feat, dist_type=kwargs['dist_type'], verbose=True)
+        dist_type = kwargs['dist_type']
     else:
-        dist_mat = compute_dist(query_feat, gallery_feat, dist_type='euclidean_normL2', verbose=True)
-    
-    print('compute score for single query.')
-    mAP, CMC = compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam)
+        dist_type = 'euclidean_normL2'
+    # q_g, q_q, g_g and mq_g, mq_mq are computed once and shared by all the eval types
+    cache = get_dist_cache(**kwargs)
+    cache.add('q', query_feat)
+    cache.add('g', gallery_feat)
+
+    constraint = None
+    if 'st_constraint' in kwargs and kwargs['st_constraint'] is not None:
+        assert query_frame is not None and gallery_frame is not None
+        constraint = kwargs['st_constraint'].fit(gallery_cam, gallery_frame)
+    if 'stream_memory' in kwargs:
+        max_memory = kwargs['stream_memory']
+    else:
+        max_memory = 2**28
+
+    if constraint is not None:
+        print('compute pruned distance and score for single query.')
+        dist_blocks = compute_dist_pruned_blocks(constraint, query_feat, query_cam, query_frame, \
+            gallery_feat, dist_type=dist_type, backend=get_backend(**kwargs), max_memory=max_memory)
+        mAP, CMC = compute_score_blocks(dist_blocks, query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+    else:
+        print('compute distance and score for single query.')
+        mAP, CMC, _ = compute_dist_score(query_feat, gallery_feat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, cache=cache, names=('q', 'g'), **kwargs)
     result['sq'] = dict()
     result['sq']['mAP'] = mAP
     result['sq']['CMC'] = CMC
 
+    ann_index = None
+    if 'ann_nlist' in kwargs and kwargs['ann_nlist'] > 0:
+        ann_index = build_ann_index(gallery_feat, dist_type, **kwargs)
+        print('compute ann score for single query.')
+        mAP, CMC, recall, search_time = compute_ann_score(ann_index, query_feat, gallery_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'sq_ann', mAP, CMC, dict(recall=recall, time=search_time))
+
+    hash_index = None
+    if 'hash_bits' in kwargs and kwargs['hash_bits'] > 0:
+        hash_index = build_hash_index(gallery_feat, dist_type, **kwargs)
+        print('compute hash score for single query.')
+        mAP, CMC, recall, search_time = compute_hash_score(hash_index, query_feat, gallery_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'sq_hash', mAP, CMC, dict(recall=recall, time=search_time))
+
+    cascade_flag = 'cascade_topn' in kwargs and kwargs['cascade_topn'] > 0
+    if cascade_flag:
+        print('compute cascade score for single query.')
+        mAP, CMC, recall, search_time = compute_cascade_score(query_feat, gallery_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'sq_cascade', mAP, CMC, dict(recall=recall, time=search_time))
+
+    if distractor_feat is not None:
+        if 'distractor_counts' in kwargs:
+            distractor_counts = kwargs['distractor_counts']
+        else:
+            distractor_counts = [distractor_feat.shape[0]]
+        # the same clamping as compute_score_distractors, so the keys match the scores
+        distractor_counts = sorted(set([min(int(n), distractor_feat.shape[0]) for n in distractor_counts]))
+        print('compute score for single query with distractors.')
+        scores = compute_score_distractors(query_feat, gallery_feat, distractor_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, distractor_counts, \
+            dist_type=dist_type, max_memory=max_memory, backend=get_backend(**kwargs))
+        for n, (mAP, CMC) in zip(distractor_counts, scores):
+            _add_stage_result(result, 'sq_distractor%d' % n, mAP, CMC)
+
     if 'rerank_k1' in kwargs:
         k1 = kwargs['rerank_k1']
     else:
@@ -473,60 +1855,129 @@ def reid_evaluate_image_sequence_fixed_query_gallery_groundtruth(query_feat, que
     else:
         lambda_value = 0.3
 
+    # sparse re-ranking by default, the dense one needs several [Q+G, Q+G] matrices
+    backend = get_backend(**kwargs)
+    if 'rerank_sparse' in kwargs and not kwargs['rerank_sparse']:
+        rerank_func = re_ranking
+    else:
+        rerank_func = lambda q_g, q_q, g_g, k1, k2, lambda_value: \
+            re_ranking_sparse(q_g, q_q, g_g, k1, k2, lambda_value, backend=backend)
+
+    # the query independent part of the re-ranking, shared by sq and mq
+    graph = None
+    rerank_graph = 'rerank_graph' in kwargs and kwargs['rerank_graph']
+
     if 'rerank' in kwargs and kwargs['rerank']:
-        q_g_dist = dist_mat
         print('compute distance for single query rerank.')
-        if 'dist_type' in kwargs:
-            q_q_dist = compute_dist(query_feat, query_feat, dist_type=kwargs['dist_type'], verbose=True)
-            g_g_dist = compute_dist(gallery_feat, gallery_feat, dist_type=kwargs['dist_type'], verbose=True)
+        q_g_dist = cache.dist('q', 'g', dist_type, verbose=True)
+        latency = None
+        rerank_key = 'sq_rerank'
+        if 'rerank_online' in kwargs and kwargs['rerank_online'] > 0:
+            graph = get_gallery_graph(cache, dist_type, k1, k2, **kwargs)
+            rerank_sq_dist, latency = rerank_online(cache, 'q', graph, dist_type, lambda_value, **kwargs)
+        elif rerank_graph:
+            # approximate, the queries do not update the gallery graph
+            graph = get_gallery_graph(cache, dist_type, k1, k2, **kwargs)
+            rerank_sq_dist = graph.rerank(q_g_dist, lambda_value)
+            rerank_key = 'sq_rerank_graph'
         else:
-            q_q_dist = compute_dist(query_feat, query_feat, dist_type='euclidean_normL2', verbose=True)
-            g_g_dist = compute_dist(gallery_feat, gallery_feat, dist_type='euclidean_normL2', verbose=True)
-        rerank_sq_dist = re_ranking(q_g_dist, q_q_dist, g_g_dist, k1, k2, lambda_value)
+            q_q_dist = cache.dist('q', 'q', dist_type, verbose=True)
+            g_g_dist = cache.dist('g', 'g', dist_type, verbose=True)
+            rerank_sq_dist = rerank_func(q_g_dist, q_q_dist, g_g_dist, k1, k2, lambda_value)
         print('compute score for single query rerank.')
-        mAP, CMC = compute_score(rerank_sq_dist, query_pid, query_cam, gallery_pid, gallery_cam)
-        result['sq_rerank'] = dict()
-        result['sq_rerank']['mAP'] = mAP
-        result['sq_rerank']['CMC'] = CMC
+        mAP, CMC = compute_score(rerank_sq_dist, query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, rerank_key, mAP, CMC, \
+            None if latency is None else dict(latency=np.mean(latency)))
+
+    qe_flag = ('qe' in kwargs and kwargs['qe']) or ('dba' in kwargs and kwargs['dba'])
+    if qe_flag:
+        print('compute query expansion score for single query.')
+        mAP, CMC, qe_time = compute_qe_score(cache, 'q', query_pid, query_cam, \
+            gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'sq_qe', mAP, CMC, dict(time=qe_time))
      
     # only single query
     GT = len(gt_pid)
     if GT == 0:
+        print('distance cache: %d hits, %d misses.' % (cache.hits, cache.misses))
         return result
     
-    mquery_feat = np.zeros((Q, D))
-    gt_pid = np.array(gt_pid).reshape((1, GT))
-    for i, (p, c) in enumerate(zip(query_pid[0, :], query_cam[0, :])):
-        # idx is a 1*G bool array
-        idx = ((p == gt_pid).astype(float) + (c == gt_cam).astype(float)) == 2
-        mquery_feat[i, :] = feature_pooling(gt_feat[idx[0, :], :], **kwargs)
+    # pool the groundtruth of each query by (pid, cam)
+    gt_pid = np.array(gt_pid).reshape(GT)
+    gt_cam = np.array(gt_cam).reshape(GT)
+    mquery_feat = feature_pooling_by_keys(gt_feat, [gt_pid, gt_cam], \
+        [query_pid[0, :], query_cam[0, :]], **kwargs)
+    cache.add('mq', mquery_feat)
     
-    print('compute distance for mutiple query.')
-    if 'dist_type' in kwargs:
-        dist_mat = compute_dist(mquery_feat, gallery_feat, dist_type=kwargs['dist_type'], verbose=True)
+    if constraint is not None:
+        print('compute pruned distance and score for mutiple query.')
+        dist_blocks = compute_dist_pruned_blocks(constraint, mquery_feat, query_cam, query_frame, \
+            gallery_feat, dist_type=dist_type, backend=get_backend(**kwargs), max_memory=max_memory)
+        mAP, CMC = compute_score_blocks(dist_blocks, query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
     else:
-        dist_mat = compute_dist(mquery_feat, gallery_feat, dist_type='euclidean_normL2', verbose=True)
-    print('compute score for mutiple query.')
-    mAP, CMC = compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam)
+        print('compute distance and score for mutiple query.')
+        mAP, CMC, _ = compute_dist_score(mquery_feat, gallery_feat, query_pid, query_cam, \
+            gallery_pid, gallery_cam, cache=cache, names=('mq', 'g'), **kwargs)
     result['mq'] = dict()
     result['mq']['mAP'] = mAP
     result['mq']['CMC'] = CMC
 
+    if ann_index is not None:
+        print('compute ann score for mutiple query.')
+        mAP, CMC, recall, search_time = compute_ann_score(ann_index, mquery_feat, gallery_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'mq_ann', mAP, CMC, dict(recall=recall, time=search_time))
+
+    if hash_index is not None:
+        print('compute hash score for mutiple query.')
+        mAP, CMC, recall, search_time = compute_hash_score(hash_index, mquery_feat, gallery_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'mq_hash', mAP, CMC, dict(recall=recall, time=search_time))
+
+    if cascade_flag:
+        print('compute cascade score for mutiple query.')
+        mAP, CMC, recall, search_time = compute_cascade_score(mquery_feat, gallery_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'mq_cascade', mAP, CMC, dict(recall=recall, time=search_time))
+
+    if distractor_feat is not None:
+        print('compute score for mutiple query with distractors.')
+        scores = compute_score_distractors(mquery_feat, gallery_feat, distractor_feat, \
+            query_pid, query_cam, gallery_pid, gallery_cam, distractor_counts, \
+            dist_type=dist_type, max_memory=max_memory, backend=get_backend(**kwargs))
+        for n, (mAP, CMC) in zip(distractor_counts, scores):
+            _add_stage_result(result, 'mq_distractor%d' % n, mAP, CMC)
+
     # rerank sq
     if 'rerank' in kwargs and kwargs['rerank']:
-        mq_g_dist = dist_mat
         print('compute distance for mutiple query rerank.')
-        if 'dist_type' in kwargs:
-            mq_mq_dist = compute_dist(mquery_feat, mquery_feat, dist_type=kwargs['dist_type'], verbose=True)
+        mq_g_dist = cache.dist('mq', 'g', dist_type, verbose=True)
+        latency = None
+        rerank_key = 'mq_rerank'
+        online = 'rerank_online' in kwargs and kwargs['rerank_online'] > 0
+        if (online or rerank_graph) and graph is None:
+            graph = get_gallery_graph(cache, dist_type, k1, k2, **kwargs)
+        if online:
+            rerank_mq_dist, latency = rerank_online(cache, 'mq', graph, dist_type, lambda_value, **kwargs)
+        elif rerank_graph:
+            rerank_mq_dist = graph.rerank(mq_g_dist, lambda_value)
+            rerank_key = 'mq_rerank_graph'
         else:
-            mq_mq_dist = compute_dist(mquery_feat, mquery_feat, dist_type='euclidean_normL2', verbose=True)
-        rerank_mq_dist = re_ranking(mq_g_dist, mq_mq_dist, g_g_dist, k1, k2, lambda_value)
+            mq_mq_dist = cache.dist('mq', 'mq', dist_type, verbose=True)
+            g_g_dist = cache.dist('g', 'g', dist_type, verbose=True)
+            rerank_mq_dist = rerank_func(mq_g_dist, mq_mq_dist, g_g_dist, k1, k2, lambda_value)
         print('compute score for mutiple query rerank.')
-        mAP, CMC = compute_score(rerank_mq_dist, query_pid, query_cam, gallery_pid, gallery_cam)
-        result['mq_rerank'] = dict()
-        result['mq_rerank']['mAP'] = mAP
-        result['mq_rerank']['CMC'] = CMC
+        mAP, CMC = compute_score(rerank_mq_dist, query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, rerank_key, mAP, CMC, \
+            None if latency is None else dict(latency=np.mean(latency)))
+
+    if qe_flag:
+        print('compute query expansion score for mutiple query.')
+        mAP, CMC, qe_time = compute_qe_score(cache, 'mq', query_pid, query_cam, \
+            gallery_pid, gallery_cam, **kwargs)
+        _add_stage_result(result, 'mq_qe', mAP, CMC, dict(time=qe_time))
     
+    print('distance cache: %d hits, %d misses.' % (cache.hits, cache.misses))
     return result
 
 def reid_evaluate_image_cuhk03_new(feat_func, dataset, **kwargs):
@@ -549,41 +2000,15 @@ def reid_evaluate_sequence_pids(feat_func, dataset, **kwargs):
     """
     result = dict()
     dataset.create_image_list_by_pids()
-    feat, pid, cam, seq, frame, record = extract_feat(feat_func, dataset)
-    # re-organize the data using id, cam, seq
-    data = dict()
-    N_seq = 0 
-    for i, (p, c, s) in enumerate(zip(pid, cam, seq)):
-        if p not in data:
-            data[p] = dict()
-        if c not in data[p]:
-            data[p][c] = dict()
-        if s not in data[p][c]:
-            data[p][c][s] = []
-            N_seq = N_seq + 1 
-        data[p][c][s].append(i)
-    # sort the sequence, re-compute the sequence-based feature
-    spid = []
-    scam = []
-    sseq = []
-    cnt = 0
-    for p in data.keys():
-        for c in data[p].keys():
-            for s in data[p][c]:
-                tmp = np.sort(data[p][c][s])
-                if cnt == 0:
-                    sfeat_tmp = feature_pooling(feat[tmp, :], **kwargs) 
-                    spid.append(p)
-                    scam.append(c)
-                    scam.append(s)
-                    L = sfeat_tmp.shape[1]
-                    sfeat = np.zeros((N_seq, L))
-                    sfeat[cnt, :] = sfeat_tmp
-                    cnt = cnt + 1
-                spid.append(p)
-                scam.append(c)
-                scam.append(s)
-                sfeat[cnt, :] = feature_pooling(feat[tmp, :], **kwargs)
+    feat, pid, cam, seq, frame, record = extract_feat(feat_func, dataset, **kwargs)
+    # re-organize the data using id, cam, seq, and pool each sequence
+    pid = np.array(pid)
+    cam = np.array(cam)
+    seq = np.array(seq)
+    order, starts = group_order([pid, cam, seq])
+    sfeat = feature_pooling_groups(feat, order, starts, **kwargs)
+    spid = pid[order[starts]]
+    scam = cam[order[starts]]
     # re-compute the sequence-based feature
     return reid_evaluate_image_sequence_pids(sfeat, spid, scam, **kwargs)
     
@@ -593,71 +2018,36 @@ def reid_evaluate_sequence_mars(feat_func, dataset, **kwargs):
     # for mars dataset, first create image list using test identites.
     # then using fixed query/gallery tracklets for evaluatation
     dataset.create_image_list_by_pids()
-    feat, pid, cam, seq, frame, record = extract_feat(feat_func, dataset)
-    # re-organize the data using id, cam, seq
-    data = dict()
-    N_seq = 0 
-    for i, (p, c, s) in enumerate(zip(pid, cam, seq)):
-        if p not in data:
-            data[p] = dict()
-        if c not in data[p]:
-            data[p][c] = dict()
-        if s not in data[p][c]:
-            data[p][c][s] = []
-            N_seq = N_seq + 1 
-        data[p][c][s].append(i)
-    # sort the sequence, re-compute the sequence-based feature
-    # spid = []
-    # scam = []
-    # sseq = []
+    feat, pid, cam, seq, frame, record = extract_feat(feat_func, dataset, **kwargs)
+    # group the frames into tracklets by (pid, cam, seq)
+    pid = np.array(pid)
+    cam = np.array(cam)
+    seq = np.array(seq)
+    order, starts = group_order([pid, cam, seq])
+    sfeat = feature_pooling_groups(feat, order, starts, **kwargs)
+    spid = pid[order[starts]]
+    scam = cam[order[starts]]
+    sseq = seq[order[starts]]
     # extract the fixed query/gallery tracklets feature 
-    track_pid_q = dataset.dataset['track_pid_q']
-    track_cam_q = dataset.dataset['track_cam_q']
-    track_seq_q = dataset.dataset['track_seq_q']
-    track_pid_g = dataset.dataset['track_pid_g']
-    track_cam_g = dataset.dataset['track_cam_g']
-    track_seq_g = dataset.dataset['track_seq_g']
-    N_q = len(track_pid_q)
-    N_g = len(track_pid_g)
-    track_pid_q = np.array(track_pid_q).reshape((1, N_q))
-    track_cam_q = np.array(track_cam_q).reshape((1, N_q))
-    track_seq_q = np.array(track_seq_q).reshape((1, N_q))
-    track_pid_g = np.array(track_pid_g).reshape((1, N_g))
-    track_cam_g = np.array(track_cam_g).reshape((1, N_g))
-    track_seq_g = np.array(track_seq_g).reshape((1, N_g))
-
-    query_idx = []
-    gallery_idx = []
-    query_pid = []
-    query_cam = []
-    gallery_pid = []
-    gallery_cam = []
-    cnt = 0
-    for p in data.keys():
-        for c in data[p].keys():
-            for s in data[p][c]:
-                tmp = np.sort(data[p][c][s])
-                sfeat_tmp = feature_pooling(feat[tmp, :], **kwargs) 
-                if cnt == 0:
-                    L = sfeat_tmp.shape[1]
-                    sfeat = np.zeros((N_seq, L))
-                # spid.append(p)
-                # scam.append(c)
-                # scam.append(s)
-                sfeat[cnt, :] = feature_pooling(feat[tmp, :], **kwargs)
-                # process the query/gallery index
-                flag = np.sum((track_pid_q == p) & (track_cam_q == c) & (track_seq_q == s))
-                if flag:
-                    query_idx.append(cnt)
-                    query_pid.append(p)
-                    query_cam.append(c)
-                flag = np.sum((track_pid_g == p) & (track_cam_g == c) & (track_seq_g == s))
-                if flag:
-                    gallery_idx.append(cnt)
-                    gallery_pid.append(p)
-                    gallery_cam.append(c)
-                cnt = cnt + 1
-    assert N_seq == cnt
+    track_pid_q = np.array(dataset.dataset['track_pid_q'])
+    track_cam_q = np.array(dataset.dataset['track_cam_q'])
+    track_seq_q = np.array(dataset.dataset['track_seq_q'])
+    track_pid_g = np.array(dataset.dataset['track_pid_g'])
+    track_cam_g = np.array(dataset.dataset['track_cam_g'])
+    track_seq_g = np.array(dataset.dataset['track_seq_g'])
+    # join the tracklets with the fixed query/gallery by their composite keys
+    _, bases = composite_key([np.concatenate([spid, track_pid_q, track_pid_g]), \
+        np.concatenate([scam, track_cam_q, track_cam_g]), \
+        np.concatenate([sseq, track_seq_q, track_seq_g])])
+    skey, _ = composite_key([spid, scam, sseq], bases)
+    qkey, _ = composite_key([track_pid_q, track_cam_q, track_seq_q], bases)
+    gkey, _ = composite_key([track_pid_g, track_cam_g, track_seq_g], bases)
+    query_idx = np.nonzero(np.isin(skey, qkey))[0]
+    gallery_idx = np.nonzero(np.isin(skey, gkey))[0]
+    query_pid = list(spid[query_idx])
+    query_cam = list(scam[query_idx])
+    gallery_pid = list(spid[gallery_idx])
+    gallery_cam = list(scam[gallery_idx])
     query_feat = sfeat[query_idx, :]
     gallery_feat = sfeat[gallery_idx, :]
     # for groundtruth
@@ -0,0 +1,154 @@
+import os
+import shutil
+import hashlib
+import pickle
+import numpy as np
+import torch
+
+
+class FeatureCache(object):
+    """
+    Content-addressed on-disk cache of extracted features.
+    Each entry is keyed by the model weights, the test transform and the image
+    list, and stored as a memory-mapped float32 array with its metadata.
+    Args:
+        cache_dir: the directory of the cache, such as exp_dir/feat_cache
+        max_size: maximal bytes of the cache, the least recently used entries
+            are evicted when it is exceeded
+    Usage example:
+        cache = FeatureCache('exp/market1501/partition0/run1/feat_cache')
+        key = cache.key(feat_func, dataset)
+        entry = cache.load(key)
+        if entry is None:
+            cache.save(key, feat, meta)
+    """
+    def __init__(self, cache_dir, max_size=10*2**30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, feat_func, dataset):
+        """
+        hash of the model state_dict, the test transform and the image list.
+        None if feat_func does not expose the model.
+        """
+        if not hasattr(feat_func, 'model'):
+            return None
+        h = hashlib.sha1()
+        h.update(type(feat_func).__name__.encode())
+        for name, param in sorted(feat_func.model.state_dict().items()):
+            h.update(name.encode())
+            h.update(param.detach().cpu().numpy().tobytes())
+        h.update(repr(dataset.transform).encode())
+        h.update(dataset.dataset['root'].encode())
+        h.update('\n'.join(dataset.image).encode())
+        return h.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """
+        Returns:
+            (feat, meta), feat is a read-only float32 memmap, meta is a dict
+            with pid, cam, seq, frame and record; None if key is not cached
+        """
+        if key is None:
+            return None
+        path = self.entry_dir(key)
+        if not os.path.exists(os.path.join(path, 'meta.pkl')):
+            return None
+        feat = np.load(os.path.join(path, 'feat.npy'), mmap_mode='r')
+        meta = pickle.load(open(os.path.join(path, 'meta.pkl'), 'rb'))
+        # mark as recently used for the eviction
+        os.utime(os.path.join(path, 'meta.pkl'), None)
+        return feat, meta
+
+    def save(self, key, feat, meta):
+        """ store feat as float32 and meta, then evict the old entries """
+        store = self.create(key, feat.shape)
+        store[:] = feat
+        self.commit(key, store, meta)
+
+    def create(self, key, shape):
+        """
+        a writable float32 memmap of a new entry, so that features larger than
+        the memory can be written batch by batch, then stored by commit
+        """
+        tmp_path = self.entry_dir(key) + '.tmp%d' % os.getpid()
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        return np.lib.format.open_memmap(os.path.join(tmp_path, 'feat.npy'), \
+            mode='w+', dtype=np.float32, shape=tuple([int(s) for s in shape]))
+
+    def commit(self, key, store, meta):
+        """ store meta with the memmap of create, then evict the old entries """
+        path = self.entry_dir(key)
+        tmp_path = path + '.tmp%d' % os.getpid()
+        store.flush()
+        pickle.dump(meta, open(os.path.join(tmp_path, 'meta.pkl'), 'wb'))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        self.evict(keep=key)
+
+    def content_key(self, feat, *params):
+        """ hash of the feature values and params, for the entries derived from the features """
+        h = hashlib.sha1()
+        h.update(repr(params).encode())
+        h.update(repr(tuple(feat.shape)).encode())
+        for start in range(0, feat.shape[0], 65536):
+            h.update(np.ascontiguousarray(feat[start:start+65536], dtype=np.float32).tobytes())
+        return h.hexdigest()
+
+    def load_file(self, key, name):
+        """ the path of the file name of the entry key, None if not cached """
+        path = self.entry_dir(key)
+        if not os.path.exists(os.path.join(path, 'meta.pkl')) or \
+            not os.path.exists(os.path.join(path, name)):
+            return None
+        os.utime(os.path.join(path, 'meta.pkl'), None)
+        return os.path.join(path, name)
+
+    def save_file(self, key, name, save_func, meta):
+        """
+        store a file name of the entry key by save_func(path), such as the
+        GalleryGraph of the gallery features, then evict the old entries
+        """
+        path = self.entry_dir(key)
+        tmp_path = path + '.tmp%d' % os.getpid()
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        save_func(os.path.join(tmp_path, name))
+        pickle.dump(meta, open(os.path.join(tmp_path, 'meta.pkl'), 'wb'))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        self.evict(keep=key)
+
+    def entries(self):
+        """ list of (last used time, bytes, key) of the complete entries """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = self.entry_dir(key)
+            if not os.path.exists(os.path.join(path, 'meta.pkl')):
+                continue
+            size = sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+            entries.append((os.path.getmtime(os.path.join(path, 'meta.pkl')), size, key))
+        return entries
+
+    def evict(self, keep=None):
+        """ remove the least recently used entries until the cache fits in max_size """
+        entries = sorted(self.entries())
+        total = sum([e[1] for e in entries])
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            print('Evict cached features %s.' % (key))
+            shutil.rmtree(self.entry_dir(key))
+            total -= size
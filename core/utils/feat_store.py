@@ -0,0 +1,105 @@
+import numpy as np
+
+
+FEAT_DTYPES = ['float64', 'float32', 'float16', 'int8']
+
+
+class Int8Feat(object):
+    """
+    Feature matrix stored as int8 codes with a float32 scale per dimension,
+    feat[:, d] ~= codes[:, d] * scale[d], a quarter of the float32 memory.
+    The row selections stay int8, any other access or numpy operation gets
+    the dequantized float32 array, so the distance kernels compute in float32.
+    Args:
+        codes: int8 ndarray with shape [N, D]
+        scale: float32 ndarray with shape [D]
+    Usage example:
+        feat = Int8Feat.quantize(gallery_feat)
+        block = np.asarray(feat[0:1024], dtype=np.float32)
+    """
+    def __init__(self, codes, scale):
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, feat, block_size=65536):
+        """ symmetric scalar quantization, the scale maps the max |feat| of each dimension to 127 """
+        N, D = feat.shape
+        scale = np.zeros(D, dtype=np.float32)
+        for start in range(0, N, block_size):
+            block = np.abs(np.asarray(feat[start:start+block_size], dtype=np.float32))
+            scale = np.maximum(scale, np.max(block, axis=0))
+        scale = np.where(scale > 0, scale / 127., 1.).astype(np.float32)
+        codes = np.zeros((N, D), dtype=np.int8)
+        for start in range(0, N, block_size):
+            block = np.asarray(feat[start:start+block_size], dtype=np.float32)
+            codes[start:start+block_size] = np.clip(np.rint(block / scale), -127, 127)
+        return cls(codes, scale)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        """ the dtype of the dequantized features """
+        return np.dtype(np.float32)
+
+    @property
+    def ndim(self):
+        return self.codes.ndim
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scale.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+        else:
+            rows, cols = key, slice(None)
+        codes = self.codes[rows]
+        if codes.ndim == 2 and isinstance(cols, slice) and cols == slice(None):
+            return Int8Feat(codes, self.scale)
+        return codes[..., cols] * self.scale[cols]
+
+    def __array__(self, dtype=None, copy=None):
+        feat = self.codes * self.scale
+        if dtype is not None:
+            return feat.astype(dtype, copy=False)
+        return feat
+
+
+def quantize_feat(feat, feat_dtype='float32'):
+    """
+    store the features in feat_dtype
+    Args:
+        feat: ndarray with shape [N, D]
+        feat_dtype: one of FEAT_DTYPES, 'int8' returns an Int8Feat
+    """
+    if feat_dtype not in FEAT_DTYPES:
+        print('The feature dtype should be in %s' % (', '.join(FEAT_DTYPES)))
+        raise ValueError
+    if feat is None:
+        return None
+    if feat_dtype == 'int8':
+        if isinstance(feat, Int8Feat):
+            return feat
+        return Int8Feat.quantize(feat)
+    return np.asarray(feat, dtype=feat_dtype)
+
+
+def as_float(feat):
+    """
+    the features to compute with, only the compact storage, Int8Feat and
+    float16, is converted to float32, the other arrays are kept as they are
+    """
+    if isinstance(feat, Int8Feat):
+        return np.asarray(feat, dtype=np.float32)
+    feat = np.asarray(feat)
+    if feat.dtype == np.float16:
+        return feat.astype(np.float32)
+    return feat
@@ -0,0 +1,205 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from multiprocessing import Pool
+from .evaluate import compute_dist_blocks, compute_ap_cmc_count
+
+
+# the file marking a directory written by ShardedGallery.build
+MARKER = 'GALLERY_SHARDS'
+
+# the memory-mapped shards opened in each worker process
+_shard_open = dict()
+
+
+def _open_shard(shard_dir, shard_id):
+    key = (shard_dir, shard_id)
+    if key not in _shard_open:
+        path = os.path.join(shard_dir, 'shard%d' % shard_id)
+        _shard_open[key] = dict([(name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) \
+            for name in ['feat', 'pid', 'cam', 'index']])
+    return _shard_open[key]
+
+
+def _close_shards(shard_dir):
+    for key in [k for k in _shard_open.keys() if k[0] == shard_dir]:
+        del _shard_open[key]
+
+
+def _shard_search(task):
+    """ the local top-k of one shard, with the global gallery indices """
+    shard_dir, shard_id, dist_type, topk, block_size = task
+    shard = _open_shard(shard_dir, shard_id)
+    query_feat = np.load(os.path.join(shard_dir, 'query_feat.npy'), mmap_mode='r')
+    k = min(topk, shard['feat'].shape[0])
+    Q = query_feat.shape[0]
+    dist = np.zeros((Q, k), dtype=np.float32)
+    index = np.zeros((Q, k), dtype=np.int64)
+    for start, end, d in compute_dist_blocks(query_feat, shard['feat'], dist_type=dist_type, \
+        block_size=block_size):
+        idx = np.argpartition(d, k-1, axis=1)[:, :k]
+        dist[start:end, :] = np.take_along_axis(d, idx, axis=1)
+        index[start:end, :] = shard['index'][idx]
+    return dist, index
+
+
+def _shard_score(task):
+    """
+    ap and first hit of a block of queries: the distance block of each shard is
+    computed once, and the true matches are ranked against the valid items of
+    all the shards in the same blocks
+    """
+    shard_dir, num_shards, start, end, dist_type, seperate_cam = task
+    query_feat = np.load(os.path.join(shard_dir, 'query_feat.npy'), mmap_mode='r')[start:end]
+    query_pid = np.load(os.path.join(shard_dir, 'query_pid.npy'))[start:end]
+    query_cam = np.load(os.path.join(shard_dir, 'query_cam.npy'))[start:end]
+    dist, gallery_pid, gallery_cam = [], [], []
+    for i in range(num_shards):
+        shard = _open_shard(shard_dir, i)
+        # one block with all the queries of the task
+        dist.append(next(compute_dist_blocks(query_feat, shard['feat'], dist_type=dist_type, \
+            block_size=max(end - start, 1)))[2])
+        gallery_pid.append(np.asarray(shard['pid']))
+        gallery_cam.append(np.asarray(shard['cam']))
+    # the shards are contiguous, so the gallery index order is kept for the ties
+    return compute_ap_cmc_count(np.concatenate(dist, axis=1), query_pid, query_cam, \
+        np.concatenate(gallery_pid), np.concatenate(gallery_cam), seperate_cam)
+
+
+class ShardedGallery(object):
+    """
+    Gallery split into memory-mapped shards, searched by a pool of worker
+    processes with one task for each shard, and scored with one task for
+    each block of queries.
+    Args:
+        shard_dir: the directory of the shards, written by build in a new
+            directory inside the given one
+    Usage example:
+        gallery = ShardedGallery.build('exp/shards', gallery_feat, gallery_pid, gallery_cam, 8)
+        dist, index = gallery.search(query_feat, topk=100, workers=8)
+        aps, first_hit = gallery.score(query_feat, query_pid, query_cam, workers=8)
+        gallery.remove()
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.num_shards = len([f for f in os.listdir(shard_dir) if f.startswith('shard')])
+        self.gallery_pid = np.concatenate([np.load(os.path.join(shard_dir, 'shard%d' % i, 'pid.npy')) \
+            for i in range(self.num_shards)])
+        self.gallery_cam = np.concatenate([np.load(os.path.join(shard_dir, 'shard%d' % i, 'cam.npy')) \
+            for i in range(self.num_shards)])
+        self.gallery_index = np.concatenate([np.load(os.path.join(shard_dir, 'shard%d' % i, 'index.npy')) \
+            for i in range(self.num_shards)])
+        self.num_gallery = len(self.gallery_pid)
+
+    @classmethod
+    def build(cls, shard_dir, gallery_feat, gallery_pid, gallery_cam, num_shards):
+        """
+        split the gallery into num_shards contiguous float32 shards, written in
+        a new private directory inside shard_dir, nothing else of shard_dir is
+        touched
+        """
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        shard_dir = tempfile.mkdtemp(prefix='gallery', dir=shard_dir)
+        # remove only deletes the directories with this marker
+        open(os.path.join(shard_dir, MARKER), 'w').close()
+        gallery_pid = np.asarray(gallery_pid).reshape(-1)
+        gallery_cam = np.asarray(gallery_cam).reshape(-1)
+        G = len(gallery_pid)
+        bounds = np.linspace(0, G, min(num_shards, max(G, 1)) + 1).astype(np.int64)
+        for i, (s, e) in enumerate(zip(bounds[:-1], bounds[1:])):
+            path = os.path.join(shard_dir, 'shard%d' % i)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            store = np.lib.format.open_memmap(os.path.join(path, 'feat.npy'), \
+                mode='w+', dtype=np.float32, shape=(int(e - s), gallery_feat.shape[1]))
+            store[:] = gallery_feat[s:e]
+            store.flush()
+            del store
+            np.save(os.path.join(path, 'pid.npy'), gallery_pid[s:e])
+            np.save(os.path.join(path, 'cam.npy'), gallery_cam[s:e])
+            np.save(os.path.join(path, 'index.npy'), np.arange(s, e, dtype=np.int64))
+        return cls(shard_dir)
+
+    def remove(self):
+        """ delete the shards, only in a directory written by build """
+        _close_shards(self.shard_dir)
+        if not os.path.exists(os.path.join(self.shard_dir, MARKER)):
+            print('%s was not written by ShardedGallery.build, it is not removed.' % (self.shard_dir))
+            raise ValueError
+        shutil.rmtree(self.shard_dir)
+
+    def feat(self, index):
+        """ the gallery features of the global indices """
+        index = np.asarray(index, dtype=np.int64)
+        feat = None
+        for i in range(self.num_shards):
+            shard = _open_shard(self.shard_dir, i)
+            local = index - shard['index'][0] if len(shard['index']) > 0 else index
+            mask = (local >= 0) & (local < len(shard['index']))
+            if feat is None:
+                feat = np.zeros((len(index), shard['feat'].shape[1]), dtype=np.float32)
+            feat[mask, :] = shard['feat'][local[mask], :]
+        return feat
+
+    def _save_query(self, query_feat, query_pid=None, query_cam=None):
+        store = np.lib.format.open_memmap(os.path.join(self.shard_dir, 'query_feat.npy'), \
+            mode='w+', dtype=np.float32, shape=query_feat.shape)
+        store[:] = query_feat
+        store.flush()
+        del store
+        if query_pid is not None:
+            np.save(os.path.join(self.shard_dir, 'query_pid.npy'), query_pid)
+            np.save(os.path.join(self.shard_dir, 'query_cam.npy'), query_cam)
+
+    def _map(self, func, tasks, workers):
+        if workers <= 1:
+            return [func(task) for task in tasks]
+        pool = Pool(processes=min(workers, len(tasks)))
+        try:
+            return pool.map(func, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def search(self, query_feat, topk=100, dist_type='euclidean_normL2', workers=1, block_size=256):
+        """
+        the global top-k gallery items of each query, merged from the local
+        top-k of the shards, ties are broken by gallery index
+        Returns:
+            dist: float32 ndarray with shape [Q, topk]
+            index: int ndarray with shape [Q, topk]
+        """
+        self._save_query(query_feat)
+        tasks = [(self.shard_dir, i, dist_type, topk, block_size) for i in range(self.num_shards)]
+        results = self._map(_shard_search, tasks, workers)
+        dist = np.concatenate([r[0] for r in results], axis=1)
+        index = np.concatenate([r[1] for r in results], axis=1)
+        order = np.lexsort((index, dist), axis=1)[:, :min(topk, self.num_gallery)]
+        return np.take_along_axis(dist, order, axis=1), np.take_along_axis(index, order, axis=1)
+
+    def score(self, query_feat, query_pid, query_cam, seperate_cam=False, dist_type='euclidean_normL2', \
+        workers=1, max_memory=2**28):
+        """
+        ap and first hit of each query, the same as compute_score_count_query.
+        The queries are scored in blocks by the workers, each block computes
+        its distance to every shard once, and ranks the true matches against
+        the valid items of all the shards in these same distances.
+        Args:
+            max_memory: bytes of the float32 distances of a block to the gallery, default 256MB
+        Returns:
+            aps, first_hit: the same as compute_score_query
+        """
+        query_pid = np.asarray(query_pid).reshape(-1)
+        query_cam = np.asarray(query_cam).reshape(-1)
+        assert np.all(query_pid != -1)
+        Q = len(query_pid)
+        self._save_query(query_feat, query_pid, query_cam)
+        block_size = max(1, int(max_memory // (4 * max(self.num_gallery, 1))))
+        tasks = [(self.shard_dir, self.num_shards, start, min(start + block_size, Q), dist_type, \
+            seperate_cam) for start in range(0, Q, block_size)]
+        if len(tasks) == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        results = self._map(_shard_score, tasks, workers)
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
@@ -0,0 +1,134 @@
+import numpy as np
+from .projection import FeatureProjection
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(x):
+        """ number of set bits of each element of a uint64 ndarray """
+        return np.bitwise_count(x)
+else:
+    _POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(x):
+        """ number of set bits of each element of a uint64 ndarray, by a byte table """
+        x = np.ascontiguousarray(x)
+        return np.sum(_POPCOUNT[x.view(np.uint8)].reshape(x.shape + (8,)), axis=-1, dtype=np.uint8)
+
+
+def hamming_dist(codes1, codes2, max_memory=2**28):
+    """
+    Hamming distance of all pairs of packed binary codes
+    Args:
+        codes1: uint64 ndarray with shape [m1, W]
+        codes2: uint64 ndarray with shape [m2, W]
+    Returns:
+        int32 ndarray with shape [m1, m2]
+    """
+    M1, W = codes1.shape
+    M2 = codes2.shape[0]
+    dist = np.zeros((M1, M2), dtype=np.int32)
+    block_size = max(1, int(max_memory // (8 * W * max(M2, 1))))
+    for start in range(0, M1, block_size):
+        end = min(start + block_size, M1)
+        xor = np.bitwise_xor(codes1[start:end, np.newaxis, :], codes2[np.newaxis, :, :])
+        dist[start:end] = np.sum(popcount(xor), axis=2, dtype=np.int32)
+    return dist
+
+
+class BinaryHashIndex(object):
+    """
+    Binary codes of the gallery for a Hamming first stage, the sign of the
+    PCA-rotated features, optionally refined by ITQ (Gong and Lazebnik,
+    iterative quantization), packed into uint64 words.
+    Args:
+        nbits: code length, a multiple of 64 and at most the feature dimension
+        itq_iter: number of ITQ iterations, 0 for the plain PCA signs
+        dist_type: 'euclidean', 'euclidean_normL2' or 'cosine', the features
+            are L2 normalized before the PCA for the last two
+    Usage example:
+        index = BinaryHashIndex(nbits=256).fit(gallery_feat)
+        dist, index = index.search(query_feat, topk=1000)
+    """
+    def __init__(self, nbits=256, itq_iter=50, dist_type='euclidean_normL2', seed=0):
+        assert dist_type in ['cosine', 'euclidean', 'euclidean_normL2']
+        if nbits % 64 != 0:
+            print('The code length %d should be a multiple of 64.' % (nbits))
+            raise ValueError
+        self.nbits = nbits
+        self.itq_iter = itq_iter
+        self.dist_type = dist_type
+        self.seed = seed
+
+    def preprocess(self, feat):
+        feat = np.asarray(feat, dtype=np.float32)
+        if self.dist_type in ['cosine', 'euclidean_normL2']:
+            feat = feat / np.linalg.norm(feat, ord=2, axis=1, keepdims=True)
+        return feat
+
+    def fit(self, gallery_feat, train_feat=None, block_size=65536, max_itq_points=65536):
+        """
+        learn the PCA and the rotation on train_feat, the gallery by default,
+        and encode the gallery; ITQ uses at most max_itq_points sampled rows
+        """
+        if train_feat is None:
+            train_feat = gallery_feat
+        if self.nbits > train_feat.shape[1]:
+            print('The code length %d exceeds the feature dimension %d.' % (self.nbits, train_feat.shape[1]))
+            raise ValueError
+        self.projection = FeatureProjection(self.nbits)
+        for start in range(0, train_feat.shape[0], block_size):
+            self.projection.partial_fit(self.preprocess(train_feat[start:start+block_size]))
+        self.projection.finalize()
+        rng = np.random.RandomState(self.seed)
+        # a random orthogonal initialization of the rotation
+        self.rotation = np.linalg.qr(rng.randn(self.nbits, self.nbits))[0].astype(np.float32)
+        if self.itq_iter > 0:
+            sample = np.arange(train_feat.shape[0])
+            if len(sample) > max_itq_points:
+                sample = np.sort(rng.choice(len(sample), max_itq_points, replace=False))
+            V = self.projection.transform(self.preprocess(train_feat[sample]))
+            for _ in range(self.itq_iter):
+                B = np.where(np.matmul(V, self.rotation) >= 0, 1., -1.).astype(np.float32)
+                # the orthogonal procrustes problem, min ||B - V R|| over R
+                U, _, Wt = np.linalg.svd(np.matmul(V.T, B))
+                self.rotation = np.matmul(U, Wt).astype(np.float32)
+        self.codes = self.encode(gallery_feat)
+        self.num_gallery = self.codes.shape[0]
+        return self
+
+    def encode(self, feat, block_size=65536):
+        """ packed binary codes, uint64 ndarray with shape [N, nbits/64] """
+        codes = np.zeros((feat.shape[0], self.nbits // 64), dtype=np.uint64)
+        for start in range(0, feat.shape[0], block_size):
+            V = self.projection.transform(self.preprocess(feat[start:start+block_size]))
+            bits = np.matmul(V, self.rotation) >= 0
+            codes[start:start+block_size] = np.packbits(bits, axis=1).view(np.uint64)
+        return codes
+
+    def code_size(self):
+        """ bytes of the code of each gallery item """
+        return self.nbits // 8
+
+    def search(self, query_feat, topk=1000, max_memory=2**28):
+        """
+        the top-k gallery items of each query, sorted by Hamming distance and
+        then by gallery index
+        Returns:
+            dist: int32 ndarray with shape [Q, topk], the Hamming distance
+            index: int ndarray with shape [Q, topk], the gallery indices
+        """
+        query_codes = self.encode(query_feat)
+        Q = query_codes.shape[0]
+        topk = min(topk, self.num_gallery)
+        dist = np.zeros((Q, topk), dtype=np.int32)
+        index = np.zeros((Q, topk), dtype=np.int64)
+        block_size = max(1, int(max_memory // (8 * self.codes.shape[1] * self.num_gallery)))
+        for start in range(0, Q, block_size):
+            end = min(start + block_size, Q)
+            hamming = hamming_dist(query_codes[start:end], self.codes, max_memory)
+            cand = np.argpartition(hamming, topk - 1, axis=1)[:, :topk]
+            cand_dist = np.take_along_axis(hamming, cand, axis=1)
+            order = np.lexsort((cand, cand_dist), axis=1)
+            dist[start:end] = np.take_along_axis(cand_dist, order, axis=1)
+            index[start:end] = np.take_along_axis(cand, order, axis=1)
+        return dist, index
@@ -0,0 +1,189 @@
+import numpy as np
+
+
+def _square_dist(array1, array2, square2=None):
+    """ squared euclidean distance between the rows of array1 and array2 """
+    if square2 is None:
+        square2 = np.sum(np.square(array2), axis=1)
+    dist = np.matmul(array1, array2.T)
+    dist *= -2
+    dist += np.sum(np.square(array1), axis=1)[:, np.newaxis]
+    dist += square2[np.newaxis, :]
+    return np.maximum(dist, 0, out=dist)
+
+
+def assign(x, centroids, block_size=4096):
+    """
+    the nearest centroid of each row of x
+    Returns:
+        label: int ndarray with shape [N]
+        dist: float32 ndarray with shape [N], the squared distance to it
+    """
+    square = np.sum(np.square(centroids), axis=1)
+    label = np.zeros(x.shape[0], dtype=np.int64)
+    dist = np.zeros(x.shape[0], dtype=np.float32)
+    for start in range(0, x.shape[0], block_size):
+        end = min(start + block_size, x.shape[0])
+        d = _square_dist(x[start:end], centroids, square)
+        label[start:end] = np.argmin(d, axis=1)
+        dist[start:end] = d[np.arange(end - start), label[start:end]]
+    return label, dist
+
+
+def kmeans(x, k, niter=20, seed=0, max_points=256):
+    """
+    Lloyd k-means, the empty clusters are re-seeded by the farthest points
+    Args:
+        x: float32 ndarray with shape [N, D]
+        k: number of clusters, at most N
+        max_points: at most max_points * k rows of x are sampled for training
+    Returns:
+        centroids: float32 ndarray with shape [k, D]
+    """
+    rng = np.random.RandomState(seed)
+    if x.shape[0] > max_points * k:
+        x = x[rng.choice(x.shape[0], max_points * k, replace=False)]
+    assert x.shape[0] >= k
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    for _ in range(niter):
+        label, dist = assign(x, centroids)
+        order = np.argsort(label, kind='stable')
+        count = np.bincount(label, minlength=k)
+        nonempty = np.nonzero(count)[0]
+        starts = np.concatenate([[0], np.cumsum(count[nonempty])[:-1]])
+        centroids[nonempty] = np.add.reduceat(x[order], starts, axis=0) / count[nonempty, np.newaxis]
+        empty = np.nonzero(count == 0)[0]
+        if len(empty) > 0:
+            centroids[empty] = x[np.argsort(-dist, kind='stable')[:len(empty)]]
+    return centroids
+
+
+class IVFPQIndex(object):
+    """
+    Inverted file index with product quantization of the residuals, for the
+    approximate nearest gallery items of the queries.
+    The gallery is partitioned by a k-means coarse quantizer into nlist
+    inverted lists, and the residual of each item to its list centroid is
+    encoded by m sub-quantizers of 2**nbits centroids each. A query visits
+    its nprobe nearest lists and ranks their items by asymmetric distance
+    tables, i.e. the exact query residual against the quantized items.
+    Args:
+        nlist: number of inverted lists
+        m: number of sub-quantizers, the code size is m bytes, D % m == 0
+        nbits: bits of each sub-quantizer, at most 8
+        dist_type: 'euclidean', 'euclidean_normL2' or 'cosine'
+    Usage example:
+        index = IVFPQIndex(nlist=256, m=64).fit(gallery_feat)
+        dist, index = index.search(query_feat, topk=100, nprobe=8)
+    """
+    def __init__(self, nlist=256, m=64, nbits=8, dist_type='euclidean_normL2', niter=20, seed=0):
+        assert dist_type in ['cosine', 'euclidean', 'euclidean_normL2']
+        assert nbits <= 8
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.ksub = 2**nbits
+        self.dist_type = dist_type
+        self.niter = niter
+        self.seed = seed
+
+    def preprocess(self, feat):
+        feat = np.asarray(feat, dtype=np.float32)
+        if self.dist_type in ['cosine', 'euclidean_normL2']:
+            feat = feat / np.linalg.norm(feat, ord=2, axis=1, keepdims=True)
+        return feat
+
+    def fit(self, gallery_feat):
+        """ train the quantizers on the gallery and encode it """
+        feat = self.preprocess(gallery_feat)
+        N, D = feat.shape
+        if D % self.m != 0:
+            print('feature dimension %d is not divisible by %d sub-quantizers.' % (D, self.m))
+            raise ValueError
+        self.nlist = min(self.nlist, N)
+        self.dsub = D // self.m
+        self.coarse = kmeans(feat, self.nlist, self.niter, self.seed)
+        label, _ = assign(feat, self.coarse)
+        residual = feat - self.coarse[label]
+        ksub = min(self.ksub, N)
+        self.codebook = np.zeros((self.m, self.ksub, self.dsub), dtype=np.float32)
+        codes = np.zeros((N, self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = np.ascontiguousarray(residual[:, j*self.dsub:(j+1)*self.dsub])
+            self.codebook[j, :ksub] = kmeans(sub, ksub, self.niter, self.seed + j + 1)
+            # the unused centroids of a small gallery are never assigned
+            self.codebook[j, ksub:] = self.codebook[j, 0]
+            codes[:, j], _ = assign(sub, self.codebook[j, :ksub])
+        # the inverted lists, contiguous in the order of the list id
+        order = np.argsort(label, kind='stable')
+        self.ids = order
+        self.codes = codes[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(label, minlength=self.nlist))])
+        self.codebook_square = np.sum(np.square(self.codebook), axis=2)
+        self.num_gallery = N
+        return self
+
+    def code_size(self):
+        """ bytes of the code of each gallery item """
+        return self.m * self.nbits // 8
+
+    def probe(self, query_feat, nprobe):
+        """ the nprobe nearest lists of each query, int ndarray with shape [Q, nprobe] """
+        nprobe = min(nprobe, self.nlist)
+        dist = _square_dist(query_feat, self.coarse)
+        probe = np.argpartition(dist, nprobe - 1, axis=1)[:, :nprobe]
+        return probe
+
+    def search(self, query_feat, topk=100, nprobe=8, block_size=1024):
+        """
+        the approximate top-k gallery items of each query, sorted by distance
+        Returns:
+            dist: float32 ndarray with shape [Q, topk], the approximate distance
+                of dist_type, inf if fewer than topk items are visited
+            index: int ndarray with shape [Q, topk], the gallery indices, -1 if
+                fewer than topk items are visited
+        """
+        query_feat = self.preprocess(query_feat)
+        Q = query_feat.shape[0]
+        topk = min(topk, self.num_gallery)
+        best_dist = np.full((Q, topk), np.inf, dtype=np.float32)
+        best_index = np.full((Q, topk), -1, dtype=np.int64)
+        probe = self.probe(query_feat, nprobe)
+        # visit each list once with all the queries probing it
+        rows = np.repeat(np.arange(Q), probe.shape[1])
+        lists = probe.reshape(-1)
+        order = np.argsort(lists, kind='stable')
+        rows, lists = rows[order], lists[order]
+        starts = np.nonzero(np.diff(np.concatenate([[-1], lists])))[0]
+        ends = np.append(starts[1:], len(lists))
+        for start, end in zip(starts, ends):
+            l = lists[start]
+            s, e = self.offsets[l], self.offsets[l+1]
+            if e == s:
+                continue
+            codes = self.codes[s:e]
+            ids = self.ids[s:e]
+            for qstart in range(start, end, block_size):
+                qs = rows[qstart:min(qstart + block_size, end)]
+                residual = (query_feat[qs] - self.coarse[l]).reshape((len(qs), self.m, self.dsub))
+                # distance tables with shape [nq, m, ksub]
+                table = -2 * np.matmul(residual.transpose(1, 0, 2), \
+                    self.codebook.transpose(0, 2, 1)).transpose(1, 0, 2)
+                table += self.codebook_square[np.newaxis]
+                table += np.sum(np.square(residual), axis=2)[:, :, np.newaxis]
+                dist = np.zeros((len(qs), e - s), dtype=np.float32)
+                for j in range(self.m):
+                    dist += table[:, j, codes[:, j]]
+                dist = np.concatenate([best_dist[qs], dist], axis=1)
+                index = np.concatenate([best_index[qs], np.repeat(ids[np.newaxis], len(qs), axis=0)], axis=1)
+                keep = np.argpartition(dist, topk - 1, axis=1)[:, :topk]
+                best_dist[qs] = np.take_along_axis(dist, keep, axis=1)
+                best_index[qs] = np.take_along_axis(index, keep, axis=1)
+        best_dist = np.maximum(best_dist, 0)
+        order = np.argsort(best_dist, axis=1, kind='stable')
+        best_dist = np.take_along_axis(best_dist, order, axis=1)
+        best_index = np.take_along_axis(best_index, order, axis=1)
+        if self.dist_type == 'cosine':
+            # ||x - y||^2 = 2 - 2cos for the normalized features
+            return best_dist / 2 - 1, best_index
+        return np.sqrt(best_dist), best_index
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+
+
+class FeatureProjection(object):
+    """
+    PCA or PCA-whitening projection of the features to a lower dimension,
+    fitted by a streaming covariance, batch by batch, so the training
+    features never have to be held in memory at once.
+    Args:
+        dim: output dimension
+        whiten: if True, the projected dimensions are scaled to unit variance
+        eps: added to the eigenvalues before whitening
+    Usage example:
+        projection = FeatureProjection(dim=256, whiten=True)
+        for feat in batches:
+            projection.partial_fit(feat)
+        projection.finalize().save('exp/model/ckpt_epoch60_projection.npz')
+        query_feat = projection.transform(query_feat)
+    """
+    def __init__(self, dim=256, whiten=False, eps=1e-6):
+        self.dim = dim
+        self.whiten = whiten
+        self.eps = eps
+        self.count = 0
+        self.mean = None
+        self.scatter = None
+
+    def partial_fit(self, feat):
+        """
+        add a batch with shape [N, D] to the statistics, the centered scatter
+        matrices of the batches are merged by the pairwise update of Chan et al.
+        """
+        feat = np.asarray(feat, dtype=np.float64)
+        N = feat.shape[0]
+        if N == 0:
+            return self
+        mean = np.mean(feat, axis=0)
+        centered = feat - mean
+        scatter = np.matmul(centered.T, centered)
+        if self.count == 0:
+            self.mean = mean
+            self.scatter = scatter
+        else:
+            delta = mean - self.mean
+            total = self.count + N
+            self.scatter += scatter + np.outer(delta, delta) * (self.count * N / float(total))
+            self.mean += delta * (N / float(total))
+        self.count += N
+        return self
+
+    def finalize(self):
+        """ the eigen decomposition of the covariance, the statistics are released """
+        if self.count < 2:
+            print('At least two features are needed to fit the projection.')
+            raise ValueError
+        covariance = self.scatter / (self.count - 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1]
+        self.dim = min(self.dim, len(order))
+        self.eigenvalues = np.maximum(eigenvalues[order], 0)
+        self.components = eigenvectors[:, order[:self.dim]].astype(np.float32)
+        self.mean = self.mean.astype(np.float32)
+        self.scatter = None
+        return self
+
+    def explained_variance(self, dim=None):
+        """ the fraction of the variance kept by the first dim components """
+        if dim is None:
+            dim = self.dim
+        return np.sum(self.eigenvalues[:dim]) / max(np.sum(self.eigenvalues), np.finfo(np.float64).tiny)
+
+    def truncate(self, dim):
+        """ the projection to the first dim <= self.dim components """
+        assert dim <= self.dim
+        projection = FeatureProjection(dim, self.whiten, self.eps)
+        projection.count = self.count
+        projection.mean = self.mean
+        projection.eigenvalues = self.eigenvalues
+        projection.components = self.components[:, :dim]
+        return projection
+
+    def transform(self, feat, block_size=65536):
+        """
+        project the features block by block
+        Returns:
+            float32 ndarray with shape [N, dim]
+        """
+        N = feat.shape[0]
+        matrix = self.components
+        if self.whiten:
+            matrix = matrix / np.sqrt(self.eigenvalues[:self.dim] + self.eps).astype(np.float32)
+        output = np.zeros((N, self.dim), dtype=np.float32)
+        for start in range(0, N, block_size):
+            block = np.asarray(feat[start:start+block_size], dtype=np.float32)
+            output[start:start+block_size] = np.matmul(block - self.mean, matrix)
+        return output
+
+    def save(self, path):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        np.savez(path, dim=self.dim, whiten=self.whiten, eps=self.eps, count=self.count, \
+            mean=self.mean, eigenvalues=self.eigenvalues, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        projection = cls(int(data['dim']), bool(data['whiten']), float(data['eps']))
+        projection.count = int(data['count'])
+        projection.mean = data['mean']
+        projection.eigenvalues = data['eigenvalues']
+        projection.components = data['components']
+        return projection
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def top_neighbors(query_feat, gallery_feat, k=10, max_memory=2**28):
+    """
+    the k most similar gallery items of each query by the cosine similarity,
+    from the blocked matmul of compute_dist_blocks
+    Args:
+        query_feat: ndarray with shape [Q, D]
+        gallery_feat: ndarray with shape [G, D]
+    Returns:
+        index: int ndarray with shape [Q, k], sorted by the similarity
+        sim: float32 ndarray with shape [Q, k], the cosine similarity
+    """
+    from .evaluate import compute_dist_blocks
+    Q = query_feat.shape[0]
+    k = min(k, gallery_feat.shape[0])
+    index = np.zeros((Q, k), dtype=np.int64)
+    sim = np.zeros((Q, k), dtype=np.float32)
+    for start, end, dist in compute_dist_blocks(query_feat, gallery_feat, dist_type='cosine', \
+        max_memory=max_memory):
+        idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        neighbor_dist = np.take_along_axis(dist, idx, axis=1)
+        order = np.argsort(neighbor_dist, axis=1, kind='stable')
+        index[start:end] = np.take_along_axis(idx, order, axis=1)
+        # the distance is the negative cosine similarity
+        sim[start:end] = -np.take_along_axis(neighbor_dist, order, axis=1)
+    return index, sim
+
+
+def weighted_sum(feat, index, sim, alpha=3., block_size=4096):
+    """
+    sum of the L2 normalized rows feat[index] of each row, weighted by sim**alpha,
+    the negative similarities get no weight
+    Returns:
+        float32 ndarray with shape [N, D]
+    """
+    weight = np.power(np.maximum(sim, 0), alpha).astype(np.float32)
+    output = np.zeros((index.shape[0], feat.shape[1]), dtype=np.float32)
+    for start in range(0, index.shape[0], block_size):
+        end = min(start + block_size, index.shape[0])
+        output[start:end] = np.einsum('nk,nkd->nd', weight[start:end], feat[index[start:end]])
+    return output
+
+
+def _normalize_rows(feat):
+    feat = np.asarray(feat, dtype=np.float32)
+    return feat / np.linalg.norm(feat, ord=2, axis=1, keepdims=True)
+
+
+def database_augment(gallery_feat, k=10, alpha=3., max_memory=2**28):
+    """
+    database-side augmentation (DBA), each gallery item is replaced by the
+    weighted mean of its k nearest gallery items, itself included
+    Returns:
+        float32 ndarray with shape [G, D], L2 normalized
+    """
+    gallery_feat = _normalize_rows(gallery_feat)
+    index, sim = top_neighbors(gallery_feat, gallery_feat, k, max_memory)
+    return _normalize_rows(weighted_sum(gallery_feat, index, sim, alpha))
+
+
+def alpha_query_expansion(query_feat, gallery_feat, k=10, alpha=3., max_memory=2**28):
+    """
+    alpha-weighted query expansion (alpha-QE), each query is replaced by the
+    sum of itself and its k nearest gallery items weighted by sim**alpha,
+    alpha = 0 is the plain average query expansion
+    Returns:
+        float32 ndarray with shape [Q, D], L2 normalized
+    """
+    query_feat = _normalize_rows(query_feat)
+    gallery_feat = _normalize_rows(gallery_feat)
+    index, sim = top_neighbors(query_feat, gallery_feat, k, max_memory)
+    return _normalize_rows(query_feat + weighted_sum(gallery_feat, index, sim, alpha))
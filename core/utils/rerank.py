@@ -0,0 +1,781 @@
+import numpy as np
+
+
+class SparseRows(object):
+    """
+    Row-compressed sparse matrix, used for the k-reciprocal V in re-ranking
+    Args:
+        indptr: int ndarray with shape [num_rows+1]
+        indices: int ndarray, the columns of the non-zero entries
+        data: float32 ndarray, the values of the non-zero entries
+    """
+    def __init__(self, indptr, indices, data, num_cols):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.num_cols = num_cols
+
+    @property
+    def num_rows(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_coo(cls, rows, cols, vals, num_rows, num_cols):
+        """ build from (row, col, val) entries without duplicates """
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(num_rows + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_rows))
+        return cls(indptr, cols[order].astype(np.int64), \
+            vals[order].astype(np.float32), num_cols)
+
+    def gather(self, rows):
+        """
+        entries of the given rows
+        Returns:
+            pos, the position in rows of each entry
+            cols, vals
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        length = self.indptr[rows + 1] - self.indptr[rows]
+        pos = np.repeat(np.arange(len(rows)), length)
+        offset = np.repeat(self.indptr[rows] - np.cumsum(length) + length, length)
+        idx = offset + np.arange(len(pos))
+        return pos, self.indices[idx], self.data[idx]
+
+    def transpose(self):
+        rows = np.repeat(np.arange(self.num_rows), np.diff(self.indptr))
+        return SparseRows.from_coo(self.indices, rows, self.data, self.num_cols, self.num_rows)
+
+
+def _original_rows(q_g_dist, q_q_dist, g_g_dist, start, end):
+    """
+    rows [start, end) of the squared original_dist of re_ranking, before the
+    normalization, i.e. the columns of the concatenated [Q+G, Q+G] distance matrix
+    """
+    query_num = q_g_dist.shape[0]
+    parts = []
+    if start < query_num:
+        e = min(end, query_num)
+        parts.append(np.concatenate([q_q_dist[:, start:e].T, q_g_dist[start:e, :]], axis=1))
+    if end > query_num:
+        s = max(start, query_num) - query_num
+        e = end - query_num
+        parts.append(np.concatenate([q_g_dist[:, s:e].T, g_g_dist[:, s:e].T], axis=1))
+    dist = np.concatenate(parts, axis=0)
+    return np.power(dist, 2).astype(np.float32)
+
+
+def _original_pairs(q_g_dist, q_q_dist, g_g_dist, rows, cols):
+    """ original_dist[rows, cols] of re_ranking before the normalization """
+    query_num = q_g_dist.shape[0]
+    dist = np.zeros(len(rows))
+    qr = rows < query_num
+    qc = cols < query_num
+    m = qr & qc
+    dist[m] = q_q_dist[cols[m], rows[m]]
+    m = qr & ~qc
+    dist[m] = q_g_dist[rows[m], cols[m] - query_num]
+    m = ~qr & qc
+    dist[m] = q_g_dist[cols[m], rows[m] - query_num]
+    m = ~qr & ~qc
+    dist[m] = g_g_dist[cols[m] - query_num, rows[m] - query_num]
+    return np.power(dist, 2).astype(np.float32)
+
+
+def initial_rank(row_func, all_num, k, block_size=1024):
+    """
+    the k nearest neighbours of each row, by argpartition instead of a full argsort
+    Args:
+        row_func: row_func(start, end) returns rows [start, end) of the distance
+    Returns:
+        rank: int ndarray with shape [all_num, k], sorted by distance
+        row_max: float32 ndarray with shape [all_num], the maximal distance of each row
+    """
+    k = min(k, all_num)
+    rank = np.zeros((all_num, k), dtype=np.int64)
+    row_max = np.zeros(all_num, dtype=np.float32)
+    for start in range(0, all_num, block_size):
+        end = min(start + block_size, all_num)
+        dist = row_func(start, end)
+        row_max[start:end] = np.max(dist, axis=1)
+        dist = dist / row_max[start:end, np.newaxis]
+        idx = np.argpartition(dist, k-1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(dist, idx, axis=1), axis=1, kind='stable')
+        rank[start:end, :] = np.take_along_axis(idx, order, axis=1)
+    return rank, row_max
+
+
+def k_reciprocal_half(rank, k1):
+    """
+    membership mask of the round(k1/2)-reciprocal neighbours of every row
+    Returns:
+        bool ndarray with shape [all_num, round(k1/2)+1], aligned with rank
+    """
+    half = int(np.around(k1/2.)) + 1
+    forward = rank[:, :half]
+    backward = rank[forward, :half]
+    return np.any(backward == np.arange(rank.shape[0])[:, np.newaxis, np.newaxis], axis=2)
+
+
+def k_reciprocal_expansion(rank, rows, k1, half_mask):
+    """
+    k-reciprocal expansion sets of the given rows, the same rule as re_ranking
+    Returns:
+        pos, cols: one entry for each (position in rows, expansion index), no duplicates
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    half = half_mask.shape[1]
+    forward = rank[rows, :k1+1]
+    backward = rank[forward, :k1+1]
+    mask = np.any(backward == rows[:, np.newaxis, np.newaxis], axis=2)
+    # the half-size reciprocal sets of each candidate
+    cand = rank[forward, :half]
+    cand_mask = half_mask[forward]
+    inter = np.any((cand[..., np.newaxis] == forward[:, np.newaxis, np.newaxis, :]) & \
+        mask[:, np.newaxis, np.newaxis, :], axis=3)
+    inter = np.sum(inter & cand_mask, axis=2)
+    expand = mask & (inter > 2./3 * np.sum(cand_mask, axis=2))
+    cand_mask = cand_mask & expand[..., np.newaxis]
+    pos = np.concatenate([np.nonzero(mask)[0], np.nonzero(cand_mask)[0]])
+    cols = np.concatenate([forward[mask], cand[cand_mask]])
+    key = np.unique(pos * rank.shape[0] + cols)
+    return key // rank.shape[0], key % rank.shape[0]
+
+
+def k_reciprocal_V(rank, rows, k1, half_mask, pair_func, row_max, block_size=1024):
+    """
+    sparse rows of V in re_ranking for the given rows
+    Args:
+        pair_func: pair_func(rows, cols) returns the squared distance of each pair
+        row_max: the normalization of each row
+    Returns:
+        pos, cols, vals: the entries of V, pos is the position in rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    all_pos, all_cols, all_vals = [], [], []
+    for start in range(0, len(rows), block_size):
+        r = rows[start:start+block_size]
+        pos, cols = k_reciprocal_expansion(rank, r, k1, half_mask)
+        dist = pair_func(r[pos], cols) / row_max[r[pos]]
+        weight = np.exp(-dist)
+        norm = np.bincount(pos, weights=weight, minlength=len(r))
+        all_pos.append(pos + start)
+        all_cols.append(cols)
+        all_vals.append((weight / norm[pos]).astype(np.float32))
+    return np.concatenate(all_pos), np.concatenate(all_cols), np.concatenate(all_vals)
+
+
+def query_expansion_V(V, rank, rows, k2, block_size=1024):
+    """
+    the rows of V_qe in re_ranking, mean of the V rows of the k2 nearest neighbours
+    Returns:
+        pos, cols, vals: the entries of V_qe, pos is the position in rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    all_pos, all_cols, all_vals = [], [], []
+    for start in range(0, len(rows), block_size):
+        src = rank[rows[start:start+block_size], :k2].ravel()
+        pos, cols, vals = V.gather(src)
+        key, inverse = np.unique((pos // k2) * V.num_cols + cols, return_inverse=True)
+        vals = np.bincount(inverse.ravel(), weights=vals, minlength=len(key)) / k2
+        all_pos.append(key // V.num_cols + start)
+        all_cols.append(key % V.num_cols)
+        all_vals.append(vals.astype(np.float32))
+    return np.concatenate(all_pos), np.concatenate(all_cols), np.concatenate(all_vals)
+
+
+def jaccard_dist(V, V_col, rows, cols, block_size=256):
+    """
+    jaccard distance of re_ranking between the given rows and cols of V
+    Args:
+        V: SparseRows, V (or V_qe) of all the items
+        V_col: V.transpose(), the inverted index
+    Returns:
+        float32 ndarray with shape [len(rows), len(cols)]
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    num = V.num_rows
+    dist = np.zeros((len(rows), len(cols)), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        r = rows[start:start+block_size]
+        pos, k, val = V.gather(r)
+        idx, images, image_val = V_col.gather(k)
+        temp_min = np.bincount(pos[idx] * num + images, \
+            weights=np.minimum(val[idx], image_val), minlength=len(r) * num)
+        temp_min = temp_min.reshape((len(r), num))[:, cols].astype(np.float32)
+        dist[start:start+len(r), :] = 1 - temp_min / (2. - temp_min)
+    return dist
+
+
+def re_ranking_sparse(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3, block_size=1024, \
+    backend='numpy'):
+    """
+    k-reciprocal re-ranking with sparse per-row structures, the same result as
+    re_ranking within float tolerance, but without any dense [Q+G, Q+G] matrix
+    Args:
+        q_g_dist, q_q_dist, g_g_dist, k1, k2, lambda_value: the same as re_ranking
+        block_size: number of rows processed together
+        backend: 'numpy' or 'torch', the torch one finds the neighbours by
+            torch.topk and batched gathers, the sparse V is shared
+    Returns:
+        final_dist: float32 ndarray with shape [Q, G]
+    """
+    if backend == 'torch':
+        from .torch_backend import initial_rank_torch as rank_func
+        from .torch_backend import k_reciprocal_half_torch as half_func
+    else:
+        rank_func = initial_rank
+        half_func = k_reciprocal_half
+    query_num = q_g_dist.shape[0]
+    all_num = query_num + q_g_dist.shape[1]
+    row_func = lambda start, end: _original_rows(q_g_dist, q_q_dist, g_g_dist, start, end)
+    pair_func = lambda rows, cols: _original_pairs(q_g_dist, q_q_dist, g_g_dist, rows, cols)
+    rank, row_max = rank_func(row_func, all_num, max(k1+1, k2), block_size)
+    half_mask = half_func(rank, k1)
+    pos, cols, vals = k_reciprocal_V(rank, np.arange(all_num), k1, half_mask, \
+        pair_func, row_max, block_size)
+    V = SparseRows.from_coo(pos, cols, vals, all_num, all_num)
+    if k2 != 1:
+        pos, cols, vals = query_expansion_V(V, rank, np.arange(all_num), k2)
+        V = SparseRows.from_coo(pos, cols, vals, all_num, all_num)
+    jaccard = jaccard_dist(V, V.transpose(), np.arange(query_num), np.arange(query_num, all_num))
+    original_dist = np.power(q_g_dist, 2).astype(np.float32) / row_max[:query_num, np.newaxis]
+    return jaccard * (1 - lambda_value) + original_dist * lambda_value
+
+
+class GalleryGraph(object):
+    """
+    The query independent part of the k-reciprocal re-ranking of a gallery:
+    the top neighbours of each gallery item among the gallery, the
+    round(k1/2)-reciprocal masks, the sparse V rows and their query expansion.
+    It is built once per gallery feature set, so re-ranking a set of queries
+    only computes the rows of the queries. A query is re-ranked as if it alone
+    were added to the gallery: it enters the V rows of its reciprocal gallery
+    neighbours, but does not shift their other entries, so the result is
+    close to re_ranking_sparse but not the same.
+    Args:
+        k1, k2: the same as re_ranking
+    Usage example:
+        graph = GalleryGraph.build(g_g_dist, k1=20, k2=6)
+        graph.save('exp/feat_cache/<key>/graph.npz')
+        final_dist = graph.rerank(q_g_dist, lambda_value=0.3)
+    """
+    def __init__(self, k1=20, k2=6):
+        self.k1 = k1
+        self.k2 = k2
+
+    @classmethod
+    def build(cls, g_g_dist, k1=20, k2=6, block_size=1024, backend='numpy'):
+        """ build from the gallery distance g_g_dist with shape [G, G], see re_ranking_sparse """
+        if backend == 'torch':
+            from .torch_backend import initial_rank_torch as rank_func
+            from .torch_backend import k_reciprocal_half_torch as half_func
+        else:
+            rank_func = initial_rank
+            half_func = k_reciprocal_half
+        graph = cls(k1, k2)
+        G = g_g_dist.shape[0]
+        row_func = lambda start, end: np.power(g_g_dist[start:end], 2).astype(np.float32)
+        pair_func = lambda rows, cols: np.power(g_g_dist[rows, cols], 2).astype(np.float32)
+        graph.rank, graph.row_max = rank_func(row_func, G, max(k1+1, k2), block_size)
+        graph.half_mask = half_func(graph.rank, k1)
+        # a query enters the top k1+1 of a gallery item if it is closer than
+        # the k1-th neighbour of the item
+        rows = np.arange(G)
+        graph.bound = np.full(G, np.inf, dtype=np.float32)
+        if graph.rank.shape[1] > k1:
+            graph.bound = pair_func(rows, graph.rank[:, k1])
+        # and enters the query expansion of the item if closer than the k2-1-th one
+        graph.qe_bound = np.full(G, -np.inf, dtype=np.float32)
+        if k2 > 1 and graph.rank.shape[1] >= k2:
+            graph.qe_bound = pair_func(rows, graph.rank[:, k2-1])
+        pos, cols, vals = k_reciprocal_V(graph.rank, rows, k1, graph.half_mask, \
+            pair_func, graph.row_max, block_size)
+        # the sum of the weights of each V row, the weight of the item itself is 1
+        graph.norm = np.ones(G, dtype=np.float32)
+        graph.norm[pos[cols == pos]] = 1. / vals[cols == pos]
+        graph.V = SparseRows.from_coo(pos, cols, vals, G, G)
+        graph.V_qe = graph.V
+        if k2 != 1:
+            pos, cols, vals = query_expansion_V(graph.V, graph.rank, rows, k2)
+            graph.V_qe = SparseRows.from_coo(pos, cols, vals, G, G)
+        graph.index()
+        return graph
+
+    def index(self):
+        """ the inverted index of V_qe and the items using each V row in their query expansion """
+        G = self.rank.shape[0]
+        k2 = min(self.k2, self.rank.shape[1])
+        self.V_col = self.V_qe.transpose()
+        self.expanded_by = SparseRows.from_coo(self.rank[:, :k2].ravel(), np.repeat(np.arange(G), k2), \
+            np.ones(G * k2), G, G)
+
+    @property
+    def num_gallery(self):
+        return self.rank.shape[0]
+
+    def save(self, path):
+        np.savez(path, k1=self.k1, k2=self.k2, rank=self.rank, row_max=self.row_max, \
+            half_mask=self.half_mask, bound=self.bound, qe_bound=self.qe_bound, norm=self.norm, \
+            V_indptr=self.V.indptr, V_indices=self.V.indices, V_data=self.V.data, \
+            V_qe_indptr=self.V_qe.indptr, V_qe_indices=self.V_qe.indices, V_qe_data=self.V_qe.data)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        graph = cls(int(data['k1']), int(data['k2']))
+        for name in ['rank', 'row_max', 'half_mask', 'bound', 'qe_bound', 'norm']:
+            setattr(graph, name, data[name])
+        G = graph.rank.shape[0]
+        graph.V = SparseRows(data['V_indptr'], data['V_indices'], data['V_data'], G)
+        graph.V_qe = SparseRows(data['V_qe_indptr'], data['V_qe_indices'], data['V_qe_data'], G)
+        graph.index()
+        return graph
+
+    def query_V(self, q_g_square):
+        """
+        the V rows of a block of queries, and the entries of the queries in the
+        V rows of their reciprocal gallery neighbours
+        Args:
+            q_g_square: the squared distance with shape [B, G]
+        Returns:
+            V: SparseRows with shape [B, G+1], the column G is the query itself
+            q_pos, q_rows, q_vals: the entries V[q_rows, query q_pos]
+            nearest: the nearest gallery items of each query, sorted
+            row_max: the normalization of each query
+        """
+        B, G = q_g_square.shape
+        k1 = self.k1
+        row_max = np.max(q_g_square, axis=1)
+        m = min(max(k1, self.k2 - 1), G)
+        nearest = np.argpartition(q_g_square, m - 1, axis=1)[:, :m]
+        order = np.argsort(np.take_along_axis(q_g_square, nearest, axis=1), axis=1, kind='stable')
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        # the k1 nearest gallery items and whether the query is in their top k1+1
+        forward = nearest[:, :k1]
+        forward_square = np.take_along_axis(q_g_square, forward, axis=1)
+        mask = forward_square < self.bound[forward]
+        # the half-size reciprocal sets of each candidate, the same rule as
+        # k_reciprocal_expansion; the set of the query itself adds nothing new
+        half = self.half_mask.shape[1]
+        cand = self.rank[forward, :half]
+        cand_mask = self.half_mask[forward]
+        inter = np.any((cand[..., np.newaxis] == forward[:, np.newaxis, np.newaxis, :]) & \
+            mask[:, np.newaxis, np.newaxis, :], axis=3)
+        inter = np.sum(inter & cand_mask, axis=2)
+        expand = mask & (inter > 2./3 * np.sum(cand_mask, axis=2))
+        cand_mask = cand_mask & expand[..., np.newaxis]
+        pos = np.concatenate([np.arange(B), np.nonzero(mask)[0], np.nonzero(cand_mask)[0]])
+        cols = np.concatenate([np.full(B, G), forward[mask], cand[cand_mask]])
+        key = np.unique(pos * (G + 1) + cols)
+        pos, cols = key // (G + 1), key % (G + 1)
+        dist = np.zeros(len(pos), dtype=np.float32)
+        gallery = cols < G
+        dist[gallery] = q_g_square[pos[gallery], cols[gallery]] / row_max[pos[gallery]]
+        weight = np.exp(-dist)
+        vals = weight / np.bincount(pos, weights=weight, minlength=B)[pos]
+        V = SparseRows.from_coo(pos, cols, vals, B, G + 1)
+        # the query in the V rows of its reciprocal gallery neighbours, the
+        # other entries of the rows are kept
+        q_pos = np.nonzero(mask)[0]
+        q_rows = forward[mask]
+        weight = np.exp(-forward_square[mask] / np.maximum(self.row_max[q_rows], forward_square[mask]))
+        q_vals = (weight / (self.norm[q_rows] + weight)).astype(np.float32)
+        return V, q_pos, q_rows, q_vals, nearest, row_max
+
+    def query_expansion(self, V, q_pos, q_rows, q_vals, nearest, rows, cols):
+        """
+        the V_qe rows of the queries and of the gallery items cols, the mean of
+        the V rows of the k2 nearest items
+        Args:
+            V, q_pos, q_rows, q_vals, nearest: the same as query_V
+            rows, cols: the (query, gallery item) pairs, the gallery items the
+                query enters the k2 nearest of, whose V_qe rows are recomputed
+        Returns:
+            V_qe: SparseRows with shape [B, G+1]
+            g_pos, g_rows, g_vals: the entries V_qe[g_rows, query g_pos]
+            pair_V: SparseRows with shape [len(rows), G+1], the V_qe rows of the pairs
+        """
+        B, G = V.num_rows, V.num_cols - 1
+        k2 = min(self.k2, nearest.shape[1] + 1)
+        # the query itself and its k2-1 nearest gallery items
+        src = nearest[:, :k2-1]
+        qv = np.zeros((B, G), dtype=np.float32)
+        qv[q_pos, q_rows] = q_vals
+        pos, cols_qe, vals = V.gather(np.arange(B))
+        g_pos, g_cols, g_vals = self.V.gather(src.ravel())
+        pos = np.concatenate([pos, g_pos // max(k2 - 1, 1), np.arange(B)])
+        cols_qe = np.concatenate([cols_qe, g_cols, np.full(B, G)])
+        vals = np.concatenate([vals, g_vals, np.sum(np.take_along_axis(qv, src, axis=1), axis=1)])
+        key, inverse = np.unique(pos * (G + 1) + cols_qe, return_inverse=True)
+        vals = np.bincount(inverse.ravel(), weights=vals, minlength=len(key)) / k2
+        V_qe = SparseRows(np.searchsorted(key // (G + 1), np.arange(B + 1)), key % (G + 1), \
+            vals.astype(np.float32), G + 1)
+        # the query in the V_qe rows of the gallery
+        idx, g_rows, _ = self.expanded_by.gather(q_rows)
+        key, inverse = np.unique(q_pos[idx] * G + g_rows, return_inverse=True)
+        g_vals = np.bincount(inverse.ravel(), weights=q_vals[idx], minlength=len(key)) / k2
+        g_pos, g_rows = key // G, key % G
+        # the V_qe rows of the pairs, the V row of the query replaces the one of
+        # the k2-1-th neighbour of the gallery item
+        P = len(rows)
+        pos, pair_cols, vals = self.V_qe.gather(cols)
+        v_pos, v_cols, v_vals = V.gather(rows)
+        d_pos, d_cols, d_vals = self.V.gather(self.rank[cols, k2-1])
+        pos = np.concatenate([pos, v_pos, d_pos, np.arange(P)])
+        pair_cols = np.concatenate([pair_cols, v_cols, d_cols, np.full(P, G)])
+        vals = np.concatenate([vals, v_vals / k2, -d_vals / k2, qv[rows, cols] / k2])
+        key, inverse = np.unique(pos * (G + 1) + pair_cols, return_inverse=True)
+        vals = np.maximum(np.bincount(inverse.ravel(), weights=vals, minlength=len(key)), 0)
+        pair_V = SparseRows(np.searchsorted(key // (G + 1), np.arange(P + 1)), key % (G + 1), \
+            vals.astype(np.float32), G + 1)
+        return V_qe, g_pos, g_rows, g_vals.astype(np.float32), pair_V
+
+    def rerank(self, q_g_dist, lambda_value=0.3, block_size=256):
+        """
+        re-rank the queries against the gallery of the graph, an approximation
+        of re_ranking_sparse, see OnlineReranker for the exact one
+        Args:
+            q_g_dist: the distance with shape [Q, G]
+            lambda_value: the same as re_ranking
+        Returns:
+            final_dist: float32 ndarray with shape [Q, G]
+        """
+        Q, G = q_g_dist.shape
+        assert G == self.num_gallery
+        final_dist = np.zeros((Q, G), dtype=np.float32)
+        for start in range(0, Q, block_size):
+            end = min(start + block_size, Q)
+            B = end - start
+            square = np.power(q_g_dist[start:end], 2).astype(np.float32)
+            V, q_pos, q_rows, q_vals, nearest, row_max = self.query_V(square)
+            # the gallery items whose k2 nearest the query enters
+            pairs = np.take_along_axis(square, nearest, axis=1) < self.qe_bound[nearest]
+            rows, cols = np.nonzero(pairs)[0], nearest[pairs]
+            if self.k2 == 1:
+                V_qe, g_pos, g_rows, g_vals = V, q_pos, q_rows, q_vals
+                pair_V = None
+            else:
+                V_qe, g_pos, g_rows, g_vals, pair_V = self.query_expansion(V, q_pos, q_rows, \
+                    q_vals, nearest, rows, cols)
+            pos, cols_qe, vals = V_qe.gather(np.arange(B))
+            # the query column against the query entries of the gallery rows
+            self_val = np.zeros(B, dtype=np.float32)
+            self_val[pos[cols_qe == G]] = vals[cols_qe == G]
+            temp_min = np.bincount(g_pos * G + g_rows, weights=np.minimum(self_val[g_pos], g_vals), \
+                minlength=B * G)
+            gallery = cols_qe < G
+            pos, cols_qe, vals = pos[gallery], cols_qe[gallery], vals[gallery]
+            idx, images, image_val = self.V_col.gather(cols_qe)
+            temp_min += np.bincount(pos[idx] * G + images, \
+                weights=np.minimum(vals[idx], image_val), minlength=B * G)
+            if pair_V is not None and len(rows) > 0:
+                # the recomputed V_qe rows of the pairs
+                p_pos, p_cols, p_vals = pair_V.gather(np.arange(len(rows)))
+                q_pos_, q_cols, q_vals_ = V_qe.gather(rows)
+                _, i1, i2 = np.intersect1d(p_pos * (G + 1) + p_cols, q_pos_ * (G + 1) + q_cols, \
+                    assume_unique=True, return_indices=True)
+                temp_min[rows * G + cols] = np.bincount(p_pos[i1], \
+                    weights=np.minimum(p_vals[i1], q_vals_[i2]), minlength=len(rows))
+            temp_min = temp_min.reshape((B, G)).astype(np.float32)
+            jaccard = 1 - temp_min / (2. - temp_min)
+            final_dist[start:end] = jaccard * (1 - lambda_value) + \
+                square / row_max[:, np.newaxis] * lambda_value
+        return final_dist
+
+
+class PaddedRows(object):
+    """
+    Mutable row-major sparse matrix, the entries of each row are padded to a
+    common capacity, so that single rows can be replaced in place; the same
+    gather interface as SparseRows
+    Args:
+        num_cols: number of columns, can grow
+        capacity: number of entries of each row, grows when needed
+    """
+    def __init__(self, num_cols, capacity=32):
+        self.num_cols = num_cols
+        self.num_rows = 0
+        self.cols = np.full((0, capacity), -1, dtype=np.int64)
+        self.vals = np.zeros((0, capacity), dtype=np.float32)
+
+    @classmethod
+    def from_sparse(cls, V):
+        rows = cls(V.num_cols, max(1, int(np.max(np.diff(V.indptr)))))
+        rows.resize(V.num_rows)
+        pos, cols, vals = V.gather(np.arange(V.num_rows))
+        rows.set_rows(np.arange(V.num_rows), pos, cols, vals)
+        return rows
+
+    def resize(self, num_rows):
+        """ append empty rows up to num_rows, the storage is doubled when grown """
+        n = max(num_rows, 2 * self.cols.shape[0]) - self.cols.shape[0]
+        if num_rows > self.cols.shape[0]:
+            self.cols = np.concatenate([self.cols, np.full((n, self.cols.shape[1]), -1, dtype=np.int64)])
+            self.vals = np.concatenate([self.vals, np.zeros((n, self.vals.shape[1]), dtype=np.float32)])
+        self.num_rows = max(self.num_rows, num_rows)
+
+    def set_rows(self, rows, pos, cols, vals):
+        """ replace the given rows by the entries (position in rows, col, val) """
+        count = np.bincount(pos, minlength=len(rows))
+        capacity = self.cols.shape[1]
+        if len(count) > 0 and np.max(count) > capacity:
+            n = max(int(np.max(count)), 2 * capacity) - capacity
+            rows_alloc = self.cols.shape[0]
+            self.cols = np.concatenate([self.cols, np.full((rows_alloc, n), -1, dtype=np.int64)], axis=1)
+            self.vals = np.concatenate([self.vals, np.zeros((rows_alloc, n), dtype=np.float32)], axis=1)
+        self.cols[rows] = -1
+        self.vals[rows] = 0
+        order = np.argsort(pos, kind='stable')
+        pos, cols, vals = pos[order], cols[order], vals[order]
+        slot = np.arange(len(pos)) - np.repeat(np.cumsum(count) - count, count)
+        self.cols[rows[pos], slot] = cols
+        self.vals[rows[pos], slot] = vals
+
+    def gather(self, rows):
+        """ the same as SparseRows.gather """
+        cols = self.cols[rows]
+        mask = cols >= 0
+        return np.nonzero(mask)[0], cols[mask], self.vals[rows][mask]
+
+
+def _grow(array, num_rows, num_cols=None):
+    """ array with the capacity of at least num_rows (and num_cols), doubled when grown """
+    shape = list(array.shape)
+    if shape[0] < num_rows:
+        shape[0] = max(num_rows, 2 * shape[0])
+    if num_cols is not None and shape[1] < num_cols:
+        shape[1] = max(num_cols, 2 * shape[1])
+    if shape == list(array.shape):
+        return array
+    grown = np.zeros(shape, dtype=array.dtype)
+    grown[tuple(slice(0, s) for s in array.shape)] = array
+    return grown
+
+
+class OnlineReranker(object):
+    """
+    Incremental k-reciprocal re-ranking of streaming queries against a fixed
+    gallery. The k-reciprocal structures of the gallery are taken from a
+    GalleryGraph, and each new query updates them as re_ranking would: it is
+    inserted into the top neighbours of the items it is close to, and only
+    the rank, the reciprocal masks, the V and V_qe rows and the jaccard
+    numerators depending on the changed rows are recomputed. A query costs
+    its own rows and the changed neighbourhoods around it, so the latency is
+    milliseconds, and once all the queries are fed in, dist() is the same as
+    re_ranking_sparse of all of them within float tolerance.
+    Args:
+        g_g_dist: the gallery distance with shape [G, G]
+        k1, k2, lambda_value: the same as re_ranking
+        graph: the GalleryGraph of g_g_dist with the same k1 and k2, built if None
+    Usage example:
+        online = OnlineReranker(g_g_dist, graph=graph)
+        for q_g_dist, q_q_dist in stream:
+            dist = online.add(q_g_dist, q_q_dist)
+        final_dist = online.dist()
+    """
+    def __init__(self, g_g_dist, k1=20, k2=6, lambda_value=0.3, graph=None):
+        if graph is None:
+            graph = GalleryGraph.build(g_g_dist, k1, k2)
+        assert graph.k1 == k1 and graph.k2 == k2
+        G = g_g_dist.shape[0]
+        if G < max(k1+1, k2):
+            print('The gallery of %d items is smaller than the neighbours of re-ranking.' % (G))
+            raise ValueError
+        self.k1 = k1
+        self.k2 = k2
+        self.lambda_value = lambda_value
+        self.g_g_dist = g_g_dist
+        self.num_gallery = G
+        self.num_query = 0
+        # the items are indexed as [gallery, queries]
+        self.q_g_dist = np.zeros((0, G), dtype=g_g_dist.dtype)
+        self.q_q_dist = np.zeros((0, 0), dtype=g_g_dist.dtype)
+        self.rank = graph.rank.copy()
+        self.rank_square = self.pair(np.repeat(np.arange(G), self.rank.shape[1]), \
+            self.rank.ravel()).reshape(self.rank.shape)
+        self.row_max = graph.row_max.copy()
+        self.half_mask = graph.half_mask.copy()
+        self.V = PaddedRows.from_sparse(graph.V)
+        self.V_qe = self.V if k2 == 1 else PaddedRows.from_sparse(graph.V_qe)
+        # the jaccard numerators of the queries and the stale ones
+        self.numerator = np.zeros((0, G), dtype=np.float32)
+        self.stale_rows = set()
+        self.stale_cols = set()
+
+    @property
+    def num_all(self):
+        return self.num_gallery + self.num_query
+
+    def pair(self, rows, cols):
+        """ the squared distance of the (row, col) items, the same as _original_pairs """
+        G = self.num_gallery
+        dist = np.zeros(len(rows))
+        qr = rows >= G
+        qc = cols >= G
+        m = ~qr & ~qc
+        dist[m] = self.g_g_dist[rows[m], cols[m]]
+        m = qr & ~qc
+        dist[m] = self.q_g_dist[rows[m] - G, cols[m]]
+        m = ~qr & qc
+        dist[m] = self.q_g_dist[cols[m] - G, rows[m]]
+        m = qr & qc
+        dist[m] = self.q_q_dist[rows[m] - G, cols[m] - G]
+        return np.power(dist, 2).astype(np.float32)
+
+    def insert(self, square):
+        """
+        insert a new item with the squared distance square to all the items,
+        itself the last one, into the top neighbours and the row maxima
+        Returns:
+            position: int ndarray, the position of the new item in each rank
+                row, the rank width if not inserted, 0 for the new row itself
+            grown: bool ndarray, whether the row maximum is changed
+        """
+        n = self.num_all - 1
+        K = self.rank.shape[1]
+        old = square[:n]
+        grown = np.append(old > self.row_max, True)
+        self.row_max = np.append(np.maximum(self.row_max, old), np.max(square))
+        # the rank row of the new item, the same as initial_rank
+        idx = np.argpartition(square, K-1)[:K]
+        order = np.argsort(square[idx], kind='stable')
+        position = np.full(n + 1, K, dtype=np.int64)
+        position[n] = 0
+        rows = np.nonzero(old < self.rank_square[:, K-1])[0]
+        position[rows] = np.sum(self.rank_square[rows] <= old[rows, np.newaxis], axis=1)
+        slot = np.arange(K)[np.newaxis, :]
+        src = np.where(slot < position[rows, np.newaxis], slot, slot - 1)
+        rank = np.take_along_axis(self.rank[rows], src, axis=1)
+        rank_square = np.take_along_axis(self.rank_square[rows], src, axis=1)
+        rank[slot == position[rows, np.newaxis]] = n
+        rank_square[slot == position[rows, np.newaxis]] = old[rows]
+        self.rank[rows] = rank
+        self.rank_square[rows] = rank_square
+        self.rank = np.concatenate([self.rank, idx[order][np.newaxis]])
+        self.rank_square = np.concatenate([self.rank_square, square[idx[order]][np.newaxis]])
+        return position, grown
+
+    def update(self, position, grown):
+        """
+        recompute the reciprocal masks, V and V_qe rows depending on the
+        changed rank rows
+        Returns:
+            the rows of the changed V_qe
+        """
+        k1, k2 = self.k1, self.k2
+        half = self.half_mask.shape[1]
+        self.half_mask = np.concatenate([self.half_mask, np.zeros((1, half), dtype=bool)])
+        changed = position < half
+        rows = np.nonzero(changed | np.any(changed[self.rank[:, :half]], axis=1))[0]
+        half_mask = np.any(self.rank[self.rank[rows, :half], :half] == rows[:, np.newaxis, np.newaxis], axis=2)
+        changed = changed.copy()
+        changed[rows] |= np.any(half_mask != self.half_mask[rows], axis=1)
+        self.half_mask[rows] = half_mask
+        # V depends on the top k1+1 of the row, their top k1+1 and their masks
+        changed |= position < k1 + 1
+        dirty = grown | (position < k1 + 1) | np.any(changed[self.rank[:, :k1+1]], axis=1)
+        rows = np.nonzero(dirty)[0]
+        self.V.resize(self.num_all)
+        self.V.num_cols = self.num_all
+        capacity = self.V.cols.shape[1]
+        old_cols, old_vals = self.V.cols[rows], self.V.vals[rows]
+        pos, cols, vals = k_reciprocal_V(self.rank, rows, k1, self.half_mask, self.pair, self.row_max)
+        self.V.set_rows(rows, pos, cols, vals)
+        if k2 == 1:
+            return rows
+        # V_qe depends on the V rows of the top k2, only the rows actually changed
+        # are propagated
+        dirty[rows] = np.any(self.V.cols[rows, :capacity] != old_cols, axis=1) | \
+            np.any(self.V.vals[rows, :capacity] != old_vals, axis=1) | \
+            np.any(self.V.cols[rows, capacity:] >= 0, axis=1)
+        dirty = (position < k2) | np.any(dirty[self.rank[:, :k2]], axis=1)
+        rows = np.nonzero(dirty)[0]
+        self.V_qe.resize(self.num_all)
+        self.V_qe.num_cols = self.num_all
+        pos, cols, vals = query_expansion_V(self.V, self.rank, rows, k2)
+        self.V_qe.set_rows(rows, pos, cols, vals)
+        return rows
+
+    def jaccard_numerator(self, rows, cols, block_size=256):
+        """
+        sum of the min of the V_qe entries of the items rows and cols, a few
+        rows against the padded rows of cols, or by the inverted index of cols
+        Returns:
+            float32 ndarray with shape [len(rows), len(cols)]
+        """
+        numerator = np.zeros((len(rows), len(cols)), dtype=np.float32)
+        if len(rows) <= 16:
+            other_cols = self.V_qe.cols[cols]
+            other_vals = self.V_qe.vals[cols]
+            dense = np.zeros(self.num_all + 1, dtype=np.float32)
+            for i, row in enumerate(rows):
+                _, c, v = self.V_qe.gather(np.array([row]))
+                dense[c] = v
+                # the padding -1 is the last zero entry of dense
+                numerator[i] = np.sum(np.minimum(dense[other_cols], other_vals), axis=1)
+                dense[c] = 0
+            return numerator
+        pos, c, v = self.V_qe.gather(cols)
+        V_col = SparseRows.from_coo(c, pos, v, self.num_all, len(cols))
+        for start in range(0, len(rows), block_size):
+            r = rows[start:start+block_size]
+            pos, c, v = self.V_qe.gather(r)
+            idx, images, image_val = V_col.gather(c)
+            numerator[start:start+len(r)] = np.bincount(pos[idx] * len(cols) + images, \
+                weights=np.minimum(v[idx], image_val), minlength=len(r) * len(cols)).reshape((len(r), len(cols)))
+        return numerator
+
+    def add(self, q_g_dist, q_q_dist):
+        """
+        feed a block of new queries
+        Args:
+            q_g_dist: the distance of the new queries with shape [B, G]
+            q_q_dist: the distance of the new queries to all the queries so
+                far, the new ones included, with shape [B, Q+B]
+        Returns:
+            float32 ndarray with shape [B, G], the re-ranked distance of the
+            new queries given the queries so far
+        """
+        B, G = q_g_dist.shape
+        start = self.num_query
+        for b in range(B):
+            Q = self.num_query + 1
+            self.q_g_dist = _grow(self.q_g_dist, Q)
+            self.q_g_dist[Q-1] = q_g_dist[b]
+            self.q_q_dist = _grow(self.q_q_dist, Q, Q)
+            self.q_q_dist[Q-1, :Q] = q_q_dist[b, :Q]
+            self.q_q_dist[:Q, Q-1] = q_q_dist[b, :Q]
+            self.numerator = _grow(self.numerator, Q)
+            self.num_query = Q
+            square = np.concatenate([np.power(q_g_dist[b], 2), np.power(q_q_dist[b, :Q], 2)]).astype(np.float32)
+            position, grown = self.insert(square)
+            rows = self.update(position, grown)
+            self.stale_rows.update((rows[rows >= G] - G).tolist())
+            self.stale_cols.update(rows[rows < G].tolist())
+        return self.dist(np.arange(start, self.num_query))
+
+    def dist(self, queries=None):
+        """
+        the re-ranked distance of the queries, all of them by default, the
+        stale jaccard numerators are recomputed first
+        Returns:
+            float32 ndarray with shape [len(queries), G]
+        """
+        G = self.num_gallery
+        if queries is None:
+            queries = np.arange(self.num_query)
+            if len(self.stale_cols) > 0:
+                cols = np.array(sorted(self.stale_cols))
+                self.numerator[:self.num_query, cols] = \
+                    self.jaccard_numerator(cols, np.arange(self.num_query) + G).T
+                self.stale_cols = set()
+        refresh = np.array(sorted(set(queries.tolist()) & self.stale_rows | \
+            (set(queries.tolist()) if len(self.stale_cols) > 0 else set())), dtype=np.int64)
+        if len(refresh) > 0:
+            self.numerator[refresh] = self.jaccard_numerator(refresh + G, np.arange(G))
+            self.stale_rows -= set(refresh.tolist())
+        numerator = self.numerator[queries]
+        jaccard = 1 - numerator / (2. - numerator)
+        original_dist = np.power(self.q_g_dist[queries], 2) / self.row_max[queries + G, np.newaxis]
+        return (jaccard * (1 - self.lambda_value) + original_dist * self.lambda_value).astype(np.float32)
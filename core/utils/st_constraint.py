@@ -0,0 +1,136 @@
+import numpy as np
+
+
+class SpatioTemporalConstraint(object):
+    """
+    Spatio-temporal pruning of the gallery candidates of each query, by the
+    camera and the frame of the images.
+    A gallery item is feasible for a query if (query cam, gallery cam) is an
+    allowed camera transition and the frame gap, gallery frame - query frame,
+    is inside the window of the camera pair.
+    Args:
+        cam_pairs: the whitelist of (query cam, gallery cam) transitions,
+            None to allow all the transitions
+        frame_windows: dict, frame_windows[(query cam, gallery cam)] = (low, high),
+            the inclusive frame gap window of the camera pair
+        default_window: (low, high) of the pairs not in frame_windows, None for
+            no frame constraint
+        bucket_size: number of frames in a time bucket, the queries of the same
+            (cam, time bucket) share one candidate set
+    Usage example:
+        constraint = SpatioTemporalConstraint(cam_pairs=[(1, 2), (2, 1)],
+            default_window=(-3000, 3000))
+        constraint.fit(gallery_cam, gallery_frame)
+        for query_idx, cand_idx, mask in constraint.groups(query_cam, query_frame):
+            # mask[i, j], whether cand_idx[j] is feasible for query_idx[i]
+            ...
+        print(constraint.prune_ratio())
+    """
+    def __init__(self, cam_pairs=None, frame_windows=None, default_window=None, bucket_size=1000):
+        self.cam_pairs = None if cam_pairs is None else set([tuple(p) for p in cam_pairs])
+        self.frame_windows = dict() if frame_windows is None else dict(frame_windows)
+        self.default_window = default_window
+        self.bucket_size = bucket_size
+        self.reset()
+
+    def reset(self):
+        """ clear the fitted gallery, the candidate sets and the counters """
+        self.cams = []
+        self.sorted_frame = dict()
+        self.sorted_index = dict()
+        self.candidates = dict()
+        self.num_gallery = 0
+        self.total_pairs = 0
+        self.computed_pairs = 0
+        self.feasible_pairs = 0
+
+    def fit(self, gallery_cam, gallery_frame):
+        """ index the gallery by camera, each sorted by frame """
+        self.reset()
+        gallery_cam = np.asarray(gallery_cam).reshape(-1)
+        gallery_frame = np.asarray(gallery_frame, dtype=np.int64).reshape(-1)
+        self.num_gallery = len(gallery_cam)
+        self.gallery_cam = gallery_cam
+        self.gallery_frame = gallery_frame
+        self.cams = np.unique(gallery_cam)
+        for cam in self.cams:
+            index = np.nonzero(gallery_cam == cam)[0]
+            order = np.argsort(gallery_frame[index], kind='stable')
+            self.sorted_index[cam] = index[order]
+            self.sorted_frame[cam] = gallery_frame[index[order]]
+        return self
+
+    def allowed(self, query_cam, gallery_cam):
+        return self.cam_pairs is None or (query_cam, gallery_cam) in self.cam_pairs
+
+    def window(self, query_cam, gallery_cam):
+        """ (low, high) frame gap of the camera pair, None if unconstrained """
+        if (query_cam, gallery_cam) in self.frame_windows:
+            return self.frame_windows[(query_cam, gallery_cam)]
+        return self.default_window
+
+    def candidate_set(self, query_cam, bucket):
+        """
+        the gallery items feasible for any query of (query_cam, bucket)
+        Returns:
+            cand_idx: int ndarray, the gallery indices
+            low, high: int ndarray, the frame gap window of each candidate
+        """
+        key = (query_cam, bucket)
+        if key in self.candidates:
+            return self.candidates[key]
+        first = bucket * self.bucket_size
+        last = first + self.bucket_size - 1
+        cand_idx, low, high = [], [], []
+        for cam in self.cams:
+            if not self.allowed(query_cam, cam):
+                continue
+            window = self.window(query_cam, cam)
+            if window is None:
+                start, end = 0, len(self.sorted_index[cam])
+                window = (np.iinfo(np.int64).min // 2, np.iinfo(np.int64).max // 2)
+            else:
+                start = np.searchsorted(self.sorted_frame[cam], first + window[0], side='left')
+                end = np.searchsorted(self.sorted_frame[cam], last + window[1], side='right')
+            cand_idx.append(self.sorted_index[cam][start:end])
+            low.append(np.zeros(end - start, dtype=np.int64) + window[0])
+            high.append(np.zeros(end - start, dtype=np.int64) + window[1])
+        if len(cand_idx) == 0:
+            entry = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        else:
+            entry = (np.concatenate(cand_idx), np.concatenate(low), np.concatenate(high))
+        self.candidates[key] = entry
+        return entry
+
+    def groups(self, query_cam, query_frame):
+        """
+        group the queries by (cam, time bucket)
+        Yields:
+            query_idx: int ndarray, the queries of the group
+            cand_idx: int ndarray, the candidate gallery items of the group
+            mask: bool ndarray with shape [len(query_idx), len(cand_idx)], the
+                exact feasibility of each (query, candidate) pair
+        """
+        query_cam = np.asarray(query_cam).reshape(-1)
+        query_frame = np.asarray(query_frame, dtype=np.int64).reshape(-1)
+        bucket = query_frame // self.bucket_size
+        self.total_pairs += len(query_cam) * self.num_gallery
+        _, inverse = np.unique(np.stack([query_cam, bucket], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.nonzero(np.diff(np.concatenate([[-1], inverse[order]])))[0]
+        ends = np.append(starts[1:], len(order))
+        for start, end in zip(starts, ends):
+            query_idx = order[start:end]
+            cand_idx, low, high = self.candidate_set(query_cam[query_idx[0]], bucket[query_idx[0]])
+            gap = self.gallery_frame[cand_idx][np.newaxis, :] - query_frame[query_idx][:, np.newaxis]
+            mask = (gap >= low[np.newaxis, :]) & (gap <= high[np.newaxis, :])
+            self.computed_pairs += mask.size
+            self.feasible_pairs += np.count_nonzero(mask)
+            yield query_idx, cand_idx, mask
+
+    def prune_ratio(self):
+        """ the fraction of the (query, gallery) distances which are not computed """
+        if self.total_pairs == 0:
+            return 0.
+        return 1. - self.computed_pairs / float(self.total_pairs)
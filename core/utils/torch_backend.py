@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+from .euclidean import euclidean_from_product
+
+
+def set_threads(num_threads=None):
+    """ set the intra-op threads of torch, keep the torch default if None """
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def _tensor(array):
+    """ float32 cpu tensor sharing the memory of array when possible """
+    return torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32))
+
+
+def compute_dist_torch(array1, array2, dist_type='euclidean_normL2', A=None, verbose=False):
+    """
+    compute_dist with float32 torch cpu tensors
+    Args:
+        the same as compute_dist
+    Returns:
+        float32 numpy array with shape [m1, m2]
+    """
+    assert dist_type in ['cosine', 'euclidean', 'mahalanobis', 'euclidean_normL2']
+    assert len(array1.shape) == 2 and len(array2.shape) == 2
+    assert array1.shape[1] == array2.shape[1]
+    if verbose:
+        print('compute %s distance between matrix [%d, %d] and [%d, %d] with torch' \
+            %(dist_type, array1.shape[0], array1.shape[1], array2.shape[0], array2.shape[1]))
+    x = _tensor(array1)
+    y = _tensor(array2)
+    with torch.no_grad():
+        if dist_type in ['cosine', 'euclidean_normL2']:
+            x = x / torch.norm(x, p=2, dim=1, keepdim=True)
+            y = y / torch.norm(y, p=2, dim=1, keepdim=True)
+        if dist_type == 'cosine':
+            # we use negative cosine similarity as distance
+            return torch.mm(x, y.t()).neg_().numpy()
+        if dist_type == 'mahalanobis':
+            assert A is not None
+            A = _tensor(A)
+            square1 = torch.sum(torch.mm(x, A) * x, dim=1, keepdim=True)
+            tmp = torch.mm(y, A)
+            square2 = torch.sum(tmp * y, dim=1).unsqueeze(0)
+            dist = torch.mm(x, tmp.t())
+        else:
+            square1 = torch.sum(x * x, dim=1, keepdim=True)
+            square2 = torch.sum(y * y, dim=1).unsqueeze(0)
+            dist = torch.mm(x, y.t())
+        return euclidean_from_product(dist.numpy(), square1.numpy(), square2.numpy())
+
+
+def matmul_torch(array1, array2):
+    """ float32 array1 * array2 by torch.mm, returns a numpy array """
+    with torch.no_grad():
+        return torch.mm(_tensor(array1), _tensor(array2)).numpy()
+
+
+def argsort_torch(dist):
+    """
+    stable argsort of each row, the rows are sorted in parallel by the
+    intra-op threads
+    """
+    with torch.no_grad():
+        return torch.sort(_tensor(dist), dim=1, stable=True)[1].numpy()
+
+
+def topk_torch(dist, k):
+    """
+    the k smallest entries of each row, sorted by distance
+    Returns:
+        int ndarray with shape [B, k]
+    """
+    with torch.no_grad():
+        return torch.topk(_tensor(dist), k, dim=1, largest=False, sorted=True)[1].numpy()
+
+
+def initial_rank_torch(row_func, all_num, k, block_size=1024):
+    """
+    initial_rank of rerank.py by torch.topk over row blocks
+    Args:
+        the same as rerank.initial_rank
+    Returns:
+        rank: int ndarray with shape [all_num, k], sorted by distance
+        row_max: float32 ndarray with shape [all_num]
+    """
+    k = min(k, all_num)
+    rank = np.zeros((all_num, k), dtype=np.int64)
+    row_max = np.zeros(all_num, dtype=np.float32)
+    with torch.no_grad():
+        for start in range(0, all_num, block_size):
+            end = min(start + block_size, all_num)
+            dist = _tensor(row_func(start, end))
+            dist_max = torch.max(dist, dim=1, keepdim=True)[0]
+            row_max[start:end] = dist_max.squeeze(1).numpy()
+            dist = dist / dist_max
+            rank[start:end, :] = torch.topk(dist, k, dim=1, largest=False, sorted=True)[1].numpy()
+    return rank, row_max
+
+
+def k_reciprocal_half_torch(rank, k1):
+    """ k_reciprocal_half of rerank.py with batched torch gathers """
+    half = int(np.around(k1/2.)) + 1
+    with torch.no_grad():
+        rank = torch.from_numpy(rank)
+        forward = rank[:, :half]
+        backward = rank[forward.reshape(-1), :half].reshape((rank.shape[0], half, half))
+        rows = torch.arange(rank.shape[0]).reshape((-1, 1, 1))
+        return (backward == rows).any(dim=2).numpy()
@@ -0,0 +1,72 @@
+import sys
+import os
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.getcwd())
+
+from core.utils.evaluate import compute_dist, compute_score
+from core.utils.rerank import re_ranking_sparse
+from core.utils.torch_backend import set_threads
+
+# check the parity of the numpy and torch evaluation backends and time them
+# on synthetic features of market1501 size, such as
+# python script/experiment/benchmark_eval_backend.py --torch_threads 8
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_query', type=int, default=3368)
+parser.add_argument('--num_gallery', type=int, default=15913)
+parser.add_argument('--num_pid', type=int, default=751)
+parser.add_argument('--num_cam', type=int, default=6)
+parser.add_argument('--feat_dim', type=int, default=2048)
+parser.add_argument('--noise', type=float, default=4.)
+parser.add_argument('--torch_threads', type=int, default=0)
+parser.add_argument('--rerank', type=int, default=0) # number of queries to re-rank, 0 to skip
+args = parser.parse_args()
+
+np.random.seed(0)
+set_threads(args.torch_threads)
+center = np.random.randn(args.num_pid, args.feat_dim)
+gallery_pid = np.random.randint(-1, args.num_pid, (1, args.num_gallery))
+gallery_cam = np.random.randint(0, args.num_cam, (1, args.num_gallery))
+# every query has a true match in another camera, as in market1501
+src = np.random.choice(np.nonzero(gallery_pid[0, :] >= 0)[0], args.num_query)
+query_pid = gallery_pid[:, src]
+query_cam = (gallery_cam[:, src] + 1) % args.num_cam
+query_feat = center[query_pid[0, :]] + args.noise * np.random.randn(args.num_query, args.feat_dim)
+gallery_feat = center[np.maximum(gallery_pid[0, :], 0)] + args.noise * np.random.randn(args.num_gallery, args.feat_dim)
+
+def evaluate(backend):
+    kwargs = dict(eval_backend=backend)
+    t0 = time.time()
+    dist_mat = compute_dist(query_feat, gallery_feat, verbose=True, backend=backend)
+    t1 = time.time()
+    mAP, CMC = compute_score(dist_mat, query_pid, query_cam, gallery_pid, gallery_cam, **kwargs)
+    t2 = time.time()
+    print('%s: distance %.2fs, score %.2fs, mAP %.4f, top1 %.4f' \
+        %(backend, t1 - t0, t2 - t1, mAP, CMC[0, 0]))
+    result = dict(dist=t1 - t0, score=t2 - t1, mAP=mAP, CMC=CMC)
+    if args.rerank > 0:
+        Q = args.rerank
+        t0 = time.time()
+        q_q_dist = compute_dist(query_feat[:Q], query_feat[:Q], backend=backend)
+        g_g_dist = compute_dist(gallery_feat, gallery_feat, backend=backend)
+        rerank_dist = re_ranking_sparse(dist_mat[:Q], q_q_dist, g_g_dist, backend=backend)
+        result['rerank'] = time.time() - t0
+        result['rerank_mAP'], _ = compute_score(rerank_dist, query_pid[:, :Q], \
+            query_cam[:, :Q], gallery_pid, gallery_cam, **kwargs)
+        print('%s: rerank %.2fs, mAP %.4f' %(backend, result['rerank'], result['rerank_mAP']))
+    return result
+
+ref = evaluate('numpy')
+res = evaluate('torch')
+print('speedup: distance %.1fx, score %.1fx' \
+    %(ref['dist'] / res['dist'], ref['score'] / res['score']))
+# float32 only changes the order of the near ties
+assert abs(ref['mAP'] - res['mAP']) < 1e-3
+assert np.max(np.abs(ref['CMC'] - res['CMC'])) < 1e-3
+if args.rerank > 0:
+    print('speedup: rerank %.1fx' %(ref['rerank'] / res['rerank']))
+    assert abs(ref['rerank_mAP'] - res['rerank_mAP']) < 1e-3
+print('numpy and torch backends agree.')
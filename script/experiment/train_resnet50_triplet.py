@@ -23,6 +23,7 @@ from core.model.Res50BaseModel import Res50Model
 from core.model.Res50BaseModel import Res50ExtractFeature 
 from core.loss.triplet import TripletLoss
 from core.utils.evaluate import reid_evaluate
+from core.utils.evaluate import load_or_fit_projection, reid_evaluate_projection_sweep
 from core.utils.utils import str2bool
 from core.utils.utils import set_seed 
 from core.utils.utils import transfer_optim_state
@@ -51,6 +52,12 @@ class Config(object):
                             choices=['trainval', 'train'])
         parser.add_argument('--test_split', type=str, default='test')
         parser.add_argument('--rerank', type=str2bool, default=False)
+        parser.add_argument('--rerank_graph', type=str2bool, default=False)
+        parser.add_argument('--rerank_online', type=int, default=0) # queries fed at a time, 0 for the batch re-ranking
+        parser.add_argument('--qe', type=str2bool, default=False)
+        parser.add_argument('--qe_k', type=int, default=10)
+        parser.add_argument('--qe_alpha', type=float, default=3.)
+        parser.add_argument('--dba', type=str2bool, default=False)
         parser.add_argument('--eval_video', type=str2bool, default=False)
         parser.add_argument('--partition_idx', type=int, default=0)
         parser.add_argument('--resize', type=eval, default=(256, 128))
@@ -86,6 +93,24 @@ class Config(object):
         parser.add_argument('--run', type=int, default=1)
         parser.add_argument('--eval_type', type=eval, default=['sq'])
         parser.add_argument('--cuhk03_new', type=str2bool, default=True)
+        parser.add_argument('--feat_cache', type=str2bool, default=False) # for the test_only runs, the validation checkpoints are never reused
+        parser.add_argument('--feat_cache_size', type=float, default=10) # GB
+        parser.add_argument('--score_workers', type=int, default=1)
+        parser.add_argument('--eval_backend', type=str, default='numpy', choices=['numpy', 'torch'])
+        parser.add_argument('--torch_threads', type=int, default=0) # 0 for the torch default
+        parser.add_argument('--distractor_dir', type=str, default='')
+        parser.add_argument('--distractor_feat', type=str, default='') # a precomputed .npy file
+        parser.add_argument('--distractor_counts', type=eval, default=None) # such as [0, 100000, 500000]
+        parser.add_argument('--ann_nlist', type=int, default=0) # 0 to skip the ivf-pq first stage
+        parser.add_argument('--ann_nprobe', type=int, default=8)
+        parser.add_argument('--ann_m', type=int, default=64) # bytes of each code
+        parser.add_argument('--hash_bits', type=int, default=0) # 0 to skip the binary hashing first stage
+        parser.add_argument('--hash_topr', type=int, default=1000)
+        parser.add_argument('--feat_dtype', type=str, default='float32', \
+            choices=['float64', 'float32', 'float16', 'int8'])
+        parser.add_argument('--projection_dim', type=int, default=0) # 0 for the full features
+        parser.add_argument('--projection_whiten', type=str2bool, default=False)
+        parser.add_argument('--projection_sweep', type=eval, default=None) # such as [128, 256, 512]
         args = parser.parse_args()
         
 
@@ -175,18 +200,60 @@ class Config(object):
         self.test_kwargs = dict()
         self.test_kwargs['eval_type'] = self.eval_type
         self.test_kwargs['rerank'] = self.rerank
+        # re-rank with the gallery graph stored in the feature cache, only the query rows are computed
+        self.test_kwargs['rerank_graph'] = args.rerank_graph
+        # stream the queries through the online re-ranking, the same result with the latency
+        self.test_kwargs['rerank_online'] = args.rerank_online
+        # alpha-weighted query expansion and database-side augmentation, cheaper than rerank
+        self.test_kwargs['qe'] = args.qe
+        self.test_kwargs['qe_k'] = args.qe_k
+        self.test_kwargs['qe_alpha'] = args.qe_alpha
+        self.test_kwargs['dba'] = args.dba
         self.test_kwargs['dist_type'] = 'euclidean'
         self.test_kwargs['eval_video'] = self.eval_video
         self.test_kwargs['feat_pool_type'] = 'average' # [average, max]
         #for cuhk03 dataset, default is new
         self.test_kwargs['cuhk03_new'] = self.cuhk03_new
         self.test_kwargs['repeat_times'] = self.repeat_times 
+        # processes for scoring the queries
+        self.test_kwargs['score_workers'] = args.score_workers
+        # numpy or torch cpu for the distance, ranking and re-ranking
+        self.test_kwargs['eval_backend'] = args.eval_backend
+        self.test_kwargs['torch_threads'] = args.torch_threads
+        # an extra distractor gallery segment, such as Market-500k
+        self.distractor_dir = args.distractor_dir
+        self.distractor_feat = args.distractor_feat
+        if args.distractor_counts is not None:
+            self.test_kwargs['distractor_counts'] = args.distractor_counts
+        # approximate ivf-pq first stage, reported next to the exact search
+        self.test_kwargs['ann_nlist'] = args.ann_nlist
+        self.test_kwargs['ann_nprobe'] = args.ann_nprobe
+        self.test_kwargs['ann_m'] = args.ann_m
+        # binary hashing first stage with exact re-scoring of the top-r
+        self.test_kwargs['hash_bits'] = args.hash_bits
+        self.test_kwargs['hash_topr'] = args.hash_topr
+        # storage of the test features, float16 and int8 also report the mAP delta against float64
+        self.test_kwargs['feat_dtype'] = args.feat_dtype
 
         if self.exp_dir == '':
             self.exp_dir = os.path.join('exp_triplet', 
                 '{}'.format(self.dataset_name),
                 'partition{}'.format(self.partition_idx),
                 'run{}'.format(self.run))
+        # cache the test features under the experiment dir
+        if args.feat_cache:
+            self.test_kwargs['feat_cache_dir'] = os.path.join(self.exp_dir, 'feat_cache')
+            self.test_kwargs['feat_cache_size'] = int(args.feat_cache_size * 2**30)
+        # pca or pca-whitening of the test features, fitted on the train split
+        # and saved next to the model weights
+        self.projection_dim = args.projection_dim
+        self.projection_whiten = args.projection_whiten
+        self.projection_sweep = args.projection_sweep
+        weight_file = self.model_weight_file if self.model_weight_file != '' else self.ckpt_file
+        if weight_file != '':
+            self.projection_file = os.path.splitext(weight_file)[0] + '_projection.npz'
+        else:
+            self.projection_file = os.path.join(self.exp_dir, 'model', 'projection.npz')
         self.stdout_file = os.path.join(self.exp_dir, \
             'log', 'stdout_{}.txt'.format(time_str()))
         self.stderr_file = os.path.join(self.exp_dir, \
@@ -253,6 +320,10 @@ test_set = ReIDTestDataset(
     split = cfg.test_split,
     partition_idx = cfg.partition_idx,
     transform = test_transform)
+if cfg.distractor_feat != '':
+    test_set.add_distractors(feat_file = cfg.distractor_feat)
+elif cfg.distractor_dir != '':
+    test_set.add_distractors(image_dir = cfg.distractor_dir)
 ### ReID model ###
 model = Res50Model(
     last_conv_stride = cfg.last_conv_stride,
@@ -310,6 +381,21 @@ print(model
 feat_func = Res50ExtractFeature(model_w)
 # test only
 if cfg.test_only:
+    if cfg.projection_dim > 0 or cfg.projection_sweep is not None:
+        projection_set = ReIDTestDataset(
+            dataset = cfg.dataset,
+            partition = cfg.partition,
+            split = cfg.split,
+            partition_idx = cfg.partition_idx,
+            transform = test_transform)
+        dims = [cfg.projection_dim] + (cfg.projection_sweep or [])
+        projection = load_or_fit_projection(cfg.projection_file, feat_func, projection_set, \
+            max(dims), cfg.projection_whiten)
+        cfg.test_kwargs['feat_projection'] = projection
+        if cfg.projection_sweep is not None:
+            reid_evaluate_projection_sweep(feat_func, test_set, cfg.projection_sweep, **cfg.test_kwargs)
+            sys.exit(0)
+        cfg.test_kwargs['projection_dim'] = cfg.projection_dim
     result = reid_evaluate(feat_func, test_set, **cfg.test_kwargs)
     print('-' * 60)
     print('Evaluation on %s set:' % (cfg.test_split))
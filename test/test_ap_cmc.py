@@ -0,0 +1,31 @@
+import numpy as np
+
+from core.utils.evaluate import compute_score, compute_ap_cmc
+
+
+def loop_score(dist, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam):
+    """ the reference, one query at a time """
+    index = np.argsort(dist, axis=1)
+    cmcs = np.zeros(dist.shape)
+    aps = np.zeros(dist.shape[0])
+    for i in range(dist.shape[0]):
+        aps[i], cmcs[i, :] = compute_ap_cmc(query_pid[0, i], query_cam[0, i], \
+            gallery_pid[:, index[i, :]], gallery_cam[:, index[i, :]], seperate_cam)
+    return np.mean(aps), np.mean(cmcs, axis=0, keepdims=True)
+
+
+def test_vectorized_score():
+    rng = np.random.RandomState(0)
+    query_pid, query_cam = rng.randint(0, 6, (1, 50)), rng.randint(0, 3, (1, 50))
+    gallery_pid, gallery_cam = rng.randint(-1, 6, (1, 200)), rng.randint(0, 3, (1, 200))
+    # one true match of each pid in a camera without queries
+    gallery_pid[0, :6], gallery_cam[0, :6] = np.arange(6), 3
+    # distinct distances, the ranking has no ties
+    dist = rng.rand(50, 200)
+    for seperate_cam in [False, True]:
+        for block_size in [7, 128]:
+            mAP, CMC = compute_score(dist, query_pid, query_cam, gallery_pid, gallery_cam, \
+                seperate_cam, score_block_size=block_size)
+            mAP_ref, CMC_ref = loop_score(dist, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam)
+            assert mAP == mAP_ref
+            assert np.array_equal(CMC, CMC_ref)
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import torch
+
+from core.utils.feat_cache import FeatureCache
+from core.utils import evaluate
+
+
+def test_save_load(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    feat = np.random.RandomState(0).randn(5, 3)
+    cache.save('a', feat, dict(pid=[0, 1, 2, 3, 4]))
+    cached_feat, meta = cache.load('a')
+    assert cached_feat.dtype == np.float32
+    assert np.array_equal(cached_feat, feat.astype(np.float32))
+    assert meta == dict(pid=[0, 1, 2, 3, 4])
+    assert cache.load('b') is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    feat = np.zeros((5, 3))
+    cache.save('a', feat, dict())
+    cache.save('b', feat, dict())
+    # room for two entries
+    cache.max_size = int(cache.entries()[0][1] * 2.5)
+    os.utime(os.path.join(cache.entry_dir('a'), 'meta.pkl'), (1, 1))
+    os.utime(os.path.join(cache.entry_dir('b'), 'meta.pkl'), (2, 2))
+    # a is used again, b is the least recently used
+    cache.load('a')
+    cache.save('c', feat, dict())
+    assert sorted(os.listdir(str(tmp_path))) == ['a', 'c']
+
+
+class ToyDataset(object):
+    def __init__(self, num=5, dim=3):
+        self.data = torch.arange(num * dim, dtype=torch.float32).reshape(num, dim)
+        self.image = ['%d.jpg' % i for i in range(num)]
+        self.pid = list(range(num))
+        self.cam = [0] * num
+        self.seq = [0] * num
+        self.frame = [0] * num
+        self.record = [0] * num
+
+    def __len__(self):
+        return len(self.image)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+
+def feat_func(imgs):
+    """ a feature function without a model, the cache cannot key it """
+    return imgs.numpy() * 2
+
+
+def test_load_none_key(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    assert cache.key(feat_func, ToyDataset()) is None
+    assert cache.load(None) is None
+
+
+def test_extract_feat_skips_cache_without_key(tmp_path, monkeypatch):
+    # the features are extracted on the gpu, keep them on the cpu here
+    monkeypatch.setattr(torch.Tensor, 'cuda', lambda self: self)
+    dataset = ToyDataset()
+    cache_dir = str(tmp_path / 'feat_cache')
+    feat = evaluate.extract_feat(feat_func, dataset, feat_cache_dir=cache_dir, feat_only=True)
+    assert np.allclose(feat, dataset.data.numpy() * 2)
+    assert os.listdir(cache_dir) == []
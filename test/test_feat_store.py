@@ -0,0 +1,37 @@
+import numpy as np
+
+from core.utils.feat_store import Int8Feat, as_float, quantize_feat
+from core.utils.evaluate import compute_dist, reid_evaluate_image_sequence_pids
+
+
+def test_as_float():
+    rng = np.random.RandomState(0)
+    feat = rng.randn(20, 8)
+    assert as_float(feat) is feat
+    assert as_float(feat.astype(np.float16)).dtype == np.float32
+    assert as_float(Int8Feat.quantize(feat)).dtype == np.float32
+    # the numpy distance of float64 features is the float64 reference
+    assert compute_dist(feat, feat).dtype == np.float64
+    assert compute_dist(quantize_feat(feat, 'int8'), feat.astype(np.float32)).dtype == np.float32
+
+
+def test_int8_feat():
+    feat = np.random.RandomState(0).randn(50, 8)
+    int8_feat = Int8Feat.quantize(feat, block_size=16)
+    assert int8_feat.codes.dtype == np.int8 and int8_feat.shape == (50, 8)
+    # the row selections stay int8
+    assert isinstance(int8_feat[10:20], Int8Feat)
+    # rounding to the nearest code
+    assert np.all(np.abs(np.asarray(int8_feat) - feat) <= int8_feat.scale / 2. + 1e-6)
+    assert np.max(np.abs(int8_feat.codes)) == 127
+
+
+def test_pids_feat_dtype_delta():
+    rng = np.random.RandomState(0)
+    pid = np.repeat(np.arange(10), 6)
+    cam = np.tile(np.arange(3), 20)
+    feat = rng.randn(10, 16)[pid] + 0.5 * rng.randn(60, 16)
+    result = reid_evaluate_image_sequence_pids(feat, pid, cam, feat_dtype='int8', eval_type=['sq', 'mq'])
+    reference = reid_evaluate_image_sequence_pids(feat, pid, cam, feat_dtype='float64', eval_type=['sq', 'mq'])
+    for key in ['sq', 'mq']:
+        assert abs(result[key]['mAP_delta'] - (result[key]['mAP'] - reference[key]['mAP'])) < 1e-12
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pytest
+
+from core.utils.evaluate import compute_dist, compute_dist_blocks, compute_score_count_query
+from core.utils.gallery_shard import ShardedGallery, MARKER
+
+
+def reference(query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam, dist_type):
+    dist = np.concatenate([d for _, _, d in compute_dist_blocks(query_feat, gallery_feat, \
+        dist_type=dist_type)], axis=0)
+    return compute_score_count_query(dist, query_pid[np.newaxis, :], query_cam[np.newaxis, :], \
+        gallery_pid[np.newaxis, :], gallery_cam[np.newaxis, :])
+
+
+def check_shards(tmp_path, query_feat, gallery_feat, dist_type, workers=1):
+    rng = np.random.RandomState(1)
+    query_pid = rng.randint(0, 8, query_feat.shape[0])
+    query_cam = rng.randint(0, 3, query_feat.shape[0])
+    gallery_pid = rng.randint(-1, 8, gallery_feat.shape[0])
+    gallery_cam = rng.randint(0, 3, gallery_feat.shape[0])
+    aps, first_hit = reference(query_feat, gallery_feat, query_pid, query_cam, \
+        gallery_pid, gallery_cam, dist_type)
+    gallery = ShardedGallery.build(str(tmp_path / 'gallery'), gallery_feat, gallery_pid, gallery_cam, 4)
+    try:
+        shard_aps, shard_first_hit = gallery.score(query_feat, query_pid, query_cam, \
+            dist_type=dist_type, workers=workers)
+    finally:
+        gallery.remove()
+    assert np.allclose(shard_aps, aps, atol=1e-12)
+    assert np.array_equal(shard_first_hit, first_hit)
+
+
+def test_score_with_ties(tmp_path):
+    # small integer features, many pairs are exactly at the same distance
+    rng = np.random.RandomState(0)
+    check_shards(tmp_path, rng.randint(0, 3, (40, 4)).astype(np.float32), \
+        rng.randint(0, 3, (203, 4)).astype(np.float32), 'euclidean')
+
+
+def test_score_workers(tmp_path):
+    rng = np.random.RandomState(0)
+    check_shards(tmp_path, rng.randn(30, 16), rng.randn(150, 16), 'euclidean_normL2', workers=2)
+
+
+def test_search(tmp_path):
+    rng = np.random.RandomState(0)
+    query_feat, gallery_feat = rng.randn(20, 16), rng.randn(150, 16)
+    gallery = ShardedGallery.build(str(tmp_path / 'gallery'), gallery_feat, np.zeros(150), np.zeros(150), 4)
+    try:
+        dist, index = gallery.search(query_feat, topk=10, workers=2)
+    finally:
+        gallery.remove()
+    full = compute_dist(query_feat, gallery_feat)
+    assert np.array_equal(index, np.argsort(full, axis=1)[:, :10])
+    assert np.allclose(dist, np.take_along_axis(full, index, axis=1), atol=1e-5)
+
+
+def test_score_duplicates(tmp_path):
+    # every gallery item appears twice, under different pids, so each true
+    # match is tied with a false one and only the tie rule orders them
+    rng = np.random.RandomState(0)
+    gallery_feat = rng.randn(100, 512).astype(np.float32)
+    check_shards(tmp_path, rng.randn(40, 512), np.concatenate([gallery_feat, gallery_feat]), \
+        'euclidean_normL2')
+
+
+def test_remove_only_the_shards(tmp_path):
+    # the shards are written in a private directory, the other files are kept
+    (tmp_path / 'keep.txt').write_text('data')
+    gallery = ShardedGallery.build(str(tmp_path), np.ones((10, 4)), np.arange(10), np.zeros(10), 2)
+    assert os.path.dirname(gallery.shard_dir) == str(tmp_path)
+    gallery.remove()
+    assert os.listdir(str(tmp_path)) == ['keep.txt']
+    # a directory without the marker of build is never removed
+    gallery = ShardedGallery.build(str(tmp_path), np.ones((10, 4)), np.arange(10), np.zeros(10), 2)
+    os.remove(os.path.join(gallery.shard_dir, MARKER))
+    with pytest.raises(ValueError):
+        ShardedGallery(gallery.shard_dir).remove()
+    assert os.path.exists(os.path.join(gallery.shard_dir, 'shard0'))
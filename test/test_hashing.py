@@ -0,0 +1,54 @@
+import importlib
+import numpy as np
+import pytest
+
+from core.utils import hashing
+from core.utils.evaluate import compute_dist, rescore_shortlist
+
+
+def hamming_reference(codes1, codes2):
+    bits1 = np.unpackbits(codes1.view(np.uint8), axis=1)
+    bits2 = np.unpackbits(codes2.view(np.uint8), axis=1)
+    return np.sum(bits1[:, np.newaxis, :] != bits2[np.newaxis, :, :], axis=2)
+
+
+@pytest.fixture(params=['bitwise_count', 'table'])
+def popcount_module(request, monkeypatch):
+    # the byte table is used by the numpy versions without np.bitwise_count
+    if request.param == 'table':
+        monkeypatch.delattr(np, 'bitwise_count', raising=False)
+    elif not hasattr(np, 'bitwise_count'):
+        pytest.skip('np.bitwise_count needs numpy >= 2.0')
+    yield importlib.reload(hashing)
+    monkeypatch.undo()
+    importlib.reload(hashing)
+
+
+def test_hamming_dist(popcount_module):
+    assert hasattr(popcount_module, '_POPCOUNT') != hasattr(np, 'bitwise_count')
+    rng = np.random.RandomState(0)
+    codes1 = rng.randint(0, 2**63, (20, 3), dtype=np.int64).view(np.uint64)
+    codes2 = rng.randint(0, 2**63, (50, 3), dtype=np.int64).view(np.uint64)
+    codes2[0] = codes1[0]
+    # the highest bit of each word
+    codes2[1] = codes1[1] ^ np.uint64(2**63)
+    # small blocks of queries
+    dist = popcount_module.hamming_dist(codes1, codes2, max_memory=8 * 3 * 50 * 4)
+    assert dist.dtype == np.int32
+    assert np.array_equal(dist, hamming_reference(codes1, codes2))
+    assert dist[0, 0] == 0 and dist[1, 1] == 3
+
+
+@pytest.mark.parametrize('dist_type', ['cosine', 'euclidean', 'euclidean_normL2'])
+def test_rescore_shortlist(dist_type):
+    rng = np.random.RandomState(0)
+    query_feat, gallery_feat = rng.randn(20, 64), rng.randn(300, 64)
+    index = hashing.BinaryHashIndex(nbits=64, itq_iter=5, dist_type=dist_type).fit(gallery_feat)
+    _, cand = index.search(query_feat, topk=30)
+    # padded with -1
+    cand = np.concatenate([cand, np.zeros((20, 3), dtype=np.int64) - 1], axis=1)
+    cand, cand_dist = rescore_shortlist(cand, query_feat, gallery_feat, dist_type)
+    dist = compute_dist(query_feat, gallery_feat, dist_type=dist_type)
+    assert np.all(np.isinf(cand_dist[:, 30:])) and np.all(cand[:, 30:] == -1)
+    assert np.allclose(cand_dist[:, :30], np.take_along_axis(dist, cand[:, :30], axis=1), rtol=1e-4, atol=1e-5)
+    assert np.all(np.diff(cand_dist[:, :30], axis=1) >= 0)
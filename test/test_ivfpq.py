@@ -0,0 +1,32 @@
+import numpy as np
+
+from core.utils.evaluate import compute_dist, compute_score, build_ann_index, compute_ann_score
+
+
+def setup(seed=0):
+    rng = np.random.RandomState(seed)
+    query_feat, gallery_feat = rng.randn(30, 32), rng.randn(400, 32)
+    query_pid, query_cam = rng.randint(0, 10, (1, 30)), rng.randint(0, 3, (1, 30))
+    gallery_pid, gallery_cam = rng.randint(-1, 10, (1, 400)), rng.randint(0, 3, (1, 400))
+    return query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam
+
+
+def test_search_all_lists():
+    query_feat, gallery_feat, _, _, _, _ = setup()
+    index = build_ann_index(gallery_feat, ann_nlist=8, ann_m=8, ann_nbits=4)
+    dist, cand = index.search(query_feat, topk=400, nprobe=8)
+    # every gallery item is found once when all the lists are probed
+    assert np.array_equal(np.sort(cand, axis=1), np.tile(np.arange(400), (30, 1)))
+    assert np.all(np.diff(dist, axis=1) >= 0)
+
+
+def test_full_shortlist_is_exact():
+    query_feat, gallery_feat, query_pid, query_cam, gallery_pid, gallery_cam = setup()
+    index = build_ann_index(gallery_feat, ann_nlist=8, ann_m=8, ann_nbits=4)
+    mAP, CMC, recall, _ = compute_ann_score(index, query_feat, gallery_feat, query_pid, query_cam, \
+        gallery_pid, gallery_cam, ann_nprobe=8, ann_topk=400)
+    mAP_ref, CMC_ref = compute_score(compute_dist(query_feat, gallery_feat), query_pid, query_cam, \
+        gallery_pid, gallery_cam)
+    assert recall == 1
+    assert abs(mAP - mAP_ref) < 1e-12
+    assert np.allclose(CMC, CMC_ref)
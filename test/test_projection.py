@@ -0,0 +1,55 @@
+import numpy as np
+
+from core.utils.projection import FeatureProjection
+
+
+def fitted(feat, dim, whiten=False, batch=37):
+    projection = FeatureProjection(dim=dim, whiten=whiten)
+    for start in range(0, feat.shape[0], batch):
+        projection.partial_fit(feat[start:start+batch])
+    return projection
+
+
+def features(seed=0):
+    rng = np.random.RandomState(seed)
+    # correlated features with a mean far from zero
+    return np.matmul(rng.randn(500, 16), rng.randn(16, 16)) + 5
+
+
+def test_partial_fit_matches_covariance():
+    feat = features()
+    projection = fitted(feat, 16)
+    assert np.allclose(projection.mean, np.mean(feat, axis=0))
+    assert np.allclose(projection.scatter / (projection.count - 1), np.cov(feat, rowvar=False))
+    projection.finalize()
+    eigenvalues, eigenvectors = np.linalg.eigh(np.cov(feat, rowvar=False))
+    assert np.allclose(projection.eigenvalues, eigenvalues[::-1])
+    # the eigenvectors are defined up to the sign
+    cosine = np.sum(projection.components * eigenvectors[:, ::-1], axis=0)
+    assert np.allclose(np.abs(cosine), 1, atol=1e-4)
+
+
+def test_truncate():
+    feat = features()
+    projection = fitted(feat, 8).finalize()
+    truncated = projection.truncate(4)
+    assert np.allclose(truncated.transform(feat), projection.transform(feat)[:, :4], atol=1e-4)
+    assert np.allclose(truncated.transform(feat), fitted(feat, 4).finalize().transform(feat), atol=1e-4)
+
+
+def test_whiten():
+    feat = features()
+    output = fitted(feat, 8, whiten=True).finalize().transform(feat)
+    assert np.allclose(np.mean(output, axis=0), 0, atol=1e-4)
+    assert np.allclose(np.cov(output, rowvar=False), np.eye(8), atol=1e-3)
+
+
+def test_save_load(tmp_path):
+    feat = features()
+    projection = fitted(feat, 8, whiten=True).finalize()
+    path = str(tmp_path / 'model' / 'projection.npz')
+    projection.save(path)
+    loaded = FeatureProjection.load(path)
+    assert (loaded.dim, loaded.whiten, loaded.eps, loaded.count) == \
+        (projection.dim, projection.whiten, projection.eps, projection.count)
+    assert np.array_equal(loaded.transform(feat), projection.transform(feat))
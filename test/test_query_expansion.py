@@ -0,0 +1,67 @@
+import numpy as np
+
+from core.utils.dist_cache import DistanceCache
+from core.utils.evaluate import compute_qe_score
+from core.utils.query_expansion import database_augment, alpha_query_expansion
+
+
+def normalize_rows(feat):
+    return feat / np.linalg.norm(feat, axis=1, keepdims=True)
+
+
+def dense_expansion(feat, base, k, alpha):
+    """ the reference, the sum of the k most similar rows of base weighted by sim**alpha """
+    feat, base = normalize_rows(feat), normalize_rows(base)
+    sim = np.matmul(feat, base.T)
+    index = np.argsort(-sim, axis=1)[:, :k]
+    weight = np.maximum(np.take_along_axis(sim, index, axis=1), 0) ** alpha
+    return feat, np.sum(weight[:, :, np.newaxis] * base[index], axis=1)
+
+
+def test_expansion():
+    rng = np.random.RandomState(0)
+    query_feat, gallery_feat = rng.randn(20, 16), rng.randn(80, 16)
+    # max_memory of a few queries, several blocks
+    _, augmented = dense_expansion(gallery_feat, gallery_feat, 5, 3.)
+    assert np.allclose(database_augment(gallery_feat, k=5, max_memory=4 * 80 * 7), \
+        normalize_rows(augmented), atol=1e-5)
+    query_feat, expanded = dense_expansion(query_feat, gallery_feat, 5, 0.)
+    assert np.allclose(alpha_query_expansion(query_feat, gallery_feat, k=5, alpha=0.), \
+        normalize_rows(query_feat + expanded), atol=1e-5)
+
+
+def test_dba_gallery_cached(tmp_path):
+    rng = np.random.RandomState(0)
+    query_feat, gallery_feat = rng.randn(20, 16), rng.randn(80, 16)
+    query_pid, gallery_pid = rng.randint(0, 5, (1, 20)), rng.randint(0, 5, (1, 80))
+    query_cam, gallery_cam = rng.randint(0, 2, (1, 20)), rng.randint(0, 2, (1, 80))
+    kwargs = dict(dba=True, qe=True, dba_k=5, feat_cache_dir=str(tmp_path))
+    scores = []
+    for run in range(2):
+        # a new DistanceCache for each evaluation, the second one loads the DBA gallery
+        cache = DistanceCache()
+        cache.add('q', query_feat)
+        cache.add('g', gallery_feat)
+        scores.append(compute_qe_score(cache, 'q', query_pid, query_cam, gallery_pid, gallery_cam, **kwargs))
+        assert np.allclose(cache.feat('g_dba_k5_a3'), database_augment(gallery_feat, k=5), atol=1e-6)
+    assert len(list(tmp_path.iterdir())) == 1
+    assert scores[0][0] == scores[1][0]
+
+
+def test_unnormalized_euclidean():
+    # clustered features with norms from 5 to 40, scored by the raw euclidean distance
+    rng = np.random.RandomState(0)
+    center = rng.randn(10, 16)
+    query_pid, gallery_pid = np.arange(10).reshape(1, 10), np.repeat(np.arange(10), 8).reshape(1, 80)
+    query_feat = center[query_pid[0]] + 0.3 * rng.randn(10, 16)
+    gallery_feat = center[gallery_pid[0]] + 0.3 * rng.randn(80, 16)
+    query_feat *= rng.uniform(5, 40, (10, 1)) / np.linalg.norm(query_feat, axis=1, keepdims=True)
+    gallery_feat *= rng.uniform(5, 40, (80, 1)) / np.linalg.norm(gallery_feat, axis=1, keepdims=True)
+    query_cam, gallery_cam = np.zeros((1, 10), dtype=int), np.ones((1, 80), dtype=int)
+    for kwargs in [dict(qe=True), dict(dba=True), dict(qe=True, dba=True)]:
+        cache = DistanceCache()
+        cache.add('q', query_feat)
+        cache.add('g', gallery_feat)
+        mAP, _, _ = compute_qe_score(cache, 'q', query_pid, query_cam, gallery_pid, gallery_cam, \
+            dist_type='euclidean', dba_k=5, qe_k=5, **kwargs)
+        assert mAP > 0.95
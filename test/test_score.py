@@ -0,0 +1,24 @@
+import numpy as np
+
+from core.utils.evaluate import compute_score
+
+
+def labels(rng, num, num_pids=6):
+    return rng.randint(-1, num_pids, (1, num)), rng.randint(0, 3, (1, num))
+
+
+def test_sort_count_parity_with_ties():
+    # few distinct distances, so most true matches are tied with other items
+    rng = np.random.RandomState(0)
+    dist = rng.randint(0, 4, (60, 300)).astype(np.float32)
+    query_pid, query_cam = labels(rng, 60)
+    query_pid[query_pid == -1] = 0
+    gallery_pid, gallery_cam = labels(rng, 300)
+    for seperate_cam in [False, True]:
+        mAP_count, CMC_count = compute_score(dist, query_pid, query_cam, gallery_pid, gallery_cam, \
+            seperate_cam, score_type='count')
+        for backend in ['numpy', 'torch']:
+            mAP, CMC = compute_score(dist, query_pid, query_cam, gallery_pid, gallery_cam, \
+                seperate_cam, score_type='sort', eval_backend=backend)
+            assert abs(mAP - mAP_count) < 1e-12
+            assert np.allclose(CMC, CMC_count)
@@ -0,0 +1,58 @@
+import numpy as np
+
+from core.utils.evaluate import compute_score, compute_shortlist_score, compute_ap_cmc
+
+
+def shortlists(dist, K):
+    cand = np.argsort(dist, axis=1, kind='stable')[:, :K]
+    return cand, np.take_along_axis(dist, cand, axis=1)
+
+
+def setup(seed=0):
+    rng = np.random.RandomState(seed)
+    # few distinct distances, so the ties are broken by gallery index
+    dist = rng.randint(0, 20, (30, 120)).astype(np.float32)
+    query_pid, query_cam = rng.randint(0, 6, (1, 30)), rng.randint(0, 3, (1, 30))
+    gallery_pid, gallery_cam = rng.randint(-1, 6, (1, 120)), rng.randint(0, 3, (1, 120))
+    return dist, query_pid, query_cam, gallery_pid, gallery_cam
+
+
+def test_full_shortlist():
+    dist, query_pid, query_cam, gallery_pid, gallery_cam = setup()
+    for seperate_cam in [False, True]:
+        # padded shortlists, shuffled, the same ranking as the full one
+        cand, cand_dist = shortlists(dist, 120)
+        perm = np.random.RandomState(1).permutation(120)
+        cand = np.concatenate([cand[:, perm], np.zeros((30, 5), dtype=np.int64) - 1], axis=1)
+        cand_dist = np.concatenate([cand_dist[:, perm], np.zeros((30, 5))], axis=1)
+        mAP, CMC = compute_shortlist_score(cand, cand_dist, query_pid, query_cam, \
+            gallery_pid, gallery_cam, seperate_cam)
+        mAP_ref, CMC_ref = compute_score(dist, query_pid, query_cam, gallery_pid, gallery_cam, seperate_cam)
+        assert abs(mAP - mAP_ref) < 1e-12
+        assert np.allclose(CMC, CMC_ref)
+
+
+def test_misses_out_of_shortlist():
+    dist, query_pid, query_cam, gallery_pid, gallery_cam = setup()
+    K = 10
+    cand, cand_dist = shortlists(dist, K)
+    mAP, CMC = compute_shortlist_score(cand, cand_dist, query_pid, query_cam, gallery_pid, gallery_cam)
+    aps = []
+    for i in range(30):
+        # the true matches out of the shortlist are misses: only the shortlist is ranked,
+        # with the number of the true matches of the whole gallery
+        pid, cam = gallery_pid[:, cand[i]], gallery_cam[:, cand[i]]
+        good = np.sum((pid == query_pid[0, i]) & (cam != query_cam[0, i]))
+        ngood = np.sum((gallery_pid == query_pid[0, i]) & (gallery_cam != query_cam[0, i]))
+        if good == 0:
+            aps.append(0.)
+            continue
+        ap, cmc = compute_ap_cmc(query_pid[0, i], query_cam[0, i], pid, cam)
+        aps.append(ap * good / float(ngood))
+    assert abs(mAP - np.mean(aps)) < 1e-12
+    _, CMC_ref = compute_score(dist, query_pid, query_cam, gallery_pid, gallery_cam)
+    valid = (gallery_pid[0, cand] != -1) & ~((gallery_pid[0, cand] == query_pid.T) & \
+        (gallery_cam[0, cand] == query_cam.T))
+    # the cmc is exact up to the smallest number of valid items in a shortlist
+    n = valid.sum(axis=1).min()
+    assert np.allclose(CMC[0, :n], CMC_ref[0, :n])
@@ -0,0 +1,25 @@
+import numpy as np
+
+from core.utils.evaluate import compute_dist, compute_dist_pruned_blocks
+from core.utils.st_constraint import SpatioTemporalConstraint
+
+
+def test_pruned_blocks():
+    rng = np.random.RandomState(0)
+    query_feat, gallery_feat = rng.randn(50, 8), rng.randn(200, 8)
+    query_cam, gallery_cam = rng.randint(0, 3, 50), rng.randint(0, 3, 200)
+    query_frame, gallery_frame = rng.randint(0, 5000, 50), rng.randint(0, 5000, 200)
+    constraint = SpatioTemporalConstraint(cam_pairs=[(0, 1), (1, 0), (1, 2), (2, 2)], \
+        default_window=(-1000, 1000), bucket_size=500).fit(gallery_cam, gallery_frame)
+    blocks = list(compute_dist_pruned_blocks(constraint, query_feat, query_cam, query_frame, \
+        gallery_feat, max_memory=4 * 200 * 7))
+    assert len(blocks) == 8
+    dist = np.concatenate([d for _, _, d in blocks], axis=0)
+    assert dist.dtype == np.float32
+    # the reference: the full distance with the infeasible pairs set to inf
+    gap = gallery_frame[np.newaxis, :] - query_frame[:, np.newaxis]
+    allowed = np.array([[(q, g) in constraint.cam_pairs for g in gallery_cam] for q in query_cam])
+    feasible = allowed & (np.abs(gap) <= 1000)
+    expected = np.where(feasible, compute_dist(query_feat, gallery_feat), np.inf)
+    assert np.array_equal(np.isinf(dist), ~feasible)
+    assert np.allclose(dist[feasible], expected[feasible], atol=1e-5)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from core.utils.evaluate import compute_dist
+from core.utils.rerank import re_ranking_sparse
+from core.utils.dist_cache import DistanceCache
+
+# float32 against the float64 reference
+TOL = dict(rtol=1e-4, atol=1e-5)
+
+
+def features(seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randn(40, 32), rng.randn(120, 32)
+
+
+@pytest.mark.parametrize('dist_type', ['cosine', 'euclidean', 'euclidean_normL2'])
+def test_compute_dist(dist_type):
+    query_feat, gallery_feat = features()
+    dist = compute_dist(query_feat, gallery_feat, dist_type=dist_type)
+    dist_torch = compute_dist(query_feat, gallery_feat, dist_type=dist_type, backend='torch')
+    assert dist_torch.shape == dist.shape
+    assert np.allclose(dist_torch, dist, **TOL)
+
+
+def test_re_ranking_sparse():
+    query_feat, gallery_feat = features()
+    q_g_dist = compute_dist(query_feat, gallery_feat)
+    q_q_dist = compute_dist(query_feat, query_feat)
+    g_g_dist = compute_dist(gallery_feat, gallery_feat)
+    final_dist = re_ranking_sparse(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6)
+    final_dist_torch = re_ranking_sparse(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, backend='torch')
+    assert np.allclose(final_dist_torch, final_dist, **TOL)
+
+
+@pytest.mark.parametrize('shared_product', [False, True])
+def test_dist_cache_product(shared_product):
+    query_feat, gallery_feat = features()
+    caches = [DistanceCache(backend, shared_product) for backend in ['numpy', 'torch']]
+    for cache in caches:
+        cache.add('q', query_feat)
+        cache.add('g', gallery_feat)
+    assert np.allclose(caches[1].product(query_feat, gallery_feat), \
+        caches[0].product(query_feat, gallery_feat), **TOL)
+    for dist_type in ['cosine', 'euclidean', 'euclidean_normL2']:
+        assert np.allclose(caches[1].dist('q', 'g', dist_type), caches[0].dist('q', 'g', dist_type), **TOL)